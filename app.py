@@ -1,20 +1,48 @@
 from __future__ import annotations
 
+import asyncio
+import atexit
+import base64
+import contextlib
+import contextvars
 import csv
+import hashlib
+import importlib.util
 import io
+import itertools
 import json
+import logging
+import logging.handlers
+import math
+import mimetypes
 import os
 import platform
+import queue
 import re
+import signal
+import socket
+import sqlite3
 import subprocess
+import sys
 import threading
 import time
 import uuid
-from datetime import datetime
+import zipfile
+from contextlib import asynccontextmanager, closing
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
+from urllib.parse import urlparse
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape as xml_escape
 
-from flask import Flask, jsonify, render_template, request, redirect, url_for, flash, send_file
+try:
+    import fcntl
+except ImportError:  # Windows: single local process, no cross-worker locking needed
+    fcntl = None
+
+from flask import Flask, jsonify, render_template, request, redirect, url_for, flash, send_file, session
 
 
 app = Flask(__name__, template_folder=str(Path("templates")))
@@ -23,6 +51,28 @@ app.secret_key = os.environ.get("FLASK_SECRET", "dev-secret")
 # Server-side downloads directory
 SERVER_DOWNLOADS_DIR = Path("server_downloads")
 SERVER_DOWNLOADS_DIR.mkdir(exist_ok=True)
+# Reports are stored once per distinct content, as objects/<sha256><ext> under the downloads dir
+REPORT_OBJECTS_DIR = "objects"
+HASH_CHUNK_BYTES = 1024 * 1024
+
+# Where the Performance and Participation report comes from: "export" (the portal's Excel export) or
+# "grid" (the grid's own JSON responses, written here; falls back to the export when nothing is captured)
+REPORT_SOURCE = os.environ.get("REPORT_SOURCE", "export").strip().lower()
+REPORT_GRID_FORMAT = os.environ.get("REPORT_GRID_FORMAT", "xlsx").strip().lower()  # "xlsx" or "csv"
+GRID_RESPONSE_PATTERN = re.compile(os.environ.get("GRID_RESPONSE_PATTERN", r"report|result|attempt|participa"), re.I)
+GRID_MAX_PAGES = 500
+# Columns used until an export from the portal has been seen (its header row is then learned per host)
+GRID_DEFAULT_COLUMNS = ("Name", "Email", "Status", "Score", "Percentage", "Time Taken", "Submitted On")
+GRID_COLUMN_ALIASES = {  # normalized column name -> normalized JSON keys that hold it
+    "name": ("fullname", "studentname", "candidatename", "username", "displayname"),
+    "email": ("emailid", "emailaddress", "mail", "useremail", "login"),
+    "status": ("attemptstatus", "teststatus", "state"),
+    "score": ("marks", "totalscore", "totalmarks", "obtainedmarks", "marksobtained"),
+    "percentage": ("percent", "scorepercentage", "percentagescore"),
+    "timetaken": ("duration", "timespent", "totaltime", "timetakeninseconds"),
+    "submittedon": ("submittedat", "submissiondate", "submittedtime", "endtime", "completedon"),
+}
+_ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)  # fixed member timestamps: identical rows give identical (deduplicated) files
 
 # File metadata storage (in-memory, could be replaced with database)
 file_metadata: dict[str, dict] = {}
@@ -30,68 +80,646 @@ file_metadata: dict[str, dict] = {}
 # Active process tracking for cancellation
 active_processes: dict[str, dict] = {}
 
+# Where browser jobs run: "thread" (inside the web process) or "worker" (worker.py pool via SQLite queue)
+JOB_BACKEND = os.environ.get("JOB_BACKEND", "thread").strip().lower()
+
 # Flag to track if browser installation has been attempted
 _browser_install_attempted = False
 _browser_install_success = False
 
+# Persistent server-side state (learned timings, queues, caches)
+SERVER_STATE_DIR = Path("server_state")
 
-def ensure_playwright_browsers_installed():
-    """Ensure Playwright browsers are installed. Runs automatically when user visits."""
-    global _browser_install_attempted, _browser_install_success, _browser_install_in_progress
-    
-    # If already successfully installed, return immediately
-    if _browser_install_success:
+# Browser readiness marker shared by all workers: written once per deploy after verification
+BROWSER_READY_MARKER = SERVER_STATE_DIR / "browser_ready.json"
+_browser_marker_cache: tuple[int, dict] | None = None
+_playwright_version_cache: str | None = None
+
+# Launch profiles: engine and flags chosen by a benchmark when browsers are verified, stored in the marker
+LAUNCH_ENGINES = {  # engine -> Playwright channel (None launches the default headless shell)
+    "chrome": "chrome",
+    "chromium": "chromium",
+    "chromium-headless-shell": None,
+}
+LAUNCH_FLAG_SETS = (
+    (),
+    ("--disable-dev-shm-usage",),
+    ("--disable-dev-shm-usage", "--disable-gpu"),
+    ("--disable-dev-shm-usage", "--disable-gpu", "--disable-extensions", "--mute-audio"),
+)
+LAUNCH_SANDBOX_ARGS = ("--no-sandbox", "--disable-setuid-sandbox")  # required for headless on some Linux servers
+LAUNCH_BENCHMARK_ROUNDS = int(os.environ.get("LAUNCH_BENCHMARK_ROUNDS", "2"))
+LAUNCH_BENCHMARK_BUDGET_S = float(os.environ.get("LAUNCH_BENCHMARK_BUDGET_S", "120"))  # profiles after this are skipped
+LAUNCH_MEMORY_TOLERANCE = 0.1  # profiles within 10% of the fastest are compared on memory
+
+# HAR record/replay of a job's network traffic for offline performance runs; set by har_bench.py
+HAR_MODE = "off"  # "record": save the traffic to HAR_PATH, "replay": serve it from HAR_PATH
+HAR_PATH: Path | None = None
+HAR_REPLAY_LATENCY_MS = 0.0  # extra delay per replayed request
+
+# SQLite job queue shared with worker.py processes
+JOB_QUEUE_DB = SERVER_STATE_DIR / "jobs.db"
+_files_synced_at = 0.0
+_jobs_db_migrated = False
+
+# Fair scheduling of queued jobs: global and per-user caps, weighted fair queuing, interactive first
+QUEUE_MAX_RUNNING = int(os.environ.get("QUEUE_MAX_RUNNING", "4"))  # upper bound of the adaptive limit
+QUEUE_MIN_RUNNING = int(os.environ.get("QUEUE_MIN_RUNNING", "1"))
+QUEUE_MAX_PER_USER = int(os.environ.get("QUEUE_MAX_PER_USER", "2"))  # user = portal host + username
+QUEUE_POLL_S = float(os.environ.get("QUEUE_POLL_S", "1"))
+QUEUE_DEFAULT_JOB_S = 180  # start-time estimate per job until some jobs have finished
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1  # scheduled batches and catalog crawls
+_dispatcher_thread: threading.Thread | None = None
+
+# Adaptive running-job limit (AIMD): halved while the host is overloaded, +1 while it has headroom
+QUEUE_AUTOSCALE = os.environ.get("QUEUE_AUTOSCALE", "1").lower() not in ("0", "false", "no")
+QUEUE_AUTOSCALE_INTERVAL_S = float(os.environ.get("QUEUE_AUTOSCALE_INTERVAL_S", "30"))
+QUEUE_CPU_HIGH = float(os.environ.get("QUEUE_CPU_HIGH", "0.9"))  # CPU utilisation (0-1) that halves the limit
+QUEUE_CPU_LOW = float(os.environ.get("QUEUE_CPU_LOW", "0.7"))  # below this the limit may grow
+QUEUE_MEM_HEADROOM_MB = int(os.environ.get("QUEUE_MEM_HEADROOM_MB", "600"))  # free memory needed to grow
+QUEUE_LATENCY_HIGH = 1.5  # step latencies at this multiple of their baseline halve the limit
+_cpu_sample: tuple[float, float] | None = None  # (busy, total) jiffies from the previous /proc/stat read
+autoscale_status: dict = {}
+_dispatch_wakeup = threading.Event()
+
+# Batch manifests: CSV/XLSX uploads of (course, module, test) rows, planned into batch jobs
+MANIFEST_MAX_ROWS = int(os.environ.get("MANIFEST_MAX_ROWS", "10000"))
+MANIFEST_COLUMNS = {  # accepted header names per field, compared case-insensitively
+    "course": ("course", "course name"),
+    "module": ("module", "module name"),
+    "test": ("test", "test name"),
+    "filename_choice": ("filename", "filename choice", "file name"),
+}
+# Expected seconds per navigation, used to balance sessions
+MANIFEST_COURSE_NAV_S = 20  # Courses tool search and course page
+MANIFEST_MODULE_NAV_S = 8  # module selection in the sidebar
+MANIFEST_REPORT_S = 120  # one report, dominated by the fixed shareable-link wait
+
+# Per-portal-host budgets, shared by all processes through jobs.db; 0 disables a limit
+PORTAL_RATE_LIMITS = {
+    "login": float(os.environ.get("PORTAL_LOGINS_PER_MIN", "6")),
+    "export": float(os.environ.get("PORTAL_EXPORTS_PER_MIN", "4")),
+}
+PORTAL_MAX_SESSIONS = int(os.environ.get("PORTAL_MAX_SESSIONS", "3"))  # running jobs per portal host
+PORTAL_LIMIT_MAX_WAIT_S = float(os.environ.get("PORTAL_LIMIT_MAX_WAIT_S", "600"))
+PORTAL_SLOW_FACTOR = float(os.environ.get("PORTAL_SLOW_FACTOR", "1.3"))  # speed factor that halves the budgets
+PORTAL_ADJUST_INTERVAL_S = 30  # at most one budget change per host this often
+PORTAL_MIN_BUDGET = 0.25  # budgets never drop below this fraction
+
+# Adaptive step timeouts, learned per portal host from observed latencies
+STEP_TIMINGS_FILE = SERVER_STATE_DIR / "step_timings.json"
+STEP_TIMEOUT_FLOOR_MS = int(os.environ.get("STEP_TIMEOUT_FLOOR_MS", "2000"))
+STEP_TIMEOUT_CEILING_MS = int(os.environ.get("STEP_TIMEOUT_CEILING_MS", "120000"))
+STEP_TIMEOUT_MARGIN = float(os.environ.get("STEP_TIMEOUT_MARGIN", "1.5"))
+STEP_TIMING_WINDOW = 50  # recent samples kept per (host, step)
+STEP_TIMING_MIN_SAMPLES = 5  # below this the hard-coded default is used
+step_timings: dict[str, dict[str, dict]] = {}  # host -> step -> {"samples": [...], "baseline_ms": float}
+_step_timings_lock = threading.Lock()
+_step_timings_loaded = False
+_step_timings_dirty: set[tuple[str, str]] = set()
+_portal_host: contextvars.ContextVar[str] = contextvars.ContextVar("portal_host", default="")
+
+# Job checkpoints: furthest step reached, so a failed job can be retried from there
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BACKOFF_S = float(os.environ.get("JOB_RETRY_BACKOFF_S", "5"))
+CHECKPOINT_STEPS = (
+    "logged_in", "course_page", "module_selected", "test_opened", "shareable_link", "report_downloaded",
+)
+_current_job_id: contextvars.ContextVar[str] = contextvars.ContextVar("current_job_id", default="")
+
+# Watchdog: a job past its deadline is failed with diagnostics, its slot freed and its page (or browser) stopped
+JOB_DEADLINE_S = float(os.environ.get("JOB_DEADLINE_S", "1200"))  # whole job, all attempts, not the keep-open wait
+JOB_DEADLINE_PER_ITEM_S = float(os.environ.get("JOB_DEADLINE_PER_ITEM_S", "300"))  # per batch report / crawled course
+STEP_DEADLINE_GRACE_S = float(os.environ.get("STEP_DEADLINE_GRACE_S", "60"))  # allowed beyond a wait's own timeout
+WATCHDOG_INTERVAL_S = 5
+WATCHDOG_KILL_AFTER_S = 10  # the browser is killed if the job has not stopped this long after its deadline
+_watchdog_thread: threading.Thread | None = None
+
+# Per-job progress events, kept in a ring of JOB_EVENTS_MAX slots per job in jobs.db
+JOB_EVENTS_MAX = int(os.environ.get("JOB_EVENTS_MAX", "200"))
+JOB_EVENTS_RETENTION_S = 86400  # events of jobs finished longer ago than this are dropped
+_job_event_queue: queue.SimpleQueue = queue.SimpleQueue()  # written by one thread, so emitting never waits on jobs.db
+_job_event_writer: threading.Thread | None = None
+_job_event_writer_lock = threading.Lock()
+_job_events_progress = threading.Condition()
+_job_events_queued = 0  # events put on the queue by this process
+_job_events_written = 0  # of those, events the writer has handled (stored or given up on)
+
+# Logging: records pass through a queue to a listener thread, so a log call never blocks a job's event loop
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()  # "json" or "text"
+LOG_SAMPLE_ABOVE_JOBS = int(os.environ.get("LOG_SAMPLE_ABOVE_JOBS", "4"))  # running jobs at which debug is sampled
+LOG_DEBUG_SAMPLE_RATE = int(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "10"))  # keep 1 in N debug records under load
+_current_step: contextvars.ContextVar[str] = contextvars.ContextVar("current_step", default="")
+_queue_running_jobs = 0  # jobs running across all processes, as of this process's last claim or finish
+log = logging.getLogger("reportgenerator")
+
+
+class _JobContextFilter(logging.Filter):
+    """Tag records with the current job, step and elapsed ms; sample debug records under load."""
+
+    def __init__(self):
+        super().__init__()
+        self._debug_count = itertools.count(1)  # next() is atomic, so threads never skip or repeat a slot
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        job_id = _current_job_id.get()
+        started_at = (active_processes.get(job_id) or {}).get("started_at") if job_id else None
+        record.job_id = job_id
+        record.step = _current_step.get()
+        record.elapsed_ms = round((time.time() - started_at) * 1000) if started_at else None
+        if record.levelno < logging.INFO and _queue_running_jobs >= LOG_SAMPLE_ABOVE_JOBS:
+            return next(self._debug_count) % LOG_DEBUG_SAMPLE_RATE == 0
         return True
-    
-    # If installation is in progress, don't start another one
-    if _browser_install_in_progress:
-        return False  # Still installing
+
+
+class _JobQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve the message and traceback in the calling thread; the listener only serializes
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.exc = logging.Formatter().formatException(record.exc_info) if record.exc_info else None
+        record.args, record.exc_info, record.exc_text = None, None, None
+        return record
+
+
+class _LogFormatter(logging.Formatter):
+    """One JSON object per record (LOG_FORMAT=json), or the classic "LEVEL: message" lines."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        if LOG_FORMAT != "json":
+            job = f"[{record.job_id[:8]}{' ' + record.step if record.step else ''}] " if record.job_id else ""
+            text = f"{record.levelname}: {job}{record.msg}"
+            return f"{text}\n{record.exc}" if record.exc else text
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "msg": record.msg,
+            "job_id": record.job_id or None,
+            "step": record.step or None,
+            "elapsed_ms": record.elapsed_ms,
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        if record.exc:
+            entry["exc"] = record.exc
+        return json.dumps({k: v for k, v in entry.items() if v is not None}, ensure_ascii=False)
+
+
+def _setup_logging():
+    if log.handlers:
+        return
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = _JobQueueHandler(records)
+    handler.addFilter(_JobContextFilter())
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(_LogFormatter())
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    atexit.register(listener.stop)  # flush what is still queued on exit
+    log.addHandler(handler)
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+
+
+_setup_logging()
+
+
+# Browser recycling and memory supervision
+BROWSER_MAX_JOBS = int(os.environ.get("BROWSER_MAX_JOBS", "20"))  # recycle after this many jobs
+BROWSER_MAX_RSS_MB = int(os.environ.get("BROWSER_MAX_RSS_MB", "700"))  # recycle above this process-tree RSS
+BROWSER_SAMPLE_INTERVAL_S = float(os.environ.get("BROWSER_SAMPLE_INTERVAL_S", "5"))
+HOST_MIN_AVAILABLE_MB = int(os.environ.get("HOST_MIN_AVAILABLE_MB", "250"))  # below this, new jobs wait
+HOST_PRESSURE_MAX_WAIT_S = int(os.environ.get("HOST_PRESSURE_MAX_WAIT_S", "300"))
+
+# Low-memory mode for small instances: leaner launch flags and contexts, pages closed early, no warm pool
+LOW_MEMORY_MODE = os.environ.get("LOW_MEMORY_MODE", "auto").lower()  # "on", "off" or "auto"
+LOW_MEMORY_AUTO_MB = int(os.environ.get("LOW_MEMORY_AUTO_MB", "2048"))  # auto: on for hosts with at most this RAM
+LOW_MEMORY_LAUNCH_ARGS = (
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--renderer-process-limit=2",  # contexts share renderers instead of one process tree each
+    "--disable-features=site-per-process,IsolateOrigins,Translate,BackForwardCache,MediaRouter,OptimizationHints",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-extensions",
+    "--dns-prefetch-disable",
+    "--disk-cache-size=1048576",
+    "--media-cache-size=1048576",
+    "--autoplay-policy=user-gesture-required",
+    "--mute-audio",
+)
+LOW_MEMORY_CONTEXT_OPTIONS = {
+    "viewport": {"width": 1024, "height": 768},
+    "service_workers": "block",
+    "reduced_motion": "reduce",
+}
+LOW_MEMORY_BLOCKED_MEDIA = "**/*.{mp4,webm,ogg,ogv,mp3,wav,m4a,aac}"
+LOW_MEMORY_PROBE_CONTEXTS = 3  # contexts opened per mode when measuring memory at verification
+_low_memory_auto: bool | None = None
+
+# Warm pool: logged-in contexts parked on the Courses tool for frequently used (portal, user) pairs
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", "0"))  # contexts per (portal, user); 0 disables
+WARM_POOL_MIN_USES = int(os.environ.get("WARM_POOL_MIN_USES", "2"))  # jobs within the window before pooling
+WARM_POOL_DEMAND_WINDOW_S = int(os.environ.get("WARM_POOL_DEMAND_WINDOW_S", "3600"))
+WARM_POOL_IDLE_TTL_S = int(os.environ.get("WARM_POOL_IDLE_TTL_S", "900"))
+
+# Recurring report schedules (cron-style), run in batches during the off-peak window
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "true").strip().lower() not in ("0", "false", "no")
+SCHEDULER_TICK_S = float(os.environ.get("SCHEDULER_TICK_S", "30"))
+SCHEDULE_OFFPEAK_WINDOW = os.environ.get("SCHEDULE_OFFPEAK_WINDOW", "01:00-05:00")  # server local time
+SCHEDULER_LOCK_FILE = SERVER_STATE_DIR / "scheduler.lock"
+# Schedules keep the portal password for as long as they exist, so it is stored encrypted with this key
+CREDENTIAL_KEY = os.environ.get("CREDENTIAL_KEY", "")
+CREDENTIAL_KEY_FILE = SERVER_STATE_DIR / "credential.key"  # generated when CREDENTIAL_KEY is not set
+_credential_cipher_cache = None
+_scheduler_thread: threading.Thread | None = None
+
+# Course -> module -> test catalog per portal, crawled incrementally; backs form autocomplete
+CATALOG_REFRESH_AGE_S = int(os.environ.get("CATALOG_REFRESH_AGE_S", str(7 * 24 * 3600)))  # re-crawl older courses
+CATALOG_MAX_COURSES_PER_RUN = int(os.environ.get("CATALOG_MAX_COURSES_PER_RUN", "25"))
+
+# Deep links: a learned course URL is only trusted once the page it opens names the course
+COURSE_TITLE_SELECTOR = os.environ.get(
+    "COURSE_TITLE_SELECTOR", "h1, h2, h3, .ui-breadcrumb, .course-title, .coursename"
+)
+_courses_tool_urls: dict[str, str] = {}  # host -> address of the Courses tool (search page)
+
+
+class JobCancelled(asyncio.CancelledError):
+    """Raised inside a job's flow when the job has been cancelled."""
+
+
+def _deploy_id() -> str:
+    """Identifies the current deploy so browser verification runs once per deploy."""
+    return os.environ.get("RENDER_GIT_COMMIT") or os.environ.get("DEPLOY_ID") or ""
+
+
+def _playwright_version() -> str:
+    """Installed Playwright version, read from package metadata without importing Playwright."""
+    global _playwright_version_cache
+    if _playwright_version_cache is None:
+        try:
+            from importlib.metadata import version
+            _playwright_version_cache = version("playwright")
+        except Exception:
+            _playwright_version_cache = ""
+    return _playwright_version_cache
+
+
+def read_browser_marker() -> dict | None:
+    """Return the readiness marker if it is valid for this deploy and its browser still exists."""
+    global _browser_marker_cache
+    try:
+        mtime = BROWSER_READY_MARKER.stat().st_mtime_ns
+    except OSError:
+        return None
+    if _browser_marker_cache is None or _browser_marker_cache[0] != mtime:
+        try:
+            _browser_marker_cache = (mtime, json.loads(BROWSER_READY_MARKER.read_text(encoding="utf-8")))
+        except Exception:
+            return None
+    marker = _browser_marker_cache[1]
+    if marker.get("deploy_id") != _deploy_id() or marker.get("playwright_version") != _playwright_version():
+        return None
+    if not os.path.exists(marker.get("executable_path", "")):
+        return None
+    return marker
+
+
+def write_browser_marker(executable_path: str, engine: str, **extra):
+    """Record a verified browser install so other workers and later boots skip verification."""
+    revision = re.search(r"(?:chromium|chrome)[-_a-z]*-(\d+)", executable_path)
+    marker = {
+        "engine": engine,
+        "executable_path": executable_path,
+        "revision": revision.group(1) if revision else None,
+        "playwright_version": _playwright_version(),
+        "deploy_id": _deploy_id(),
+        "verified_at": datetime.now().isoformat(),
+        **extra,
+    }
+    try:
+        SERVER_STATE_DIR.mkdir(exist_ok=True)
+        tmp_path = BROWSER_READY_MARKER.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(marker), encoding="utf-8")
+        os.replace(tmp_path, BROWSER_READY_MARKER)
+    except Exception as exc:
+        log.warning(f"Could not write browser readiness marker: {exc}")
+
+
+def benchmark_launch_profiles(
+    p, flag_sets: tuple = LAUNCH_FLAG_SETS, rounds: int | None = None, first_working: bool = False,
+) -> list[dict]:
+    """Launch every engine with every flag set (headless) and time it up to a rendered page.
+
+    `p` is a started sync Playwright. Returns one result per profile tried:
+    {"engine", "args", "ok", "launched", "launch_ms", "rss_mb", "executable_path", "error"}.
+    A profile that fails after its browser started is recorded as failed and the others are
+    still tried; an engine that does not launch at all is not retried with its other flag sets.
+    Profiles left when LAUNCH_BENCHMARK_BUDGET_S runs out are skipped. With `first_working`,
+    stop at the first profile that works (a plain launch check).
+    """
+    results = []
+    deadline = time.monotonic() + LAUNCH_BENCHMARK_BUDGET_S
+    for engine, channel in LAUNCH_ENGINES.items():
+        for flags in flag_sets:
+            if time.monotonic() > deadline:
+                log.warning(f"Launch benchmark budget of {LAUNCH_BENCHMARK_BUDGET_S:.0f} s used up, skipping the remaining profiles")
+                return results
+            timings, rss, executable_path, error, launched = [], [], None, None, False
+            for _ in range(rounds or LAUNCH_BENCHMARK_ROUNDS):
+                marker = f"--reportgen-benchmark={uuid.uuid4().hex[:12]}"
+                started = time.perf_counter()
+                try:
+                    browser = p.chromium.launch(
+                        headless=True, args=[*LAUNCH_SANDBOX_ARGS, *flags, marker],
+                        **({"channel": channel} if channel else {}),
+                    )
+                except Exception as exc:
+                    error = _error_line(exc)
+                    break
+                launched = True
+                try:
+                    page = browser.new_page()
+                    page.set_content("<html><body><p>launch benchmark</p></body></html>")
+                    timings.append((time.perf_counter() - started) * 1000)
+                    pid, rss_mb = process_tree_rss_mb(marker)
+                    if rss_mb is not None:
+                        rss.append(rss_mb)
+                    if pid is not None and executable_path is None:
+                        with contextlib.suppress(OSError):
+                            executable_path = os.readlink(f"/proc/{pid}/exe")
+                except Exception as exc:
+                    error = _error_line(exc)
+                    break
+                finally:
+                    with contextlib.suppress(Exception):
+                        browser.close()
+            results.append({
+                "engine": engine,
+                "args": list(flags),
+                "ok": error is None and bool(timings),
+                "launched": launched,
+                "launch_ms": round(_percentile(timings, 50)) if timings else None,
+                "rss_mb": round(_percentile(rss, 50), 1) if rss else None,
+                "executable_path": executable_path,
+                "error": error,
+            })
+            if first_working and results[-1]["ok"]:
+                return results
+            if not launched:
+                break
+    return results
+
+
+def _error_line(exc: Exception) -> str:
+    return str(exc).strip().splitlines()[0][:200] if str(exc).strip() else type(exc).__name__
+
+
+def choose_launch_profile(results: list[dict]) -> dict | None:
+    """The fastest working profile; among those within LAUNCH_MEMORY_TOLERANCE of it, the leanest."""
+    working = [r for r in results if r["ok"]]
+    if not working:
+        return None
+    fastest = min(r["launch_ms"] for r in working)
+    close = [r for r in working if r["launch_ms"] <= fastest * (1 + LAUNCH_MEMORY_TOLERANCE)]
+    return min(close, key=lambda r: (r["rss_mb"] if r["rss_mb"] is not None else float("inf"), r["launch_ms"]))
+
+
+def _launch_check_and_record_browsers() -> bool:
+    """Launch the first engine that starts, without extra flags, and record it in the readiness marker.
+
+    No launch profile is stored, so launches probe engines until the full benchmark has run.
+    """
+    from playwright.sync_api import sync_playwright  # type: ignore[reportMissingImports]
+    p = sync_playwright().start()
+    try:
+        results = benchmark_launch_profiles(p, flag_sets=((),), rounds=1, first_working=True)
+        working = next((r for r in results if r["ok"]), None)
+        if working is None:
+            log.debug(f"No browser engine launched: {[(r['engine'], r['error']) for r in results]}")
+            return False
+        write_browser_marker(working["executable_path"] or p.chromium.executable_path, working["engine"])
+        return True
+    finally:
+        p.stop()
+
+
+def _verify_browsers(full_benchmark: bool) -> bool:
+    """Whether a browser launches; writes the readiness marker if so.
+
+    With `full_benchmark` the launch profiles are benchmarked too. If the benchmark itself
+    fails, a plain launch check decides, so a benchmark bug never passes for a missing browser.
+    """
+    if full_benchmark:
+        try:
+            return _benchmark_and_record_browsers()
+        except Exception as exc:  # noqa: BLE001
+            log.warning(f"Launch benchmark failed ({exc}), checking with a plain launch instead")
+    try:
+        return _launch_check_and_record_browsers()
+    except Exception as exc:  # noqa: BLE001
+        log.debug(f"Plain browser launch failed: {exc}")
+        return False
+
+
+def _benchmark_launch_profiles_in_background():
+    """After a plain launch check at runtime: pick the launch profile without holding up jobs."""
+    def _run():
+        try:
+            with _browser_install_lock():
+                if (read_browser_marker() or {}).get("launch_benchmark"):
+                    return  # another worker has benchmarked this deploy already
+                _benchmark_and_record_browsers()
+        except Exception as exc:  # noqa: BLE001
+            log.warning(f"Background launch benchmark failed, launches keep probing engines: {exc}")
+
+    threading.Thread(target=_run, name="launch-benchmark", daemon=True).start()
+
+
+def _benchmark_and_record_browsers() -> bool:
+    """Benchmark the installed engines and store the chosen launch profile in the readiness marker."""
+    from playwright.sync_api import sync_playwright  # type: ignore[reportMissingImports]
+    p = sync_playwright().start()
+    try:
+        results = benchmark_launch_profiles(p)
+        profile = choose_launch_profile(results)
+        if profile is None and any(r["launched"] for r in results):
+            # Installed, but no profile got through the benchmark: keep the browsers and probe engines at launch
+            log.warning(f"No launch profile passed the benchmark: {[(r['engine'], r['error']) for r in results]}")
+            launched = next(r for r in results if r["launched"])
+            write_browser_marker(
+                launched["executable_path"] or p.chromium.executable_path,
+                launched["engine"],
+                launch_benchmark=[{k: v for k, v in r.items() if k != "executable_path"} for r in results],
+            )
+            return True
+        if profile is None:
+            log.debug(f"No browser engine launched: {[(r['engine'], r['error']) for r in results]}")
+            return False
+        log.info(
+            f"Launch profile: {profile['engine']} {' '.join(profile['args']) or '(no extra flags)'} "
+            f"in {profile['launch_ms']} ms, {profile['rss_mb']} MB"
+        )
+        try:
+            memory_profile = measure_low_memory_gain(p, profile)
+            if memory_profile.get("concurrency_gain"):
+                log.info(
+                    f"Low-memory mode fits {memory_profile['low_memory']['max_jobs']} jobs instead of "
+                    f"{memory_profile['standard']['max_jobs']} on this host (x{memory_profile['concurrency_gain']})"
+                )
+        except Exception as exc:  # noqa: BLE001
+            log.debug(f"Could not measure low-memory mode: {exc}")
+            memory_profile = {}
+        write_browser_marker(
+            profile["executable_path"] or p.chromium.executable_path,
+            profile["engine"],
+            launch_profile={"engine": profile["engine"], "args": profile["args"]},
+            launch_benchmark=[{k: v for k, v in r.items() if k != "executable_path"} for r in results],
+            memory_profile=memory_profile,
+        )
+        return True
+    finally:
+        p.stop()
+
+
+# Stand-in for a report page when measuring memory: a few thousand grid cells built by script
+_MEMORY_PROBE_HTML = """<html><body><table id="grid"></table><script>
+const grid = document.getElementById("grid");
+for (let i = 0; i < 2000; i++) {
+  const row = grid.insertRow();
+  for (let j = 0; j < 8; j++) row.insertCell().textContent = "Student " + i + " score " + (i * j % 97);
+}
+</script></body></html>"""
+
+
+def measure_low_memory_gain(p, profile: dict) -> dict:
+    """Measure browser and per-context memory with and without low-memory mode on this host.
+
+    Each mode launches the chosen engine and renders a synthetic grid page in
+    LOW_MEMORY_PROBE_CONTEXTS contexts, sampling the process-tree RSS after each one. Returns
+    per-mode {"browser_mb", "per_context_mb", "max_jobs"} and the "concurrency_gain" of
+    low-memory mode (max_jobs ratio); empty where RSS cannot be read (no /proc).
+    """
+    channel = LAUNCH_ENGINES.get(profile["engine"])
+    budget = (host_memory_status()["mem_total_mb"] or 0) - HOST_MIN_AVAILABLE_MB
+    measured = {}
+    for mode, launch_args, context_options in (
+        ("standard", (), {}),
+        ("low_memory", LOW_MEMORY_LAUNCH_ARGS, LOW_MEMORY_CONTEXT_OPTIONS),
+    ):
+        marker = f"--reportgen-benchmark={uuid.uuid4().hex[:12]}"
+        browser = p.chromium.launch(
+            headless=True, args=[*LAUNCH_SANDBOX_ARGS, *profile["args"], *launch_args, marker],
+            **({"channel": channel} if channel else {}),
+        )
+        try:
+            rss = []
+            for _ in range(LOW_MEMORY_PROBE_CONTEXTS):
+                browser.new_context(**context_options).new_page().set_content(_MEMORY_PROBE_HTML)
+                rss.append(process_tree_rss_mb(marker)[1])
+        finally:
+            browser.close()
+        if None in rss:
+            return {}
+        per_context = max((rss[-1] - rss[0]) / max(len(rss) - 1, 1), 1.0)
+        browser_mb = max(rss[0] - per_context, 0.0)
+        measured[mode] = {
+            "browser_mb": round(browser_mb, 1),
+            "per_context_mb": round(per_context, 1),
+            "max_jobs": max(0, int((budget - browser_mb) // per_context)) if budget > 0 else None,
+        }
+    standard, low = measured["standard"]["max_jobs"], measured["low_memory"]["max_jobs"]
+    measured["concurrency_gain"] = round(low / standard, 2) if standard and low is not None else None
+    return measured
+
+
+def low_memory_mode() -> bool:
+    """Whether browsers and contexts use the low-memory profile (LOW_MEMORY_MODE, or host RAM in auto)."""
+    global _low_memory_auto
+    if LOW_MEMORY_MODE in ("1", "true", "yes", "on"):
+        return True
+    if LOW_MEMORY_MODE != "auto":
+        return False
+    if _low_memory_auto is None:
+        total = _read_meminfo().get("MemTotal")
+        _low_memory_auto = total is not None and total <= LOW_MEMORY_AUTO_MB
+    return _low_memory_auto
+
+
+def launch_profile() -> dict | None:
+    """The benchmarked {"engine", "args"} for this deploy, or None before browsers were verified."""
+    return (read_browser_marker() or {}).get("launch_profile")
+
+
+def browsers_ready() -> bool:
+    """Cheap readiness check: this process verified browsers, or the shared marker says they exist."""
+    global _browser_install_success
+    if not _browser_install_success and read_browser_marker() is not None:
+        _browser_install_success = True
+    return _browser_install_success
+
+
+@contextlib.contextmanager
+def _browser_install_lock():
+    """Cross-process lock so only one gunicorn worker verifies/installs browsers at a time."""
+    SERVER_STATE_DIR.mkdir(exist_ok=True)
+    with open(SERVER_STATE_DIR / "browser_install.lock", "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def ensure_playwright_browsers_installed(full_benchmark: bool = False):
+    """Ensure Playwright browsers are installed. Runs automatically when user visits.
+
+    At runtime only a plain launch check runs before jobs may start, and the launch profiles
+    are benchmarked in the background; build.sh passes `full_benchmark` to do both up front.
+    """
+    # If already successfully installed (here or by another worker), return immediately
+    if browsers_ready():
+        return True
+    with _browser_install_lock():
+        # Another worker may have finished while we waited for the lock
+        if browsers_ready():
+            return True
+        ready = _install_and_verify_browsers(full_benchmark)
+    if ready and not full_benchmark:
+        _benchmark_launch_profiles_in_background()
+    return ready
+
+
+def _install_and_verify_browsers(full_benchmark: bool = False):
+    """Verify browsers by launching them, installing them first if needed."""
+    global _browser_install_attempted, _browser_install_success, _browser_install_in_progress
     
     # Allow retries if previous attempt failed
     # Only skip if we're currently installing
     _browser_install_attempted = True
     
     try:
-        print("INFO: Checking Playwright browser installation...")
+        log.info("Checking Playwright browser installation...")
         
-        # Check if browsers are already installed (try Chrome first, then Chromium)
-        try:
-            from playwright.sync_api import sync_playwright  # type: ignore[reportMissingImports]
-            p_check = sync_playwright().start()
-            try:
-                # Try Chrome first, then Chromium
-                try:
-                    browser = p_check.chromium.launch(channel="chrome", headless=True)
-                    browser.close()
-                    print("INFO: Chrome already installed and working!")
-                except Exception:
-                    # Chrome not available, try Chromium
-                    browser = p_check.chromium.launch(headless=True)
-                    browser.close()
-                    print("INFO: Chromium already installed and working!")
-                
-                chromium_path = p_check.chromium.executable_path
-                import os
-                if os.path.exists(chromium_path):
-                    print(f"INFO: Browser already installed at: {chromium_path}")
-                    _browser_install_success = True
-                    return True
-            except Exception as check_exc:
-                # Browser launch failed, browsers not installed
-                print(f"DEBUG: Browser check failed (browsers not installed): {check_exc}")
-            finally:
-                p_check.stop()
-        except Exception:
-            pass
+        # Check if browsers are already installed
+        if _verify_browsers(full_benchmark):
+            log.info("Browsers already installed and working!")
+            _browser_install_success = True
+            return True
         
         # Browsers not found - install them
-        print("INFO: Playwright browsers not found. Installing automatically...")
-        print("INFO: This may take a few minutes on first startup...")
+        log.info("Playwright browsers not found. Installing automatically...")
+        log.info("This may take a few minutes on first startup...")
         
         import subprocess
         # Try to install Chrome first (user preference)
         # On Linux servers, Chrome may not be available, so we'll fall back to Chromium
-        print("INFO: Attempting to install Chrome browser...")
+        log.info("Attempting to install Chrome browser...")
         result = subprocess.run(
             ["python", "-m", "playwright", "install", "chrome", "--force"],
             capture_output=True,
@@ -101,8 +729,8 @@ def ensure_playwright_browsers_installed():
         
         # If Chrome install fails (common on Linux servers), fall back to Chromium headless shell
         if result.returncode != 0:
-            print("INFO: Chrome installation failed (common on Linux servers).")
-            print("INFO: Falling back to Chromium headless shell (required for headless mode)...")
+            log.info("Chrome installation failed (common on Linux servers).")
+            log.info("Falling back to Chromium headless shell (required for headless mode)...")
             result = subprocess.run(
                 ["python", "-m", "playwright", "install", "chromium-headless-shell", "--force"],
                 capture_output=True,
@@ -111,49 +739,32 @@ def ensure_playwright_browsers_installed():
             )
         
         if result.returncode == 0:
-            # Verify Chrome actually works
-            try:
-                from playwright.sync_api import sync_playwright  # type: ignore[reportMissingImports]
-                p_verify = sync_playwright().start()
-                try:
-                    # Try to launch Chrome in headless mode
-                    browser = p_verify.chromium.launch(channel="chrome", headless=True)
-                    browser.close()
-                    print("INFO: ✅ Chrome installed and verified!")
-                    _browser_install_success = True
-                    return True
-                except Exception as verify_exc:
-                    print(f"WARNING: Installation succeeded but browser doesn't work: {verify_exc}")
-                    print("INFO: Will retry installation on next request...")
-                    _browser_install_success = False  # Reset so it tries again
-                    _browser_install_attempted = False  # Reset flag to allow retry
-                    return False
-                finally:
-                    p_verify.stop()
-            except Exception as verify_err:
-                print(f"WARNING: Could not verify Chrome installation: {verify_err}")
-                # Assume it worked if we can't verify
-                print("INFO: ✅ Chrome installed (verification skipped)")
+            # Verify the install actually launches; this also writes the readiness marker
+            if _verify_browsers(full_benchmark):
+                log.info("✅ Browser installed and verified!")
                 _browser_install_success = True
                 return True
+            log.warning("Installation succeeded but no browser engine launches")
+            log.info("Will retry installation on next request...")
+            _browser_install_success = False  # Reset so it tries again
+            _browser_install_attempted = False  # Reset flag to allow retry
+            return False
         else:
             error_output = result.stderr or result.stdout
-            print(f"ERROR: Chrome installation failed: {error_output[:500]}")
-            print("ERROR: Chrome is required. Please ensure Chrome can be installed on this system.")
+            log.error(f"Chrome installation failed: {error_output[:500]}")
+            log.error("Chrome is required. Please ensure Chrome can be installed on this system.")
             # Reset flag so it can retry
             _browser_install_attempted = False
             return False
             
     except subprocess.TimeoutExpired:
-        print("ERROR: Browser installation timed out after 10 minutes.")
-        print("INFO: Installation will be retried automatically on next page visit.")
+        log.error("Browser installation timed out after 10 minutes.")
+        log.info("Installation will be retried automatically on next page visit.")
         _browser_install_attempted = False  # Reset so it can retry
         return False
     except Exception as exc:
-        print(f"ERROR: Could not install browsers automatically: {exc}")
-        import traceback
-        traceback.print_exc()
-        print("INFO: Installation will be retried automatically on next page visit.")
+        log.exception(f"Could not install browsers automatically: {exc}")
+        log.info("Installation will be retried automatically on next page visit.")
         _browser_install_attempted = False  # Reset so it can retry
         return False
 
@@ -164,20 +775,97 @@ def get_server_downloads_dir() -> Path:
     return SERVER_DOWNLOADS_DIR
 
 
-def register_downloaded_file(filepath: Path, original_name: str, course_name: str = "", test_name: str = "") -> str:
-    """Register a downloaded file and return its unique identifier."""
+def register_downloaded_file(
+    filepath: Path, original_name: str, course_name: str = "", test_name: str = "", sha256: str = ""
+) -> str:
+    """Register a downloaded file and return its unique identifier.
+
+    Several entries may point at the same content-addressed file; `duplicate_of` names the
+    newest earlier entry with identical content (i.e. the report has not changed since).
+    """
     file_id = f"{int(time.time())}_{filepath.name}"
+    suffix = 1
+    while file_id in file_metadata:
+        suffix += 1
+        file_id = f"{int(time.time())}_{suffix}_{filepath.name}"
+    try:
+        filename = filepath.relative_to(get_server_downloads_dir()).as_posix()
+    except ValueError:
+        filename = filepath.name
+    duplicate_of = None
+    if sha256:
+        duplicate_of = next(
+            (other_id for other_id, other in reversed(file_metadata.items()) if other.get("sha256") == sha256),
+            None,
+        )
     file_metadata[file_id] = {
-        "filename": filepath.name,
+        "filename": filename,
         "original_name": original_name,
         "course_name": course_name,
         "test_name": test_name,
         "timestamp": datetime.now().isoformat(),
         "size": filepath.stat().st_size if filepath.exists() else 0,
+        "sha256": sha256,
+        "duplicate_of": duplicate_of,
     }
+    publish_downloaded_file(file_id)
     return file_id
 
 
+def store_report_file(source: Path, downloads_dir: Path, extension: str, move: bool = False) -> tuple[Path, str, bool]:
+    """Store `source` under its SHA-256, hashing while it is copied (or, with `move`, renamed) in.
+
+    Returns (stored_path, sha256, duplicate); a duplicate is discarded in favour of the existing copy.
+    """
+    objects_dir = downloads_dir / REPORT_OBJECTS_DIR
+    objects_dir.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    if move:
+        staging = source
+        with open(source, "rb") as src:
+            for chunk in iter(lambda: src.read(HASH_CHUNK_BYTES), b""):
+                digest.update(chunk)
+    else:
+        staging = objects_dir / f".incoming_{uuid.uuid4().hex}"
+        with open(source, "rb") as src, open(staging, "wb") as dst:
+            for chunk in iter(lambda: src.read(HASH_CHUNK_BYTES), b""):
+                digest.update(chunk)
+                dst.write(chunk)
+    sha256 = digest.hexdigest()
+    target = objects_dir / f"{sha256}{extension}"
+    if target.exists():
+        staging.unlink(missing_ok=True)
+        return target, sha256, True
+    os.replace(staging, target)
+    return target, sha256, False
+
+
+async def store_download(download, downloads_dir: Path, extension: str) -> tuple[Path, str, bool]:
+    """Content-address a finished Playwright download without blocking the browser loop."""
+    try:
+        # The browser already wrote the file locally; read it from there
+        source = Path(await download.path())
+        move = False
+    except Exception:
+        # Remote browsers have no local path: let Playwright save it, then hash and rename in place
+        source = downloads_dir / REPORT_OBJECTS_DIR / f".incoming_{uuid.uuid4().hex}{extension}"
+        source.parent.mkdir(parents=True, exist_ok=True)
+        await download.save_as(str(source))
+        move = True
+    return await asyncio.to_thread(store_report_file, source, downloads_dir, extension, move)
+
+
+def verify_stored_file(metadata: dict) -> bool | None:
+    """Re-hash a registered file and compare with its recorded SHA-256 (None when none was recorded)."""
+    if not metadata.get("sha256"):
+        return None
+    digest = hashlib.sha256()
+    with open(SERVER_DOWNLOADS_DIR / metadata["filename"], "rb") as fh:
+        for chunk in iter(lambda: fh.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest() == metadata["sha256"]
+
+
 def find_chrome_exe() -> Optional[Path]:
     """Find Chrome executable on Windows or macOS."""
     system = platform.system()
@@ -232,250 +920,306 @@ def normalize_url(raw: str) -> Optional[str]:
     return text
 
 
-async def download_performance_participation_report(
-    page, download_dir: Path, sanitized_filename: str | None,
-    course_query: str, test_query: str
-):
-    """Download Performance and Participation Report - existing flow"""
+def _load_step_timings():
+    """Load learned step timings from disk once per process."""
+    global _step_timings_loaded
+    if _step_timings_loaded:
+        return
+    _step_timings_loaded = True
     try:
-        checkbox = page.locator(
-            "div.ui-chkbox-box.ui-widget.ui-corner-all.ui-state-default"
-        ).first
-        await checkbox.wait_for(state="visible", timeout=10000)
-        await checkbox.click()
-
-        select_all = (
-            page.locator("span.text-underline")
-            .filter(has_text="Select all")
-            .first
-        )
+        step_timings.update(json.loads(STEP_TIMINGS_FILE.read_text(encoding="utf-8")))
+    except Exception:
+        pass
+
+
+def save_step_timings():
+    """Persist the steps this process observed, keeping other workers' entries."""
+    with _step_timings_lock:
+        if not _step_timings_dirty:
+            return
         try:
-            await select_all.wait_for(state="visible", timeout=3000)
-            await select_all.click()
+            on_disk = json.loads(STEP_TIMINGS_FILE.read_text(encoding="utf-8"))
         except Exception:
-            pass
+            on_disk = {}
+        for host, step in _step_timings_dirty:
+            on_disk.setdefault(host, {})[step] = step_timings[host][step]
+        _step_timings_dirty.clear()
+        try:
+            SERVER_STATE_DIR.mkdir(exist_ok=True)
+            tmp_path = STEP_TIMINGS_FILE.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(on_disk), encoding="utf-8")
+            os.replace(tmp_path, STEP_TIMINGS_FILE)
+        except Exception as exc:
+            log.warning(f"Could not save step timings: {exc}")
 
-        action_label = (
-            page.locator("label.ui-dropdown-label")
-            .filter(has_text="Action")
-            .first
-        )
-        await action_label.wait_for(state="visible", timeout=10000)
-        dropdown_container = action_label.locator(
-            "xpath=ancestor::div[contains(@class, 'ui-dropdown')]"
-        )
-        await dropdown_container.first.click()
 
-        shareable_option = page.locator(
-            "li.ui-dropdown-item.ui-corner-all[aria-label='Generate Shareable Link']"
-        )
-        await shareable_option.first.wait_for(state="visible", timeout=5000)
-        await shareable_option.first.click()
-        await page.wait_for_timeout(90000)
-
-        completed_label = page.locator(
-            "span.ui-multiselect-label.ui-corner-all"
-        ).filter(has_text="Completed").first
-        await completed_label.wait_for(state="visible", timeout=5000)
-        await completed_label.click()
-
-        multiselect_checkbox = page.locator(
-            "div.ui-multiselect-panel div.ui-chkbox-box.ui-widget.ui-corner-all.ui-state-default"
-        ).first
-        await multiselect_checkbox.wait_for(state="visible", timeout=5000)
-        await multiselect_checkbox.click()
-
-        download_results = (
-            page.locator("span", has_text="Download results").first
-        )
-        await download_results.wait_for(state="visible", timeout=10000)
-        await download_results.scroll_into_view_if_needed()
-        await download_results.click()
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
 
-        # Select Excel option and download
-        await select_excel_and_download(page, download_dir, sanitized_filename, course_query, test_query)
-        
-        # Close dialogs after download
-        await close_download_dialogs(page)
-    except Exception as exc:  # noqa: BLE001
-        raise Exception(f"Error in Performance and Participation Report flow: {exc}")
 
+def record_step_latency(step: str, elapsed_ms: float, host: str | None = None):
+    """Record how long a step took on the current portal host."""
+    host = host if host is not None else _portal_host.get()
+    with _step_timings_lock:
+        _load_step_timings()
+        entry = step_timings.setdefault(host, {}).setdefault(step, {"samples": [], "baseline_ms": elapsed_ms})
+        entry["samples"] = (entry["samples"] + [round(elapsed_ms, 1)])[-STEP_TIMING_WINDOW:]
+        # Slow-moving baseline so "today" can be compared against the long run
+        entry["baseline_ms"] = round(entry["baseline_ms"] * 0.98 + elapsed_ms * 0.02, 1)
+        _step_timings_dirty.add((host, step))
 
-async def download_test_level_analysis_report(
-    page, download_dir: Path, sanitized_filename: str | None,
-    course_query: str, test_query: str, campus: str = "", batch: str = ""
-):
-    """Download Test Level Analysis Report - login is same, rest of flow to be implemented"""
-    try:
-        # Login flow is same as Performance and Participation Report (already completed)
-        # After login, wait for page to be ready
-        await page.wait_for_load_state("networkidle", timeout=60000)
-        await page.wait_for_timeout(10000)  # Wait 10 seconds after login for page to fully load
-        
-        # Wait for the dashboard/report section to be visible
+
+def step_timeout(step: str, default_ms: int) -> int:
+    """Timeout for `step`: p99 of observed latencies x margin, clamped to floor/ceiling."""
+    with _step_timings_lock:
+        _load_step_timings()
+        samples = step_timings.get(_portal_host.get(), {}).get(step, {}).get("samples", [])
+        if len(samples) < STEP_TIMING_MIN_SAMPLES:
+            return default_ms
+        learned = _percentile(samples, 99) * STEP_TIMEOUT_MARGIN
+    return int(min(max(learned, STEP_TIMEOUT_FLOOR_MS), STEP_TIMEOUT_CEILING_MS))
+
+
+def portal_speed_factor() -> float:
+    """How fast the current host is today relative to its long-run baseline (0.5 - 1.5)."""
+    with _step_timings_lock:
+        _load_step_timings()
+        ratios = [
+            _percentile(entry["samples"], 50) / entry["baseline_ms"]
+            for entry in step_timings.get(_portal_host.get(), {}).values()
+            if len(entry["samples"]) >= STEP_TIMING_MIN_SAMPLES and entry["baseline_ms"] > 0
+        ]
+    if not ratios:
+        return 1.0
+    return min(max(_percentile(ratios, 50), 0.5), 1.5)
+
+
+def job_checkpoint(process_id: str | None = None) -> dict:
+    """Return the checkpoint of a job (the current one by default)."""
+    process_info = active_processes.get(process_id or _current_job_id.get()) or {}
+    return process_info.get("checkpoint", {})
+
+
+def record_checkpoint(step: str, **data):
+    """Record that the current job completed `step`; only ever moves forward."""
+    process_info = active_processes.get(_current_job_id.get())
+    if process_info is None:
+        return
+    checkpoint = process_info.setdefault("checkpoint", {})
+    previous = checkpoint.get("step")
+    if previous and CHECKPOINT_STEPS.index(step) < CHECKPOINT_STEPS.index(previous):
+        return
+    checkpoint.update(data)
+    checkpoint["step"] = step
+    checkpoint["at"] = time.time()
+    log.info(f"Checkpoint reached: {step}")
+    emit_job_event("checkpoint", checkpoint=step)
+
+
+def check_cancelled():
+    """Cancellation point between steps: raise JobCancelled if the current job was cancelled."""
+    process_info = active_processes.get(_current_job_id.get())
+    if process_info and process_info.get("cancelled"):
+        raise JobCancelled()
+
+
+def note_progress(budget_s: float | None, **detail):
+    """Record what the current job is doing (step, wait, url, selector); the watchdog fails it if
+    nothing new starts within `budget_s` (None: no limit)."""
+    process_info = active_processes.get(_current_job_id.get())
+    if process_info is None:
+        return
+    now = time.time()
+    progress = process_info.setdefault("progress", {})
+    progress.update(detail, since=now, deadline=now + budget_s if budget_s is not None else None)
+
+
+def note_wait(timeout_ms: float, **detail):
+    """Renew the watchdog budget before one of several waits inside a single step action.
+
+    A step's budget covers one wait; an action that waits several times (or once per grid page)
+    calls this before each wait, so a slow but progressing action is not taken for a hung one.
+    """
+    note_progress(timeout_ms / 1000 + STEP_DEADLINE_GRACE_S, **detail)
+
+
+def note_selector(locator):
+    """Remember the element the current job is waiting for, for the watchdog's diagnostics."""
+    process_info = active_processes.get(_current_job_id.get())
+    if process_info is not None:
+        match = re.search(r"selector='(.*)'>$", repr(locator))
+        process_info.setdefault("progress", {})["selector"] = match.group(1) if match else repr(locator)
+
+
+def job_deadline_s(params: dict) -> float:
+    """Deadline for a whole job: JOB_DEADLINE_S plus JOB_DEADLINE_PER_ITEM_S per report or course it covers."""
+    if params.get("crawl_catalog"):
+        return JOB_DEADLINE_S + JOB_DEADLINE_PER_ITEM_S * CATALOG_MAX_COURSES_PER_RUN
+    return JOB_DEADLINE_S + JOB_DEADLINE_PER_ITEM_S * len(params.get("items") or ())
+
+
+def check_job_deadlines(now: float | None = None) -> list[str]:
+    """Expire the jobs of this process that ran past a step deadline or their job deadline."""
+    now = now or time.time()
+    expired = []
+    for job_id, process_info in list(active_processes.items()):
+        if process_info.get("cancelled") or process_info.get("deadline_exceeded"):
+            continue
+        progress = process_info.get("progress") or {}
+        deadline_s = process_info.get("deadline_s", JOB_DEADLINE_S)
+        if progress.get("deadline") and now > progress["deadline"]:
+            reason = f"no progress for {now - progress['since']:.0f} s"
+        elif now - process_info.get("started_at", now) > deadline_s:
+            reason = f"job ran over its {deadline_s:.0f} s deadline"
+        else:
+            continue
+        expire_job(job_id, process_info, reason)
+        expired.append(job_id)
+    return expired
+
+
+def expire_job(job_id: str, process_info: dict, reason: str):
+    """Fail a hung job with diagnostics and free its slot at once; its page is stopped in the background."""
+    progress = process_info.get("progress") or {}
+    url = progress.get("url", "")
+    with contextlib.suppress(Exception):
+        # Page URLs are cached on the Python side, so this does not need the (possibly stuck) loop
+        url = next((page.url for page in process_info["context"].pages), url)
+    diagnostics = {
+        "reason": reason,
+        "step": progress.get("step", ""),
+        "wait": progress.get("wait", ""),
+        "url": url,
+        "selector": progress.get("selector", ""),
+        "elapsed_s": round(time.time() - process_info.get("started_at", time.time())),
+    }
+    message = f"Stopped by the watchdog: {reason} in step '{diagnostics['step'] or diagnostics['wait'] or 'start'}'"
+    if diagnostics["selector"]:
+        message += f" waiting for {diagnostics['selector']}"
+    if url:
+        message += f" on {url}"
+    process_info["deadline_exceeded"] = message
+    process_info["result"] = (False, message)
+    log.error(f"Job {job_id}: {message}")
+    emit_job_event("deadline_exceeded", job_id, **diagnostics)
+    finish_job(job_id, (False, message), process_info.get("checkpoint"))
+    _dispatch_wakeup.set()  # the slot is free now, whatever the browser does next
+    threading.Thread(target=_stop_hung_job, args=(process_info,), daemon=True).start()
+
+
+def _stop_hung_job(process_info: dict):
+    """Cancel the job and close its context; kill its browser if that does not finish in time."""
+    loop = process_info.get("loop")
+    if loop is not None and loop.is_running():
+        future = asyncio.run_coroutine_threadsafe(_abort_job(process_info), loop)
         try:
-            await page.wait_for_selector("app-dashboard", state="visible", timeout=30000)
-            await page.wait_for_timeout(2000)
+            future.result(timeout=WATCHDOG_KILL_AFTER_S)
+            return
         except Exception:
             pass
-        
-        # Step 1: Click on "Report Type" dropdown - using aria-label attribute
-        report_type_dropdown_clicked = False
-        
-        # Wait for form-fields container first
+    if process_info.get("browser"):
+        browser_supervisor.kill(process_info["browser"])
+
+
+def _watchdog_loop():
+    while True:
+        time.sleep(WATCHDOG_INTERVAL_S)
+        try:
+            check_job_deadlines()
+        except Exception as exc:  # noqa: BLE001
+            log.error(f"Watchdog tick failed: {exc}")
+
+
+def _ensure_watchdog():
+    global _watchdog_thread
+    if _watchdog_thread is None:
+        _watchdog_thread = threading.Thread(target=_watchdog_loop, name="job-watchdog", daemon=True)
+        _watchdog_thread.start()
+
+
+async def _abort_job(process_info: dict):
+    """Runs on the job's own event loop: interrupt its task and close its browser context."""
+    task = process_info.get("task")
+    if task and not task.done():
+        task.cancel()
+    context = process_info.get("context")
+    if context:
         try:
-            await page.wait_for_selector("div.form-fields", state="visible", timeout=30000)
-            await page.wait_for_timeout(2000)
+            await context.close()
         except Exception:
             pass
-        
-        # Primary: Find and click the label with aria-label="Report Type"
+
+
+def cancel_job(process_id: str, wait_s: float = 1.0) -> bool:
+    """Cancel one job and shut its browser down on the loop that owns it."""
+    process_info = active_processes.get(process_id)
+    if process_info is None:
+        return False
+    process_info["cancelled"] = True
+    loop = process_info.get("loop")
+    if loop is not None and loop.is_running():
+        future = asyncio.run_coroutine_threadsafe(_abort_job(process_info), loop)
         try:
-            report_type_label = page.locator('label[aria-label="Report Type"]')
-            await report_type_label.wait_for(state="visible", timeout=30000)
-            await report_type_label.click()
-            report_type_dropdown_clicked = True
-            await page.wait_for_timeout(2000)
+            future.result(timeout=wait_s)
         except Exception:
+            # Still shutting down; the job's own cancellation checks will finish the job
             pass
-        
-        # Fallback 1: Try clicking the dropdown by id
-        if not report_type_dropdown_clicked:
-            try:
-                dropdown = page.locator('p-dropdown#reportdropdown')
-                await dropdown.wait_for(state="visible", timeout=10000)
-                await dropdown.click()
-                report_type_dropdown_clicked = True
-                await page.wait_for_timeout(2000)
-            except Exception:
-                pass
-        
-        # Fallback 2: Click the label inside the dropdown
-        if not report_type_dropdown_clicked:
-            try:
-                dropdown_label = page.locator('p-dropdown#reportdropdown label.ui-dropdown-label')
-                await dropdown_label.wait_for(state="visible", timeout=10000)
-                await dropdown_label.click()
-                report_type_dropdown_clicked = True
-                await page.wait_for_timeout(2000)
-            except Exception:
-                pass
-        
-        # Fallback 3: Click the dropdown trigger
-        if not report_type_dropdown_clicked:
-            try:
-                dropdown_trigger = page.locator('p-dropdown#reportdropdown .ui-dropdown-trigger')
-                await dropdown_trigger.wait_for(state="visible", timeout=10000)
-                await dropdown_trigger.click()
-                report_type_dropdown_clicked = True
-                await page.wait_for_timeout(2000)
-            except Exception:
-                pass
-        
-        if not report_type_dropdown_clicked:
-            raise Exception("Could not find or click Report Type dropdown")
-        
-        # Step 2: Select "Test Level Analysis" from the dropdown - EXACT same method as Performance report
-        test_analysis_selected = False
-        
-        # Wait for dropdown panel to appear
-        await page.wait_for_timeout(2000)
-        
-        # Primary: Try to find "Test Level Analysis" option - same pattern as Performance report
+    return True
+
+
+async def adaptive_wait(step: str, default_ms: int, wait):
+    """Run `wait(timeout_ms)` with the learned timeout for `step` and record its latency."""
+    check_cancelled()
+    timeout = step_timeout(step, default_ms)
+    note_progress(timeout / 1000 + STEP_DEADLINE_GRACE_S, wait=step)
+    start = time.monotonic()
+    try:
+        result = await wait(timeout)
+    except Exception as exc:
+        if "Timeout" in type(exc).__name__:
+            # Widen a learned timeout that turned out too tight, but never past the default
+            record_step_latency(step, min(timeout * STEP_TIMEOUT_MARGIN, default_ms))
+        raise
+    record_step_latency(step, (time.monotonic() - start) * 1000)
+    return result
+
+
+async def settle(page, step: str, default_ms: int):
+    """Fixed settle delay after `step`, scaled by how fast the portal is today."""
+    check_cancelled()
+    delay_ms = int(default_ms * portal_speed_factor())
+    note_progress(delay_ms / 1000 + STEP_DEADLINE_GRACE_S, wait=step)
+    await page.wait_for_timeout(delay_ms)
+
+
+async def close_download_dialogs(page):
+    """Close download dialogs after file is downloaded"""
+    await settle(page, "download_settle", 10000)  # Wait 10 seconds after download completes
+    
+    async def click_close_button():
+        close_clicked = False
         try:
-            test_analysis_option = page.locator('li.ui-dropdown-item').filter(has_text=re.compile("Test Level Analysis", re.IGNORECASE)).first
-            await test_analysis_option.wait_for(state="visible", timeout=10000)
-            await test_analysis_option.click()
-            test_analysis_selected = True
-            await page.wait_for_timeout(2000)
+            close_span = page.locator("a.ui-dialog-titlebar-close span.pi.pi-times, a[class*='ui-dialog-titlebar-close'] span.pi.pi-times").first
+            await adaptive_wait("dialog_close", 10000, lambda t: close_span.wait_for(state="visible", timeout=t))
+            await close_span.scroll_into_view_if_needed()
+            await settle(page, "dialog_scroll", 500)
+            await close_span.click(force=True)
+            close_clicked = True
         except Exception:
-            pass
-        
-        # Fallback 1: Try finding by text "Test Level"
-        if not test_analysis_selected:
             try:
-                test_analysis_option = page.locator('li.ui-dropdown-item').filter(has_text=re.compile("Test Level", re.IGNORECASE)).first
-                await test_analysis_option.wait_for(state="visible", timeout=10000)
-                await test_analysis_option.click()
-                test_analysis_selected = True
-                await page.wait_for_timeout(2000)
-            except Exception:
-                pass
-        
-        # Fallback 2: Try finding any option with "Analysis" in text
-        if not test_analysis_selected:
-            try:
-                analysis_option = page.locator('li.ui-dropdown-item').filter(has_text=re.compile("Analysis", re.IGNORECASE)).first
-                await analysis_option.wait_for(state="visible", timeout=10000)
-                await analysis_option.click()
-                test_analysis_selected = True
-                await page.wait_for_timeout(2000)
-            except Exception:
-                pass
-        
-        # Fallback 3: Get all options and check text content - same pattern as Performance report
-        if not test_analysis_selected:
-            try:
-                all_options = page.locator('li.ui-dropdown-item')
-                option_count = await all_options.count()
-                for i in range(option_count):
-                    option = all_options.nth(i)
-                    option_text = await option.text_content()
-                    if option_text:
-                        text_lower = option_text.lower().strip()
-                        if ("test level analysis" in text_lower or 
-                            "testlevel analysis" in text_lower or
-                            ("test" in text_lower and "level" in text_lower and "analysis" in text_lower)):
-                            await option.click()
-                            test_analysis_selected = True
-                            await page.wait_for_timeout(2000)
-                            break
-            except Exception:
-                pass
-        
-        if not test_analysis_selected:
-            raise Exception("Could not find or select 'Test Level Analysis' from dropdown")
-        
-        # Wait for the form fields to appear after selecting report type
-        await page.wait_for_load_state("networkidle", timeout=10000)
-        await page.wait_for_timeout(2000)
-        
-        # TODO: Next steps to be implemented:
-        # Step 3: Select Campus (dropdown/input field)
-        # Step 4: Select Batch (dropdown/input field)
-        # Step 5: Select Course name
-        # Step 6: Select Test name
-        # Step 7: Generate/download the report
-        
-        return True
-    except Exception as exc:  # noqa: BLE001
-        raise Exception(f"Error in Test Level Analysis Report flow: {exc}")
-
-
-async def close_download_dialogs(page):
-    """Close download dialogs after file is downloaded"""
-    await page.wait_for_timeout(10000)  # Wait 10 seconds after download completes
-    
-    async def click_close_button():
-        close_clicked = False
-        try:
-            close_span = page.locator("a.ui-dialog-titlebar-close span.pi.pi-times, a[class*='ui-dialog-titlebar-close'] span.pi.pi-times").first
-            await close_span.wait_for(state="visible", timeout=10000)
-            await close_span.scroll_into_view_if_needed()
-            await page.wait_for_timeout(500)
-            await close_span.click(force=True)
-            close_clicked = True
-        except Exception:
-            try:
-                close_span = page.locator("div.ui-dialog-titlebar span.pi.pi-times").first
-                await close_span.wait_for(state="visible", timeout=5000)
-                await close_span.scroll_into_view_if_needed()
-                await close_span.click(force=True)
-                close_clicked = True
+                close_span = page.locator("div.ui-dialog-titlebar span.pi.pi-times").first
+                await adaptive_wait("dialog_close_fallback", 5000, lambda t: close_span.wait_for(state="visible", timeout=t))
+                await close_span.scroll_into_view_if_needed()
+                await close_span.click(force=True)
+                close_clicked = True
             except Exception:
                 try:
                     close_span = page.locator("span.pi.pi-times").first
-                    await close_span.wait_for(state="visible", timeout=5000)
+                    await adaptive_wait("dialog_close_fallback", 5000, lambda t: close_span.wait_for(state="visible", timeout=t))
                     await close_span.scroll_into_view_if_needed()
                     await close_span.click(force=True)
                     close_clicked = True
@@ -514,872 +1258,3331 @@ async def close_download_dialogs(page):
     # Click close button twice to close both dialogs
     try:
         first_click = await click_close_button()
-        await page.wait_for_timeout(2000)
+        await settle(page, "dialog_between_closes", 2000)
         second_click = await click_close_button()
     except Exception:
         pass
 
 
-async def select_excel_and_download(
-    page, download_dir: Path, sanitized_filename: str | None,
-    course_query: str, test_query: str
-):
-    """Common function to select Excel format and download the file"""
-    print("INFO: Selecting Excel format and initiating download...")
-    # Select Excel option instead of CSV
-    excel_option_clicked = False
-    try:
-        # Try to find by label text "Excel (.xlsx)"
-        excel_label = page.locator("label", has_text="Excel (.xlsx)").first
-        await excel_label.wait_for(state="visible", timeout=5000)
-        await excel_label.click()
-        excel_option_clicked = True
-    except Exception:
+@dataclass(frozen=True)
+class Step:
+    """One step of a declarative report flow, run by run_flow().
+
+    `actions` are alternatives tried in order, each called as action(page, ctx, timeout_ms);
+    the first one that succeeds wins and its result is stored in ctx under the step name.
+    """
+    name: str  # also the key for learned timeouts; alternatives after the first use "<name>_fallback"
+    actions: tuple
+    timeout_ms: int = 10000
+    fallback_timeout_ms: int | None = None
+    retries: int = 0  # extra rounds over all alternatives
+    optional: bool = False  # a failed optional step is skipped instead of failing the flow
+    when: Callable[[dict], bool] | None = None  # run only if this returns True
+    after: tuple[str, ...] | None = None  # dependencies; None means the previous step in the flow
+    pause_ms: int = 0  # fixed wait after success (the portal gives no completion signal)
+    settle: tuple[str, int] | None = None  # adaptive settle after success: (key, default_ms)
+    checkpoint: str | None = None  # checkpoint recorded after success
+    slot: str | None = None  # portal budget ("login"/"export") taken before the step; not timed
+    error: str | None = None  # failure message, formatted with ctx
+
+
+async def run_flow(page, flow: tuple[Step, ...], ctx: dict, record_checkpoints: bool = True) -> dict:
+    """Run a step graph; steps whose dependencies are all done run concurrently.
+
+    Per-step durations are collected in ctx["step_ms"]. Raises when a required step fails.
+    """
+    deps: dict[str, set[str]] = {}
+    previous = None
+    for step in flow:
+        deps[step.name] = set(step.after) if step.after is not None else ({previous} if previous else set())
+        previous = step.name
+    pending = {step.name: step for step in flow}
+    done: set[str] = set()
+    while pending:
+        ready = [step for name, step in pending.items() if deps[name] <= done]
+        if not ready:
+            raise RuntimeError(f"Report flow has unsatisfiable dependencies: {sorted(pending)}")
+        for step in ready:
+            del pending[step.name]
+        results = await asyncio.gather(
+            *(_run_step(page, step, ctx, record_checkpoints) for step in ready), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        done.update(step.name for step in ready)
+        if low_memory_mode():
+            await close_extra_pages(page)
+    return ctx
+
+
+async def close_extra_pages(page):
+    """Close pages other than `page` in its context (popups the flows never use)."""
+    context = getattr(page, "context", None)
+    for other in list(getattr(context, "pages", None) or ()):
+        if other is not page:
+            with contextlib.suppress(Exception):
+                await other.close()
+
+
+async def _run_step(page, step: Step, ctx: dict, record_checkpoints: bool):
+    if step.when is not None and not step.when(ctx):
+        return
+    if step.slot:
+        await acquire_portal_slot(step.slot)
+    _current_step.set(step.name)  # each step runs in its own task, so this stays local to it
+    note_progress(STEP_DEADLINE_GRACE_S, step=step.name, wait="", selector="", url=getattr(page, "url", ""))
+    emit_job_event("step_started", step=step.name)
+    started = time.monotonic()
+    last_exc: Exception | None = None
+    succeeded = False
+    result = None
+    for _ in range(step.retries + 1):
+        for index, action in enumerate(step.actions):
+            key = step.name if index == 0 else f"{step.name}_fallback"
+            default_ms = step.timeout_ms if index == 0 else (step.fallback_timeout_ms or step.timeout_ms)
+            try:
+                result = await adaptive_wait(key, default_ms, lambda t, action=action: action(page, ctx, t))
+                succeeded = True
+                if index:
+                    emit_job_event("fallback_used", step=step.name, alternative=index)
+                break
+            except Exception as exc:  # noqa: BLE001
+                last_exc = exc
+        if succeeded:
+            break
+    elapsed_ms = ctx.setdefault("step_ms", {})[step.name] = round((time.monotonic() - started) * 1000)
+    emit_job_event(
+        "step_finished", step=step.name, ms=elapsed_ms, ok=succeeded,
+        **({} if succeeded else {"error": str(last_exc)[:200], "optional": step.optional}),
+    )
+    if not succeeded:
+        if step.optional:
+            return
+        raise Exception(step.error.format_map(ctx) if step.error else f"Step '{step.name}' failed: {last_exc}")
+
+    ctx[step.name] = True if result is None else result
+    if step.pause_ms and HAR_MODE != "replay":
+        # Fixed waits for the portal's server-side work; a replayed portal has none to do
+        check_cancelled()
+        note_progress(step.pause_ms / 1000 + STEP_DEADLINE_GRACE_S, wait=f"{step.name}_pause")
+        await page.wait_for_timeout(step.pause_ms)
+    if step.settle:
+        await settle(page, *step.settle)
+    if step.checkpoint and record_checkpoints:
+        record_checkpoint(step.checkpoint, **(result if isinstance(result, dict) else {}))
+
+
+def report_flow_context(
+    host: str, download_dir: Path, course: str | None, module: str | None, test: str | None,
+    filename_choice: str = "test", course_url: str | None = None, **extra,
+) -> dict:
+    """Inputs shared by the report flows' steps."""
+    return {
+        "host": host,
+        "download_dir": download_dir,
+        "course": (course or "").strip(),
+        "module": (module or "").strip(),
+        "test": (test or "").strip(),
+        "filename_choice": filename_choice,
+        "course_url": course_url,
+        **extra,
+    }
+
+
+def _click(locate: Callable, scroll: bool = False, force: bool = False):
+    """Step action: wait for the located element, then click it."""
+    async def action(page, ctx, timeout_ms):
+        target = locate(page)
+        note_selector(target)
+        await target.wait_for(state="visible", timeout=timeout_ms)
+        note_wait(timeout_ms, wait="click")
+        if scroll:
+            await target.scroll_into_view_if_needed()
+        await target.click(force=force)
+    return action
+
+
+def _visible(selector: str):
+    """Step action: wait until `selector` is visible."""
+    async def action(page, ctx, timeout_ms):
+        note_progress(timeout_ms / 1000 + STEP_DEADLINE_GRACE_S, selector=selector)
+        await page.wait_for_selector(selector, state="visible", timeout=timeout_ms)
+    return action
+
+
+async def _network_idle(page, ctx, timeout_ms):
+    await page.wait_for_load_state("networkidle", timeout=timeout_ms)
+
+
+async def _report_filename(page, ctx, timeout_ms):
+    """Download name chosen on the form (course or test name), sanitized; empty keeps the portal's name."""
+    source = (ctx.get("course_name") or ctx["course"]) if ctx["filename_choice"] == "course" else ctx["test"]
+    if not source:
+        return ""
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", source.strip()).strip("_") or "report"
+
+
+async def _select_module(page, ctx, timeout_ms):
+    target_module = " ".join(ctx["module"].split())
+    log.info(f"Selecting module: {target_module}")
+    module_entries = page.locator("div.ui-g-3.sidedivpre span.modulelist")
+    matching_module = module_entries.filter(has_text=re.compile(re.escape(target_module), flags=re.IGNORECASE)).first
+    await matching_module.click(timeout=timeout_ms)
+    return " ".join((await matching_module.inner_text()).split())
+
+
+async def _index_module(page, ctx, timeout_ms):
+    """Keep the catalog and deep links for the selected module current while we're on it."""
+    host, course = ctx["host"], ctx["course"]
+    if await asyncio.to_thread(catalog_canonical, host, "course", course):
+        tests = await read_module_tests(page)
+        await asyncio.to_thread(catalog_store_module, host, course, ctx["select_module"], tests)
+    if ctx.get("course_url") and page.url != ctx["course_url"]:
+        # The module has its own address; remember it for the next job
+        await asyncio.to_thread(remember_deep_link, host, course, page.url, module=ctx["module"])
+
+
+async def _open_test(page, ctx, timeout_ms):
+    target_test = " ".join(ctx["test"].split())
+    log.info(f"Selecting test: {target_test}")
+    main_container = page.locator("div.ui-g-9.maindivpre")
+    note_selector(main_container)
+    await main_container.wait_for(state="visible", timeout=timeout_ms)
+    pattern = re.compile(re.escape(target_test), flags=re.IGNORECASE)
+    card = main_container.locator("div.ui-g-12.moduletest").filter(has_text=pattern).first
+    note_wait(timeout_ms, wait="test_card")
+    note_selector(card)
+    await card.wait_for(state="visible", timeout=timeout_ms)
+    await card.scroll_into_view_if_needed()
+    completed_counter = card.locator("div.confirmModal.st-count span.meta-data.ui-g-12.ui-g-nopad").first
+    note_wait(timeout_ms, wait="completed_counter")
+    note_selector(completed_counter)
+    await completed_counter.wait_for(state="visible", timeout=timeout_ms)
+    note_wait(timeout_ms, wait="click")
+    await completed_counter.click()
+
+
+async def _open_action_dropdown(page, ctx, timeout_ms):
+    action_label = page.locator("label.ui-dropdown-label").filter(has_text="Action").first
+    await action_label.wait_for(state="visible", timeout=timeout_ms)
+    note_wait(timeout_ms, wait="click")
+    await action_label.locator("xpath=ancestor::div[contains(@class, 'ui-dropdown')]").first.click()
+
+
+async def _download_report(page, ctx, timeout_ms):
+    """Click the download button, save the file under server_downloads and register it."""
+    log.info("Starting report download...")
+    download_button = page.locator("button.download-button").first
+    await download_button.wait_for(state="visible", timeout=timeout_ms)
+    note_wait(timeout_ms, wait="download_start")
+    async with page.expect_download() as download_info:
+        await download_button.click()
+    download = await download_info.value
+    note_wait(timeout_ms, wait="download_store")
+    suggested_name = download.suggested_filename
+    extension = Path(suggested_name).suffix or ".xlsx"
+    sanitized_filename = ctx.get("report_filename")
+    # Use sanitized filename (based on user's choice) as the download name
+    download_filename = f"{sanitized_filename}{extension}" if sanitized_filename else suggested_name
+    # Stored once per distinct content; repeat downloads of an unchanged report only add metadata
+    target_path, sha256, duplicate = await store_download(download, ctx["download_dir"], extension)
+    if extension == ".xlsx":
+        # The export's header row is what grid mode reproduces
+        try:
+            remember_report_columns(ctx["host"], await asyncio.to_thread(_xlsx_header, target_path))
+        except Exception as exc:  # noqa: BLE001
+            log.debug(f"Could not read the export's columns: {exc}")
+    return _register_report(ctx, target_path, download_filename, sha256, duplicate)
+
+
+def _register_report(ctx: dict, target_path: Path, download_filename: str, sha256: str, duplicate: bool, **event) -> dict:
+    log.info(
+        f"File downloaded successfully: {download_filename} (sha256 {sha256[:12]}"
+        f"{', unchanged since the last download' if duplicate else ''})"
+    )
+    file_id = register_downloaded_file(
+        target_path, download_filename, ctx.get("course_name") or ctx["course"], ctx["test"], sha256=sha256
+    )
+    emit_job_event(
+        "downloaded", file_id=file_id, filename=download_filename,
+        bytes=Path(target_path).stat().st_size, unchanged=duplicate, **event,
+    )
+    return {"file_id": file_id}
+
+
+def _grid_rows(payload) -> list[dict] | None:
+    """The largest list of objects in a JSON payload (the grid's rows), searched a few levels deep."""
+    best = None
+    stack = [(payload, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if isinstance(node, list):
+            if node and all(isinstance(item, dict) for item in node) and (best is None or len(node) > len(best)):
+                best = node
+        elif isinstance(node, dict) and depth < 3:
+            stack.extend((value, depth + 1) for value in node.values())
+    return best
+
+
+async def _read_grid_response(response, pages: dict):
+    if "json" not in (response.headers.get("content-type") or ""):
+        return
+    try:
+        rows = _grid_rows(await response.json())
+    except Exception:
+        return
+    if rows:
+        request = response.request
+        # A page fetched again (e.g. after a re-sort) replaces its earlier copy
+        pages[f"{request.method} {response.url} {request.post_data or ''}"] = (urlparse(response.url).path, rows)
+
+
+async def _capture_grid(page, ctx, timeout_ms):
+    """Start collecting the grid's JSON responses; armed before the Completed filter reloads the grid."""
+    state = {"pages": {}, "tasks": []}
+
+    def on_response(response):
+        if response.request.resource_type in ("xhr", "fetch") and GRID_RESPONSE_PATTERN.search(response.url):
+            state["tasks"].append(asyncio.ensure_future(_read_grid_response(response, state["pages"])))
+
+    state["listener"] = on_response
+    page.on("response", on_response)
+    return state
+
+
+async def _grid_responses_after(state: dict, seen: int, timeout_ms: int):
+    """Wait until more than `seen` grid pages have been captured."""
+    deadline = time.monotonic() + timeout_ms / 1000
+    while True:
+        await asyncio.gather(*state["tasks"], return_exceptions=True)
+        if len(state["pages"]) > seen:
+            return
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"No grid data within {timeout_ms} ms")
+        await asyncio.sleep(0.1)
+
+
+async def _walk_grid_pages(page, ctx, timeout_ms):
+    """Wait for the filtered grid's data, then click through its paginator; returns the pages captured."""
+    state = ctx["grid_capture"]
+    try:
+        await _grid_responses_after(state, 0, timeout_ms)
+        next_button = page.locator("a.ui-paginator-next").first
+        for number in range(2, GRID_MAX_PAGES + 2):
+            # Each page gets its own watchdog budget; the step's covers only the first
+            note_wait(timeout_ms, wait=f"grid_page_{number}")
+            if not await next_button.is_visible() or "ui-state-disabled" in (await next_button.get_attribute("class") or ""):
+                break
+            seen = len(state["pages"])
+            await next_button.click()
+            await _grid_responses_after(state, seen, timeout_ms)
+    finally:
+        release_grid_capture(page, ctx)
+    return len(state["pages"])
+
+
+def release_grid_capture(page, ctx: dict):
+    """Detach the grid response listener, if one is attached; safe to call more than once.
+
+    Called after a flow too: if a step between grid_capture and grid_pages fails, the listener
+    would otherwise stay on the page and keep reading responses for later batch items.
+    """
+    state = ctx.get("grid_capture")
+    if state and state.get("listener") is not None:
+        page.remove_listener("response", state["listener"])
+        state["listener"] = None
+
+
+def captured_grid_rows(pages: dict) -> list[dict]:
+    """Rows of the endpoint that returned the most, in page order, without repeats."""
+    families: dict[str, list[dict]] = {}
+    for path, rows in pages.values():
+        families.setdefault(path, []).extend(rows)
+    rows = max(families.values(), key=len, default=[])
+    seen: set[str] = set()
+    unique = []
+    for row in rows:
+        key = json.dumps(row, sort_keys=True, default=str)
+        if key not in seen:
+            seen.add(key)
+            unique.append(row)
+    return unique
+
+
+def _grid_key(name: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", str(name).casefold())
+
+
+def grid_row_values(row: dict, columns: list[str]) -> list:
+    """One grid row as the export's cells: each column matched by normalized key name, then by alias."""
+    flat: dict[str, object] = {}
+
+    def walk(node: dict, prefix: str):
+        for key, value in node.items():
+            if isinstance(value, dict):
+                walk(value, f"{prefix}{key}")
+            else:
+                flat.setdefault(_grid_key(key), value)
+                flat.setdefault(_grid_key(f"{prefix}{key}"), value)  # e.g. user.email -> "useremail"
+
+    walk(row, "")
+    values = []
+    for column in columns:
+        key = _grid_key(column)
+        value = next((flat[k] for k in (key, *GRID_COLUMN_ALIASES.get(key, ())) if k in flat), "")
+        if isinstance(value, list):
+            value = ", ".join(str(item) for item in value)
+        values.append("" if value is None else value)
+    return values
+
+
+def _xlsx_header(path: Path) -> list[str]:
+    with open(path, "rb") as fh:
+        return next(_iter_xlsx_rows(fh), [])
+
+
+def _column_letter(index: int) -> str:
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+_XLSX_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Report" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>'
+    ),
+}
+_XML_ILLEGAL = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _xlsx_row(number: int, values: list) -> str:
+    cells = []
+    for index, value in enumerate(values):
+        ref = f"{_column_letter(index)}{number}"
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c r="{ref}"><v>{value}</v></c>')
+        elif value != "":
+            text = xml_escape(_XML_ILLEGAL.sub("", str(value)))
+            cells.append(f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return f'<row r="{number}">{"".join(cells)}</row>'
+
+
+def write_report_rows(path: Path, header: list[str], rows) -> int:
+    """Stream `rows` under `header` to a CSV or one-sheet xlsx file (by suffix); returns the row count.
+
+    Rows are written as they are produced, so a large grid is never held as a workbook in memory.
+    """
+    count = 0
+    if path.suffix == ".csv":
+        with open(path, "w", encoding="utf-8-sig", newline="") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(header)
+            for values in rows:
+                writer.writerow(values)
+                count += 1
+        return count
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as book:
+        for name, xml in _XLSX_PARTS.items():
+            book.writestr(zipfile.ZipInfo(name, _ZIP_EPOCH), xml, zipfile.ZIP_DEFLATED)
+        sheet = zipfile.ZipInfo("xl/worksheets/sheet1.xml", _ZIP_EPOCH)
+        sheet.compress_type = zipfile.ZIP_DEFLATED
+        with book.open(sheet, "w", force_zip64=True) as fh:
+            fh.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            fh.write(_xlsx_row(1, header).encode("utf-8"))
+            for values in rows:
+                count += 1
+                fh.write(_xlsx_row(count + 1, values).encode("utf-8"))
+            fh.write(b"</sheetData></worksheet>")
+    return count
+
+
+async def _write_grid_report(page, ctx, timeout_ms):
+    """Write the captured grid rows in the export's columns and register the file like a download."""
+    rows = captured_grid_rows(ctx["grid_capture"]["pages"])
+    if not rows:
+        raise Exception("The grid returned no rows")
+    columns = report_columns(ctx["host"])
+    extension = ".csv" if REPORT_GRID_FORMAT == "csv" else ".xlsx"
+    staging = ctx["download_dir"] / REPORT_OBJECTS_DIR / f".incoming_{uuid.uuid4().hex}{extension}"
+    staging.parent.mkdir(parents=True, exist_ok=True)
+    await asyncio.to_thread(write_report_rows, staging, columns, (grid_row_values(row, columns) for row in rows))
+    target_path, sha256, duplicate = await asyncio.to_thread(
+        store_report_file, staging, ctx["download_dir"], extension, True
+    )
+    download_filename = f"{ctx.get('report_filename') or 'report'}{extension}"
+    return _register_report(ctx, target_path, download_filename, sha256, duplicate, source="grid", rows=len(rows))
+
+
+async def _close_dialogs(page, ctx, timeout_ms):
+    await close_download_dialogs(page)
+
+
+async def _select_test_level_analysis(page, ctx, timeout_ms):
+    """Last resort: scan every dropdown option for the Test Level Analysis label."""
+    all_options = page.locator("li.ui-dropdown-item")
+    for i in range(await all_options.count()):
+        note_wait(timeout_ms, wait="tla_option_scan")
+        option = all_options.nth(i)
+        text_lower = ((await option.text_content()) or "").lower().strip()
+        if ("test level analysis" in text_lower or "testlevel analysis" in text_lower
+                or ("test" in text_lower and "level" in text_lower and "analysis" in text_lower)):
+            await option.click()
+            return
+    raise Exception("No Test Level Analysis option")
+
+
+def _test_opened(ctx: dict) -> bool:
+    return bool(ctx.get("open_test"))
+
+
+def _export_needed(ctx: dict) -> bool:
+    """Grid flow: the export steps run only when the grid produced no report."""
+    return _test_opened(ctx) and not ctx.get("grid_download")
+
+
+def report_file_id(ctx: dict) -> str | None:
+    """File id of the report a performance flow produced, from the export or the grid."""
+    return (ctx.get("download") or ctx.get("grid_download") or {}).get("file_id")
+
+
+# Performance and Participation Report, from the course page to the downloaded file
+PERFORMANCE_REPORT_FLOW: tuple[Step, ...] = (
+    Step("report_filename", (_report_filename,), after=()),
+    Step("select_module", (_select_module,), 30000, optional=True, after=(),
+         when=lambda ctx: bool(ctx["module"]), settle=("module_render", 10000), checkpoint="module_selected"),
+    Step("index_module", (_index_module,), optional=True, when=lambda ctx: bool(ctx.get("select_module"))),
+    Step("open_test", (_open_test,), 5000, when=lambda ctx: bool(ctx["test"]),
+         checkpoint="test_opened", error="Could not open test '{test}'"),
+    Step("test_open", (_network_idle,), 2000, optional=True, when=_test_opened),
+    Step("report_checkbox", (_click(lambda page: page.locator(
+        "div.ui-chkbox-box.ui-widget.ui-corner-all.ui-state-default").first),), 10000, when=_test_opened),
+    Step("select_all", (_click(lambda page: page.locator("span.text-underline").filter(has_text="Select all").first),),
+         3000, optional=True, when=_test_opened),
+    Step("action_dropdown", (_open_action_dropdown,), 10000, when=_test_opened),
+    # The link is generated server-side with no progress indicator, so this wait stays fixed
+    Step("shareable_option", (_click(lambda page: page.locator(
+        "li.ui-dropdown-item.ui-corner-all[aria-label='Generate Shareable Link']").first),),
+         5000, when=_test_opened, pause_ms=90000, checkpoint="shareable_link"),
+    Step("completed_filter", (_click(lambda page: page.locator(
+        "span.ui-multiselect-label.ui-corner-all").filter(has_text="Completed").first),), 5000, when=_test_opened),
+    Step("completed_checkbox", (_click(lambda page: page.locator(
+        "div.ui-multiselect-panel div.ui-chkbox-box.ui-widget.ui-corner-all.ui-state-default").first),),
+         5000, when=_test_opened),
+    Step("download_results", (_click(lambda page: page.locator("span", has_text="Download results").first, scroll=True),),
+         10000, when=_test_opened, slot="export"),
+    Step("excel_option", (
+        _click(lambda page: page.locator("label", has_text="Excel (.xlsx)").first),
+        _click(lambda page: page.locator('input[type="radio"][name="downloadFileType"][value="excel"]')),
+        _click(lambda page: page.locator('p-radiobutton[label="Excel (.xlsx)"]').first),
+        _click(lambda page: page.locator('p-radiobutton:has(label:has-text("Excel")) span.ui-radiobutton-icon').first),
+    ), 5000, when=_test_opened),
+    Step("download", (_download_report,), 5000, retries=1, after=("excel_option", "report_filename"),
+         when=_test_opened, checkpoint="report_downloaded"),
+    Step("close_dialogs", (_close_dialogs,), optional=True, when=_test_opened),
+)
+
+# Test Level Analysis Report, straight after login (campus/batch/course/test selection not implemented yet)
+TEST_LEVEL_ANALYSIS_FLOW: tuple[Step, ...] = (
+    Step("post_login", (_network_idle,), 60000, settle=("tla_post_login", 10000)),
+    Step("tla_dashboard", (_visible("app-dashboard"),), 30000, optional=True, settle=("tla_dashboard_render", 2000)),
+    Step("tla_form_fields", (_visible("div.form-fields"),), 30000, optional=True, settle=("tla_form_render", 2000)),
+    Step("tla_report_type", (
+        _click(lambda page: page.locator('label[aria-label="Report Type"]')),
+        _click(lambda page: page.locator("p-dropdown#reportdropdown")),
+        _click(lambda page: page.locator("p-dropdown#reportdropdown label.ui-dropdown-label")),
+        _click(lambda page: page.locator("p-dropdown#reportdropdown .ui-dropdown-trigger")),
+    ), 30000, fallback_timeout_ms=10000, settle=("tla_dropdown_open", 4000),
+         error="Could not find or click Report Type dropdown"),
+    Step("tla_option", (
+        _click(lambda page: page.locator("li.ui-dropdown-item").filter(has_text=re.compile("Test Level Analysis", re.IGNORECASE)).first),
+        _click(lambda page: page.locator("li.ui-dropdown-item").filter(has_text=re.compile("Test Level", re.IGNORECASE)).first),
+        _click(lambda page: page.locator("li.ui-dropdown-item").filter(has_text=re.compile("Analysis", re.IGNORECASE)).first),
+        _select_test_level_analysis,
+    ), 10000, settle=("tla_option_applied", 2000),
+         error="Could not find or select 'Test Level Analysis' from dropdown"),
+    Step("tla_form_idle", (_network_idle,), 10000, settle=("tla_form_render", 2000)),
+)
+
+# Performance and Participation Report built from the grid's JSON: no shareable link, wait or download
+# dialog. The export steps follow as a fallback and only run if the grid gave nothing.
+_EXPORT_STEPS = {step.name: step for step in PERFORMANCE_REPORT_FLOW}
+PERFORMANCE_GRID_FLOW: tuple[Step, ...] = (
+    *PERFORMANCE_REPORT_FLOW[:5],
+    _EXPORT_STEPS["completed_filter"],
+    Step("grid_capture", (_capture_grid,), when=_test_opened),
+    _EXPORT_STEPS["completed_checkbox"],
+    Step("grid_pages", (_walk_grid_pages,), 30000, optional=True, when=_test_opened),
+    Step("grid_download", (_write_grid_report,), optional=True, when=lambda ctx: bool(ctx.get("grid_pages")),
+         checkpoint="report_downloaded"),
+    *(
+        replace(step, when=_export_needed) for step in PERFORMANCE_REPORT_FLOW[5:]
+        if step.name not in ("completed_filter", "completed_checkbox")
+    ),
+)
+
+REPORT_FLOWS = {
+    "performance": PERFORMANCE_REPORT_FLOW,
+    "performance_grid": PERFORMANCE_GRID_FLOW,
+    "test_analysis": TEST_LEVEL_ANALYSIS_FLOW,
+}
+
+
+def performance_flow() -> tuple[Step, ...]:
+    return REPORT_FLOWS["performance_grid" if REPORT_SOURCE == "grid" else "performance"]
+
+
+async def open_courses_tool(page) -> bool:
+    """Wait for the left menu after login and open the Courses tool."""
+    course_clicked = False
+
+    # First, wait for the left-menu container to be visible
+    try:
+        await adaptive_wait("left_menu", 30000, lambda t: page.wait_for_selector("div.left-menu", state="visible", timeout=t))
+        await settle(page, "menu_render", 1000)  # Additional wait for menu items to render
+    except Exception:
+        pass
+
+    # Primary: Wait for and click Courses within the left-menu using ptooltip attribute
+    try:
+        course_locator = page.locator("div.left-menu li[ptooltip='Courses']")
+        await adaptive_wait("courses_tool", 30000, lambda t: course_locator.wait_for(state="visible", timeout=t))
+        await course_locator.first.click()
+        course_clicked = True
+    except Exception:
+        pass
+
+    # Fallback 1: Click via class and icon within left-menu
+    if not course_clicked:
+        try:
+            course_locator = page.locator("div.left-menu li.each-tool:has(span.icon-learning)")
+            await adaptive_wait("courses_tool_fallback", 10000, lambda t: course_locator.wait_for(state="visible", timeout=t))
+            # Filter to only the one with ptooltip="Courses"
+            course_locator = page.locator("div.left-menu li.each-tool[ptooltip='Courses']")
+            await course_locator.first.click()
+            course_clicked = True
+        except Exception:
+            pass
+
+    # Fallback 2: Click the span inside the li within left-menu
+    if not course_clicked:
+        try:
+            course_locator = page.locator("div.left-menu li[ptooltip='Courses'] span.icon-learning")
+            await adaptive_wait("courses_tool_fallback", 10000, lambda t: course_locator.wait_for(state="visible", timeout=t))
+            await course_locator.first.click()
+            course_clicked = True
+        except Exception:
+            pass
+
+    # Fallback 3: Try clicking by text content within left-menu
+    if not course_clicked:
+        try:
+            course_locator = page.locator("div.left-menu").get_by_role("listitem").filter(has_text="Courses")
+            await course_locator.first.click()
+            course_clicked = True
+        except Exception:
+            pass
+
+    return course_clicked
+
+
+async def search_and_open_course(page, course_query: str) -> bool:
+    """Search the Courses tool for `course_query` and open the matching course page."""
+    if not (course_query or "").strip():
+        return False
+
+    course_row_clicked = False
+    log.info(f"Searching for course: {course_query.strip()}")
+    search_sel = "input[placeholder='Enter course name to search']"
+    try:
+        await adaptive_wait("course_search", 20000, lambda t: page.wait_for_selector(search_sel, state="visible", timeout=t))
+        # A course page at this same address is a postback view, not a link worth learning
+        _courses_tool_urls[_portal_host.get()] = page.url
+        await page.click(search_sel)
+        await page.fill(search_sel, course_query.strip())
+        # Submit with Enter to trigger search
+        await page.press(search_sel, "Enter")
+        log.info(f"Course search submitted: {course_query.strip()}")
+
+        # Wait for search results to appear and click on the course row
+        try:
+            # Wait for the results table to appear
+            await adaptive_wait("course_results", 10000, lambda t: page.wait_for_selector("tbody.ui-datatable-data", state="visible", timeout=t))
+            await settle(page, "results_render", 2000)  # Additional wait for table to fully render
+
+            # Try to click the row containing the course name (partial match)
+            try:
+                # Look for a row containing the course name text
+                course_row = page.locator("tbody.ui-datatable-data tr").filter(has_text=course_query.strip())
+                await adaptive_wait("course_row", 10000, lambda t: course_row.first.wait_for(state="visible", timeout=t))
+                await course_row.first.click()
+                course_row_clicked = True
+            except Exception:
+                pass
+
+            # Fallback: Click the first result row if specific match failed
+            if not course_row_clicked:
+                try:
+                    await page.locator("tbody.ui-datatable-data tr.ui-datatable-even").first.click()
+                    course_row_clicked = True
+                except Exception:
+                    pass
+
+            # Fallback: Click anywhere on the first row
+            if not course_row_clicked:
+                try:
+                    await page.locator("tbody.ui-datatable-data tr").first.click()
+                    course_row_clicked = True
+                except Exception:
+                    pass
+
+            # After clicking the course row, wait for navigation to course page
+            if course_row_clicked:
+                try:
+                    await adaptive_wait("course_page", 10000, lambda t: page.wait_for_load_state("networkidle", timeout=t))
+                except Exception:
+                    pass
+        except Exception:
+            pass
+    except Exception:
+        pass
+
+    return course_row_clicked
+
+
+async def course_page_shows(page, course: str) -> bool:
+    """Whether the open course page is `course`: its title (or, failing that, the page text) names it."""
+    wanted = _link_key(course)
+    try:
+        titles = await page.locator(COURSE_TITLE_SELECTOR).all_inner_texts()
+        if any(wanted in _link_key(title) for title in titles):
+            return True
+        return wanted in _link_key(await page.locator("body").inner_text())
+    except Exception:
+        return False
+
+
+async def course_sidebar_visible(page) -> bool:
+    """Whether the course page's module sidebar is on screen."""
+    try:
+        return await page.locator("div.ui-g-3.sidedivpre").first.is_visible()
+    except Exception:
+        return False
+
+
+async def resume_at_course_page(page, course_url: str, course: str | None = None) -> bool:
+    """Jump straight to a course page reached by an earlier attempt; False if it is no longer valid.
+
+    With `course`, the page must also show that course: a learned URL may be a shared JSF view
+    that now renders another course.
+    """
+    try:
+        log.info(f"Resuming at course page: {course_url}")
+        await adaptive_wait("course_page_direct", 30000, lambda t: page.goto(course_url, wait_until="domcontentloaded", timeout=t))
+        await adaptive_wait("course_sidebar", 20000, lambda t: page.wait_for_selector("div.ui-g-3.sidedivpre", state="visible", timeout=t))
+    except Exception as exc:
+        log.info(f"Could not resume at course page ({exc}), navigating from Courses instead")
+        return False
+    if (course or "").strip() and not await course_page_shows(page, course):
+        log.info(f"{course_url} does not show course '{course}', navigating from Courses instead")
+        return False
+    return True
+
+
+async def read_course_list(page, max_pages: int = 200) -> tuple[list[str], bool]:
+    """Course names listed by the Courses tool, following the table paginator.
+
+    Also returns whether the last page was reached; a paginator failure or hitting
+    `max_pages` leaves the list partial.
+    """
+    names: list[str] = []
+    complete = False
+    await adaptive_wait("course_results", 10000, lambda t: page.wait_for_selector("tbody.ui-datatable-data", state="visible", timeout=t))
+    for _ in range(max_pages):
+        cells = await page.locator("tbody.ui-datatable-data tr td:first-child").all_inner_texts()
+        names.extend(" ".join(cell.split()) for cell in cells if cell.strip())
+        next_button = page.locator("a.ui-paginator-next").first
+        if not await next_button.count() or "ui-state-disabled" in (await next_button.get_attribute("class") or ""):
+            complete = True
+            break
+        try:
+            await next_button.click()
+            await settle(page, "results_render", 2000)
+        except Exception as exc:  # noqa: BLE001
+            log.warning(f"Course list paginator failed after {len(names)} course(s): {exc}")
+            break
+    return list(dict.fromkeys(names)), complete
+
+
+async def read_module_tests(page) -> list[str]:
+    """Test names on the currently selected module (first line of each test card)."""
+    main_container = page.locator("div.ui-g-9.maindivpre")
+    await adaptive_wait("test_container", 5000, lambda t: main_container.wait_for(state="visible", timeout=t))
+    cards = await main_container.locator("div.ui-g-12.moduletest").all_inner_texts()
+    tests = []
+    for text in cards:
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        if lines:
+            tests.append(" ".join(lines[0].split()))
+    return tests
+
+
+async def read_course_tree(page) -> dict[str, list[str]]:
+    """Module -> test names for the open course page, selecting each module in turn."""
+    sidebar_modules = page.locator("div.ui-g-3.sidedivpre span.modulelist")
+    await adaptive_wait("course_sidebar", 20000, lambda t: sidebar_modules.first.wait_for(state="visible", timeout=t))
+    modules = [" ".join(name.split()) for name in await sidebar_modules.all_inner_texts()]
+    tree: dict[str, list[str]] = {}
+    for index, module in enumerate(modules):
+        check_cancelled()
+        if not module:
+            continue
+        try:
+            await sidebar_modules.nth(index).click()
+            await settle(page, "module_render", 10000)
+            tree[module] = await read_module_tests(page)
+        except Exception:
+            tree.setdefault(module, [])
+    return tree
+
+
+def _read_meminfo() -> dict[str, int]:
+    """Host memory figures in MB from /proc/meminfo (empty on non-Linux hosts)."""
+    info = {}
+    try:
+        with open("/proc/meminfo", encoding="ascii") as fh:
+            for line in fh:
+                key, _, rest = line.partition(":")
+                info[key] = int(rest.split()[0]) // 1024
+    except Exception:
+        pass
+    return info
+
+
+def host_memory_status() -> dict:
+    """Available/total host memory and whether new jobs should wait."""
+    info = _read_meminfo()
+    available = info.get("MemAvailable")
+    return {
+        "mem_total_mb": info.get("MemTotal"),
+        "mem_available_mb": available,
+        "under_pressure": available is not None and available < HOST_MIN_AVAILABLE_MB,
+    }
+
+
+def process_tree_rss_mb(marker: str) -> tuple[int | None, float | None]:
+    """Find the browser process started with `marker` on its command line; return (pid, tree RSS MB)."""
+    proc = Path("/proc")
+    if not proc.is_dir():
+        return None, None
+    parents: dict[int, int] = {}
+    rss_pages: dict[int, int] = {}
+    root = None
+    for entry in proc.iterdir():
+        if not entry.name.isdigit():
+            continue
+        pid = int(entry.name)
+        try:
+            stat = (entry / "stat").read_text().rsplit(")", 1)[1].split()
+            parents[pid] = int(stat[1])
+            rss_pages[pid] = int(stat[21])
+            if root is None and marker.encode() in (entry / "cmdline").read_bytes():
+                # Renderer/GPU children don't inherit the switch; the topmost match is the browser
+                root = pid
+        except Exception:
+            continue
+    if root is None:
+        return None, None
+    while parents.get(root) in rss_pages and marker.encode() in (proc / str(parents[root]) / "cmdline").read_bytes():
+        root = parents[root]
+    children: dict[int, list[int]] = {}
+    for pid, ppid in parents.items():
+        children.setdefault(ppid, []).append(pid)
+    tree, frontier = {root}, [root]
+    while frontier:
+        for child in children.get(frontier.pop(), []):
+            if child not in tree:
+                tree.add(child)
+                frontier.append(child)
+    page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+    return root, round(sum(rss_pages.get(pid, 0) for pid in tree) * page_size / (1024 * 1024), 1)
+
+
+class BrowserSupervisor:
+    """Owns the event loop, Playwright instance and shared browsers for this process.
+
+    Jobs run as coroutines on the supervisor's loop and each gets its own
+    BrowserContext. A browser is recycled once it is idle and has served
+    BROWSER_MAX_JOBS jobs or its process tree exceeds BROWSER_MAX_RSS_MB.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._playwright = None
+        self._browsers: list[dict] = []
+        self.recycled = {"jobs": 0, "rss": 0, "crashed": 0, "hung": 0}
+        # Warm pool state, keyed by (portal host, username); only touched on the supervisor loop
+        self._warm: dict[tuple[str, str], list[dict]] = {}
+        self._warm_filling: dict[tuple[str, str], int] = {}
+        self._warm_logins: dict[tuple[str, str], dict] = {}  # credentials kept in memory only
+        self._warm_demand: dict[tuple[str, str], list[float]] = {}
+        self.warm_stats = {"hits": 0, "misses": 0, "expired": 0, "stale": 0}
+        self._background: set[asyncio.Task] = set()
+        self._keep_open: dict[int, float] = {}  # id(context) -> seconds to leave it open after its job
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="browser-supervisor", daemon=True).start()
+                asyncio.run_coroutine_threadsafe(self._monitor(), loop)
+                self._loop = loop
+            return self._loop
+
+    def submit(self, coro):
+        """Schedule a job coroutine on the supervisor loop; returns a concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    async def _launch(self, is_headless: bool) -> dict:
+        if self._playwright is None:
+            from playwright.async_api import async_playwright  # type: ignore[reportMissingImports]
+            self._playwright = await async_playwright().start()
+        browser_id = uuid.uuid4().hex[:12]
+        marker = f"--reportgen-browser={browser_id}"
+        browser = await launch_browser(
+            self._playwright, is_headless, [marker, *(LOW_MEMORY_LAUNCH_ARGS if low_memory_mode() else ())]
+        )
+        managed = {
+            "id": browser_id,
+            "browser": browser,
+            "marker": marker,
+            "headless": is_headless,
+            "launched_at": time.time(),
+            "jobs_served": 0,
+            "active_jobs": 0,
+            "draining": False,
+            "pid": None,
+            "rss_mb": None,
+        }
+        browser.on("disconnected", lambda _: self._forget(managed, crashed=True))
+        self._browsers.append(managed)
+        log.info(f"Launched browser {browser_id}")
+        return managed
+
+    def kill(self, managed: dict):
+        """Kill a hung browser's process from any thread; its jobs fail and new jobs get a fresh browser."""
+        managed["draining"] = True
+        pid, _ = process_tree_rss_mb(managed["marker"])
+        if pid is None:
+            return
+        log.warning(f"Killing hung browser {managed['id']} (pid {pid})")
+        with contextlib.suppress(OSError):
+            os.kill(pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+        self.recycled["hung"] += 1
+
+    def _forget(self, managed: dict, crashed: bool = False):
+        if managed in self._browsers:
+            self._browsers.remove(managed)
+            if crashed:
+                self.recycled["crashed"] += 1
+
+    async def _acquire(self, is_headless: bool) -> dict:
+        waited = 0.0
+        while host_memory_status()["under_pressure"]:
+            # Queue rather than start another browser job on a host that is about to OOM
+            if waited >= HOST_PRESSURE_MAX_WAIT_S:
+                raise RuntimeError("Server is low on memory; please try again shortly")
+            check_cancelled()
+            if waited == 0:
+                log.info("Host memory under pressure, waiting before starting the job...")
+                note_progress(HOST_PRESSURE_MAX_WAIT_S + STEP_DEADLINE_GRACE_S, wait="host_memory")
+            await asyncio.sleep(2)
+            waited += 2
+        for managed in self._browsers:
+            if not managed["draining"] and managed["headless"] == is_headless:
+                break
+        else:
+            managed = await self._launch(is_headless)
+        managed["active_jobs"] += 1
+        return managed
+
+    async def _release(self, managed: dict):
+        managed["active_jobs"] -= 1
+        managed["jobs_served"] += 1
+        if managed["jobs_served"] >= BROWSER_MAX_JOBS and not managed["draining"]:
+            managed["draining"] = True
+            self.recycled["jobs"] += 1
+        await self._retire_idle()
+
+    async def _retire_idle(self):
+        for managed in [m for m in self._browsers if m["draining"] and m["active_jobs"] == 0]:
+            self._forget(managed)
+            log.info(f"Recycling browser {managed['id']} after {managed['jobs_served']} job(s), RSS {managed['rss_mb']} MB")
+            try:
+                await managed["browser"].close()
+            except Exception:
+                pass
+
+    async def _close_context(self, managed: dict, context):
+        try:
+            await context.close()
+        except Exception:
+            pass
+        await self._release(managed)
+
+    @asynccontextmanager
+    async def job_session(self, is_headless: bool, login: dict | None = None, **context_options):
+        """Yield (context, warm_page) for a job; warm_page is a logged-in page from the pool or None.
+
+        The context is closed (and its browser released) afterwards. `login` holds
+        url/username/password and enables the warm pool for that (portal, user).
+        """
+        warm = self._checkout_warm(login, is_headless) if login else None
+        if warm is not None:
+            managed, context, warm_page = warm["managed"], warm["context"], warm["page"]
+            if not await self._warm_page_alive(warm_page):
+                self.warm_stats["stale"] += 1
+                await self._close_context(managed, context)
+                warm = None
+        if warm is None:
+            managed = await self._acquire(is_headless)
+            warm_page = None
+            try:
+                context = await self._new_context(managed, **context_options)
+            except Exception:
+                await self._release(managed)
+                raise
+        if _current_job_id.get() in active_processes:
+            # For the watchdog, which kills the browser if the job's page cannot be closed
+            active_processes[_current_job_id.get()]["browser"] = managed
+        try:
+            yield context, warm_page
+        finally:
+            linger_s = self._keep_open.pop(id(context), 0)
+            if linger_s > 0:
+                task = asyncio.get_running_loop().create_task(self._close_later(managed, context, linger_s))
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+            else:
+                await self._close_context(managed, context)
+
+    def keep_open(self, context, seconds: float):
+        """Leave a job's context open for `seconds` after its job_session ends.
+
+        The job itself finishes (and frees its queue slot) as usual; only the browser window stays.
+        """
+        self._keep_open[id(context)] = seconds
+
+    async def _close_later(self, managed: dict, context, seconds: float):
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await self._close_context(managed, context)
+
+    async def _new_context(self, managed: dict, **context_options):
+        """A BrowserContext on `managed`; in low-memory mode smaller, without service workers or media.
+
+        In HAR record mode the context's traffic is written to HAR_PATH when it closes; in replay
+        mode it is served from HAR_PATH, HAR_REPLAY_LATENCY_MS later per request.
+        """
+        if HAR_MODE == "record":
+            context_options = {**context_options, "record_har_path": str(HAR_PATH), "record_har_content": "embed"}
+        if low_memory_mode():
+            context_options = {**LOW_MEMORY_CONTEXT_OPTIONS, **context_options}
+        context = await managed["browser"].new_context(**context_options)
+        if low_memory_mode():
+            await context.route(LOW_MEMORY_BLOCKED_MEDIA, lambda route: route.abort())
+        if HAR_MODE == "replay":
+            await context.route_from_har(HAR_PATH, not_found="abort")
+            if HAR_REPLAY_LATENCY_MS > 0:
+                # Registered last, so it runs first and then falls through to the HAR route
+                async def _delay(route):
+                    await asyncio.sleep(HAR_REPLAY_LATENCY_MS / 1000)
+                    await route.fallback()
+                await context.route("**/*", _delay)
+        return context
+
+    def _warm_key(self, login: dict) -> tuple[str, str]:
+        return urlparse(login["url"]).hostname or "", login["username"]
+
+    def _checkout_warm(self, login: dict, is_headless: bool) -> dict | None:
+        """Record demand for (portal, user), hand out a parked context if any, and schedule a refill."""
+        if WARM_POOL_SIZE <= 0 or low_memory_mode() or HAR_MODE != "off":
+            # Parked contexts are exactly the memory low-memory mode is trying to save, and
+            # recorded or replayed runs must log in themselves
+            return None
+        key = self._warm_key(login)
+        now = time.time()
+        demand = [t for t in self._warm_demand.get(key, []) if now - t < WARM_POOL_DEMAND_WINDOW_S] + [now]
+        self._warm_demand[key] = demand
+        pool = self._warm.get(key, [])
+        entry = pool.pop(0) if pool else None
+        self.warm_stats["hits" if entry else "misses"] += 1
+        if len(demand) >= WARM_POOL_MIN_USES:
+            self._warm_logins[key] = {**login, "headless": is_headless}
+            task = asyncio.get_running_loop().create_task(self._fill_warm(key))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+        return entry
+
+    async def _warm_page_alive(self, page) -> bool:
+        """A parked page is usable if the session is still logged in (left menu present)."""
+        try:
+            return await page.locator("div.left-menu").first.is_visible()
+        except Exception:
+            return False
+
+    async def _fill_warm(self, key: tuple[str, str]):
+        """Log in contexts in the background until the pool for `key` holds WARM_POOL_SIZE."""
+        login = self._warm_logins.get(key)
+        if login is None:
+            return
+        # Runs detached from the job that triggered it: not cancellable through that job
+        _current_job_id.set("")
+        _portal_host.set(key[0])
+        pool = self._warm.setdefault(key, [])
+        while len(pool) + self._warm_filling.get(key, 0) < WARM_POOL_SIZE:
+            if host_memory_status()["under_pressure"]:
+                return
+            self._warm_filling[key] = self._warm_filling.get(key, 0) + 1
+            managed = context = None
+            try:
+                managed = await self._acquire(login["headless"])
+                context = await self._new_context(managed, accept_downloads=True)
+                page = await context.new_page()
+                await open_portal(page, login["url"])
+                await login_to_portal(page, login["username"], login["password"])
+                if not await open_courses_tool(page):
+                    raise RuntimeError("Courses tool not reachable after login")
+                pool.append({"managed": managed, "context": context, "page": page, "parked_at": time.time()})
+                log.info(f"Warm pool for {key[0]} / {key[1]}: {len(pool)} ready")
+            except Exception as exc:
+                log.warning(f"Could not warm a session for {key[0]}: {exc}")
+                if managed is not None:
+                    if context is not None:
+                        await self._close_context(managed, context)
+                    else:
+                        await self._release(managed)
+                return
+            finally:
+                self._warm_filling[key] -= 1
+
+    async def _expire_warm(self):
+        """Close parked contexts idle longer than WARM_POOL_IDLE_TTL_S and forget unused credentials."""
+        now = time.time()
+        for key, pool in list(self._warm.items()):
+            for entry in [e for e in pool if now - e["parked_at"] > WARM_POOL_IDLE_TTL_S]:
+                pool.remove(entry)
+                self.warm_stats["expired"] += 1
+                await self._close_context(entry["managed"], entry["context"])
+            recent = [t for t in self._warm_demand.get(key, []) if now - t < WARM_POOL_IDLE_TTL_S]
+            if not pool and not recent and not self._warm_filling.get(key):
+                self._warm.pop(key, None)
+                self._warm_logins.pop(key, None)
+
+    async def _monitor(self):
+        """Sample each browser's process-tree RSS and mark bloated browsers for recycling."""
+        while True:
+            for managed in list(self._browsers):
+                pid, rss = await asyncio.to_thread(process_tree_rss_mb, managed["marker"])
+                managed["pid"], managed["rss_mb"] = pid, rss
+                if rss is not None and rss > BROWSER_MAX_RSS_MB and not managed["draining"]:
+                    log.info(f"Browser {managed['id']} RSS {rss} MB over {BROWSER_MAX_RSS_MB} MB, recycling when idle")
+                    managed["draining"] = True
+                    self.recycled["rss"] += 1
+            await self._expire_warm()
+            await self._retire_idle()
+            await asyncio.sleep(BROWSER_SAMPLE_INTERVAL_S)
+
+    def metrics(self) -> dict:
+        now = time.time()
+        return {
+            "browsers": [
+                {
+                    "id": m["id"],
+                    "pid": m["pid"],
+                    "rss_mb": m["rss_mb"],
+                    "jobs_served": m["jobs_served"],
+                    "active_jobs": m["active_jobs"],
+                    "draining": m["draining"],
+                    "age_s": round(now - m["launched_at"]),
+                }
+                for m in list(self._browsers)
+            ],
+            "recycled": dict(self.recycled),
+            "warm_pool": {
+                "size": WARM_POOL_SIZE,
+                "ready": {f"{host} / {user}": len(pool) for (host, user), pool in list(self._warm.items())},
+                **self.warm_stats,
+            },
+            "host": host_memory_status(),
+            "autoscale": dict(autoscale_status, min=QUEUE_MIN_RUNNING, max=QUEUE_MAX_RUNNING),
+            "low_memory": {
+                "enabled": low_memory_mode(),
+                "mode": LOW_MEMORY_MODE,
+                "measured": (read_browser_marker() or {}).get("memory_profile"),
+            },
+            "limits": {
+                "browser_max_jobs": BROWSER_MAX_JOBS,
+                "browser_max_rss_mb": BROWSER_MAX_RSS_MB,
+                "host_min_available_mb": HOST_MIN_AVAILABLE_MB,
+            },
+        }
+
+
+browser_supervisor = BrowserSupervisor()
+
+
+async def open_portal(page, url: str):
+    """Navigate to the portal and wait for redirects to settle."""
+    # Navigate and wait for redirects to complete
+    log.info(f"Navigating to URL: {url}")
+    await adaptive_wait("page_load", 30000, lambda t: page.goto(url, wait_until="domcontentloaded", timeout=t))
+    await adaptive_wait("page_idle", 30000, lambda t: page.wait_for_load_state("networkidle", timeout=t))
+    log.info("Page loaded successfully")
+
+
+async def login_to_portal(page, username: str, password: str):
+    """Fill the Angular login form, submit it and wait for the post-login page."""
+    # Wait for the Angular form fields to be available (using your exact selectors)
+    email_selector = 'input[id="emailAddress"]'
+    password_selector = 'input[id="password"]'
+    await acquire_portal_slot("login")
+
+    # Wait for email field to be visible and ready
+    log.info("Waiting for login form...")
+    await adaptive_wait("login_form", 30000, lambda t: page.wait_for_selector(email_selector, state="visible", timeout=t))
+    log.info(f"Filling email field: {username}")
+    await page.fill(email_selector, username)
+
+    # Wait for password field to be visible and ready
+    await adaptive_wait("login_password", 10000, lambda t: page.wait_for_selector(password_selector, state="visible", timeout=t))
+    log.info("Filling password field")
+    await page.fill(password_selector, password)
+
+    # Try to find and click the Login button using your markup
+    clicked = False
+    try:
+        await page.get_by_role("button", name="Login").click()
+        clicked = True
+    except Exception:
+        pass
+
+    if not clicked:
+        try:
+            await page.locator("button[label='Login']").click()
+            clicked = True
+        except Exception:
+            pass
+
+    if not clicked:
+        try:
+            await page.locator("button.form__button:has-text('Login')").click()
+            clicked = True
+        except Exception:
+            pass
+
+    if not clicked:
+        try:
+            await page.click("button[type='submit']")
+            clicked = True
+        except Exception:
+            # If still not found, press Enter in password field
+            await page.press(password_selector, "Enter")
+
+    # Wait for navigation and then attempt to select the Courses tool
+    try:
+        log.info("Waiting for page to load after login...")
+        await adaptive_wait("post_login", 60000, lambda t: page.wait_for_load_state("networkidle", timeout=t))
+        # Additional wait for Angular to render the menu items
+        await settle(page, "menu_render", 2000)
+        log.info("Login successful, page loaded")
+    except Exception:
+        pass
+
+
+def should_run_headless() -> bool:
+    """Headless on servers (HEADLESS=true, Render, Linux without X11); visible on desktops."""
+    # Determine if we should run in headless mode
+    # On Render/cloud servers, there's no display, so we must use headless mode
+    # Check for explicit HEADLESS env var, or detect server environment
+    explicit_headless = os.environ.get("HEADLESS", "").lower() == "true"
+
+    # Detect if we're on a server (headless environment)
+    # Windows/Mac should use visible browser unless explicitly set to headless
+    system = platform.system()
+    is_server = False
+
+    if explicit_headless:
+        # Explicitly requested headless mode
+        is_server = True
+    elif os.environ.get("RENDER") is not None:
+        # Render.com environment
+        is_server = True
+    elif system == "Linux" and os.environ.get("DISPLAY") is None:
+        # Linux server without X11 display
+        is_server = True
+    # Windows and macOS should use visible browser by default
+    # (DISPLAY check doesn't apply to Windows/Mac)
+
+    is_headless = is_server
+    return is_headless
+
+
+async def launch_browser(p, is_headless: bool, extra_args: list[str] | None = None):
+    """Launch Chrome, falling back to bundled Chromium; raises RuntimeError if neither starts."""
+    extra_args = extra_args or []
+    system = platform.system()
+    window_args = ['--start-maximized'] if system == "Windows" else []
+
+    # Launch the benchmarked engine directly instead of probing Chrome on every launch
+    profile = launch_profile()
+    if profile and (is_headless or profile["engine"] != "chromium-headless-shell"):
+        channel = LAUNCH_ENGINES.get(profile["engine"])
+        try:
+            return await p.chromium.launch(
+                headless=is_headless,
+                args=[*(LAUNCH_SANDBOX_ARGS if is_headless else window_args), *profile["args"], *extra_args],
+                **({"channel": channel} if channel else {}),
+            )
+        except Exception as profile_exc:
+            log.warning(f"Launch profile {profile['engine']} failed ({profile_exc}), probing engines instead")
+
+    # Prefer the user's installed Google Chrome; fallback to bundled Chromium
+    browser = None
+
+    # On headless servers, use bundled Chromium (system Chrome may not be available)
+    if not is_headless:
+        # Try to use system Chrome first (visible browser)
+        try:
+            log.debug("Attempting to launch system Chrome...")
+            browser = await p.chromium.launch(
+                channel="chrome",
+                headless=False,
+                args=(['--start-maximized'] if system == "Windows" else []) + extra_args
+            )
+            log.debug("System Chrome launched successfully!")
+        except Exception as chrome_exc:
+            log.debug(f"System Chrome launch failed: {chrome_exc}, trying bundled Chromium...")
+            # Fallback to bundled Chromium if system Chrome not available
+            try:
+                browser = await p.chromium.launch(
+                    headless=False,
+                    args=(['--start-maximized'] if system == "Windows" else []) + extra_args
+                )
+                log.debug("Bundled Chromium launched successfully!")
+            except Exception as chromium_exc:
+                error_msg = f"Failed to launch browser: {chromium_exc}. Make sure Playwright is installed: 'pip install playwright' and 'python -m playwright install chromium'"
+                log.error(f"{error_msg}")
+                raise RuntimeError(error_msg)
+    else:
+        # On headless servers, try Chrome first, fall back to Chromium
+        try:
+            log.debug("Attempting to launch Chrome in headless mode...")
+            try:
+                browser = await p.chromium.launch(
+                    channel="chrome",
+                    headless=True,
+                    args=['--no-sandbox', '--disable-setuid-sandbox'] + extra_args  # Required for some Linux servers
+                )
+                log.debug("Chrome launched successfully in headless mode!")
+            except Exception:
+                # Chrome not available, use Chromium
+                log.debug("Chrome not available, using Chromium...")
+                browser = await p.chromium.launch(
+                    headless=True,
+                    args=['--no-sandbox', '--disable-setuid-sandbox'] + extra_args  # Required for some Linux servers
+                )
+                log.debug("Chromium launched successfully in headless mode!")
+        except Exception as headless_exc:
+            error_msg = f"Failed to launch browser: {headless_exc}. Please ensure browsers are installed via 'python -m playwright install chrome' or 'python -m playwright install chromium-headless-shell'."
+            log.error(f"{error_msg}")
+            raise RuntimeError(error_msg)
+    return browser
+
+
+async def open_and_login_with_playwright(
+    url: str,
+    username: str,
+    password: str,
+    course_query: str | None = None,
+    module_query: str | None = None,
+    test_query: str | None = None,
+    filename_choice: str = "test",
+    report_type: str = "performance",
+    keep_open_ms: int = 300000,
+    process_id: str | None = None,
+    campus: str = "",
+    batch: str = "",
+    resume_from: dict | None = None,
+) -> tuple[bool, str]:
+    if importlib.util.find_spec("playwright") is None:
+        return False, "Playwright not installed"
+
+    host = urlparse(url).hostname or ""
+    _portal_host.set(host)
+    _current_job_id.set(process_id or "")
+    # Use the catalog's exact names when it knows them, so the searches below match precisely
+    course_query = await asyncio.to_thread(catalog_canonical, host, "course", course_query) or course_query
+    module_query = await asyncio.to_thread(
+        catalog_canonical, host, "module", module_query, course=course_query or ""
+    ) or module_query
+    test_query = await asyncio.to_thread(
+        catalog_canonical, host, "test", test_query, course=course_query or "", module=module_query or ""
+    ) or test_query
+    if process_id in active_processes:
+        # Let other threads cancel this job on the loop that owns its browser
+        active_processes[process_id]["loop"] = asyncio.get_running_loop()
+        active_processes[process_id]["task"] = asyncio.current_task()
+    try:
+        is_headless = should_run_headless()
+        system = platform.system()
+      
+        log.debug(f"Platform: {system}, Headless: {is_headless}, RENDER: {os.environ.get('RENDER')}, HEADLESS: {os.environ.get('HEADLESS')}")
+
+        # Each job gets its own context on a shared, supervised browser; pooled contexts are already logged in
+        login = {"url": url, "username": username, "password": password}
+        warm_login = login if report_type != "test_analysis" and not (resume_from or {}).get("course_url") else None
+        async with browser_supervisor.job_session(is_headless, warm_login, accept_downloads=True) as (context, warm_page):
+            # Store context reference for cancellation
+            if process_id and process_id in active_processes:
+                active_processes[process_id]['context'] = context
+            check_cancelled()
+            
+            download_dir = get_server_downloads_dir()
+            try:
+                download_dir.mkdir(parents=True, exist_ok=True)
+            except Exception:
+                pass
+
+            if warm_page is not None:
+                # Already logged in and parked on the Courses tool
+                page = warm_page
+                log.info("Using a pre-logged-in session from the warm pool")
+            else:
+                page = await context.new_page()
+                await open_portal(page, url)
+
+            try:
+                if warm_page is None:
+                    await login_to_portal(page, username, password)
+
+                # Route based on report type - Test Level Analysis has different flow after login
+                if report_type == "test_analysis":
+                    # For Test Level Analysis, skip course/module/test navigation
+                    ctx = report_flow_context(
+                        host, download_dir, course_query, module_query, test_query, filename_choice,
+                        campus=campus, batch=batch,
+                    )
+                    await run_flow(page, REPORT_FLOWS["test_analysis"], ctx)
+                else:
+                    # Performance and Participation Report flow
+                    # Go straight to the course page reached by a previous attempt, or one learned by earlier jobs
+                    course_page_reached = False
+                    known_link = (resume_from or {}).get("course_url") or await asyncio.to_thread(
+                        deep_link, host, course_query, module_query
+                    )
+                    if known_link:
+                        course_page_reached = await resume_at_course_page(page, known_link, course_query)
+                        if not course_page_reached:
+                            # Stale link: forget it and go back to a page with the left menu
+                            await asyncio.to_thread(forget_deep_link, host, course_query)
+                            await open_portal(page, url)
+                    if not course_page_reached:
+                        course_clicked = (warm_page is not None and not known_link) or await open_courses_tool(page)
+                        if course_clicked:
+                            record_checkpoint("logged_in")
+                        if course_clicked and (course_query or "").strip():
+                            course_page_reached = await search_and_open_course(page, course_query)
+                            if course_page_reached:
+                                await asyncio.to_thread(remember_deep_link, host, course_query, page.url)
+                    if course_page_reached:
+                        record_checkpoint("course_page", course_url=page.url)
+
+                    # Module, test, shareable link, download and dialogs
+                    ctx = report_flow_context(
+                        host, download_dir, course_query, module_query, test_query, filename_choice,
+                        course_url=page.url if course_page_reached else None,
+                    )
+                    try:
+                        await run_flow(page, performance_flow(), ctx)
+                    finally:
+                        release_grid_capture(page, ctx)
+                    if _test_opened(ctx):
+                        if not report_file_id(ctx):
+                            raise Exception("Download did not produce a file")
+                        log.info(f"Report download completed for: {course_query or ''} - {test_query or ''}")
+
+                check_cancelled()
+                if is_headless or low_memory_mode() or keep_open_ms <= 0:
+                    # Free the context as soon as the report is in; nobody can see a headless window
+                    return True, "Logged in, opened the course and downloaded the report."
+                # Keep the window open for the user after the job has finished and left its slot
+                browser_supervisor.keep_open(context, keep_open_ms / 1000)
+                return True, f"Opened in Chrome, logged in, navigated to Courses, and opened the course. Browser kept open for {(keep_open_ms//6000)} min."
+            except Exception as exc:  # noqa: BLE001
+                checkpoint = job_checkpoint()
+                if checkpoint.get("step"):
+                    return False, f"Report generation failed after step '{checkpoint['step']}': {exc}"
+                return False, f"Failed to fill login fields: {exc}. Please check if the page loaded correctly."
+    except asyncio.CancelledError:
+        return False, "Report generation was cancelled by user"
+    except Exception as exc:  # noqa: BLE001
+        return False, f"Playwright error: {exc}"
+    finally:
+        save_step_timings()
+
+
+async def process_single_course_in_session(
+    page,
+    download_dir: Path,
+    course_query: str,
+    module_query: str,
+    test_query: str,
+    filename_choice: str = "test",
+    course_name: str = "",
+) -> tuple[bool, str]:
+    """Process a single course/module/test within an existing browser session (assumes already on courses page) using the shared report flow
+
+    Pass an empty `course_query` when the page is already on the course; `course_name` then names the report.
+    """
+    course_name = course_name or course_query
+    try:
+        if (course_query or "").strip():
+            await search_and_open_course(page, course_query)
+        ctx = report_flow_context(
+            _portal_host.get(), download_dir, course_name, module_query, test_query, filename_choice,
+        )
+        # Batches track their own progress, so the per-step checkpoints are not recorded here
+        try:
+            await run_flow(page, performance_flow(), ctx, record_checkpoints=False)
+        finally:
+            release_grid_capture(page, ctx)
+        if not _test_opened(ctx):
+            return False, "Test was not clicked successfully"
+        return True, f"Successfully processed {course_name} - {test_query}"
+    except Exception as exc:  # noqa: BLE001
+        return False, f"Error processing course: {exc}"
+
+
+async def run_batch_in_session(
+    url: str,
+    username: str,
+    password: str,
+    items: list[dict],
+    process_id: str | None = None,
+    resume_from: dict | None = None,
+    **_unused,
+) -> tuple[bool, str]:
+    """Download several Performance and Participation reports for one (portal, user) in a single login.
+
+    Each item has course/module/test/filename_choice keys. Items finished by an earlier
+    attempt (checkpoint "items_done") are skipped on retry.
+    """
+    host = urlparse(url).hostname or ""
+    _portal_host.set(host)
+    _current_job_id.set(process_id or "")
+    if process_id in active_processes:
+        active_processes[process_id]["loop"] = asyncio.get_running_loop()
+        active_processes[process_id]["task"] = asyncio.current_task()
+    done = set((resume_from or {}).get("items_done", []))
+    failures: list[str] = []
+    unreachable: set[str] = set()  # courses the search could not find; their other items are not retried
+    try:
+        login = {"url": url, "username": username, "password": password}
+        async with browser_supervisor.job_session(should_run_headless(), login, accept_downloads=True) as (context, warm_page):
+            if process_id and process_id in active_processes:
+                active_processes[process_id]["context"] = context
+            check_cancelled()
+            download_dir = get_server_downloads_dir()
+            download_dir.mkdir(parents=True, exist_ok=True)
+
+            if warm_page is not None:
+                page = warm_page
+            else:
+                page = await context.new_page()
+                await open_portal(page, url)
+                await login_to_portal(page, username, password)
+            record_checkpoint("logged_in", items_done=sorted(done))
+
+            on_courses_tool = warm_page is not None
+            # Course whose page the previous item worked in, and the address it was reached at
+            current_course, current_course_url = None, None
+            for index, item in enumerate(items):
+                if index in done:
+                    continue
+                check_cancelled()
+                label = f"{item.get('course', '')} - {item.get('test', '')}"
+                log.info(f"Batch item {index + 1}/{len(items)}: {label}")
+                course = item.get("course", "")
+                if _link_key(course) in unreachable:
+                    failures.append(f"{label}: course not found")
+                    await asyncio.to_thread(record_manifest_row, item, "failed", "Course not found")
+                    continue
+                await asyncio.to_thread(record_manifest_row, item, "running")
+                # Same course as the item before: the report left the page on its results view, so
+                # only go back to the course page (if the sidebar is gone) and click the module again
+                stay = bool(item.get("module", "").strip()) and _link_key(course) == current_course and (
+                    await course_sidebar_visible(page)
+                    or await resume_at_course_page(page, current_course_url, course)
+                )
+                if stay:
+                    log.info("Staying in the course of the previous item; selecting the module in the sidebar")
+                else:
+                    current_course = None
+                    known_link = await asyncio.to_thread(deep_link, host, course, item.get("module", ""))
+                    if not (known_link and await resume_at_course_page(page, known_link, course)):
+                        if known_link:
+                            await asyncio.to_thread(forget_deep_link, host, course)
+                            await open_portal(page, url)
+                            on_courses_tool = False
+                        # Go back to the Courses tool between items instead of logging in again
+                        if not on_courses_tool and not await open_courses_tool(page):
+                            failures.append(f"{label}: could not open the Courses tool")
+                            await asyncio.to_thread(record_manifest_row, item, "failed", "Could not open the Courses tool")
+                            continue
+                        if course.strip():
+                            if not await search_and_open_course(page, course):
+                                unreachable.add(_link_key(course))
+                                failures.append(f"{label}: course not found")
+                                await asyncio.to_thread(record_manifest_row, item, "failed", "Course not found")
+                                continue
+                            await asyncio.to_thread(remember_deep_link, host, course, page.url)
+                    on_courses_tool = False
+                    current_course, current_course_url = _link_key(course), page.url
+                # Already on the course page, so no course query for the in-session search
+                ok, message = await process_single_course_in_session(
+                    page, download_dir,
+                    "", item.get("module", ""), item.get("test", ""),
+                    item.get("filename_choice", "test"),
+                    course_name=course,
+                )
+                if not ok:
+                    # The page is in an unknown state; the next item navigates again
+                    current_course = None
+                await asyncio.to_thread(record_manifest_row, item, "done" if ok else "failed", message)
+                if ok:
+                    done.add(index)
+                    record_checkpoint("logged_in", items_done=sorted(done))
+                else:
+                    failures.append(f"{label}: {message}")
+    except asyncio.CancelledError:
+        return False, "Report generation was cancelled by user"
+    except Exception as exc:  # noqa: BLE001
+        failures.append(f"Playwright error: {exc}")
+    finally:
+        save_step_timings()
+
+    summary = f"Batch downloaded {len(done)}/{len(items)} reports"
+    if failures:
+        return False, summary + ". Failed: " + "; ".join(failures)
+    return True, summary
+
+
+async def crawl_catalog(
+    url: str,
+    username: str,
+    password: str,
+    full: bool = False,
+    process_id: str | None = None,
+    **_unused,
+) -> tuple[bool, str]:
+    """Index the portal's course -> module -> test tree into the catalog.
+
+    Only courses that are new or older than CATALOG_REFRESH_AGE_S are crawled (all of
+    them with `full`), at most CATALOG_MAX_COURSES_PER_RUN per run, oldest first.
+    """
+    host = urlparse(url).hostname or ""
+    _portal_host.set(host)
+    _current_job_id.set(process_id or "")
+    if process_id in active_processes:
+        active_processes[process_id]["loop"] = asyncio.get_running_loop()
+        active_processes[process_id]["task"] = asyncio.current_task()
+    crawled = 0
+    try:
+        login = {"url": url, "username": username, "password": password}
+        async with browser_supervisor.job_session(should_run_headless(), login) as (context, warm_page):
+            if process_id and process_id in active_processes:
+                active_processes[process_id]["context"] = context
+            if warm_page is not None:
+                page = warm_page
+            else:
+                page = await context.new_page()
+                await open_portal(page, url)
+                await login_to_portal(page, username, password)
+                if not await open_courses_tool(page):
+                    return False, "Could not open the Courses tool"
+            record_checkpoint("logged_in")
+
+            courses, complete = await read_course_list(page)
+            if not courses:
+                return False, "The Courses tool listed no courses"
+            crawled_at = await asyncio.to_thread(catalog_sync_courses, host, courses, complete)
+            cutoff = time.time() - CATALOG_REFRESH_AGE_S
+            stale = sorted(
+                (course for course in courses if full or crawled_at.get(course, 0) < cutoff),
+                key=lambda course: crawled_at.get(course, 0),
+            )
+            for index, course in enumerate(stale[:CATALOG_MAX_COURSES_PER_RUN]):
+                check_cancelled()
+                if index and not await open_courses_tool(page):
+                    break
+                if not await search_and_open_course(page, course):
+                    continue
+                await asyncio.to_thread(remember_deep_link, host, course, page.url)
+                tree = await read_course_tree(page)
+                await asyncio.to_thread(catalog_store_course, host, course, tree)
+                crawled += 1
+            remaining = max(0, len(stale) - crawled)
+            return True, f"Indexed {crawled} course(s) of {len(courses)}; {remaining} left for the next refresh"
+    except asyncio.CancelledError:
+        return False, "Catalog refresh was cancelled by user"
+    except Exception as exc:  # noqa: BLE001
+        return False, f"Catalog refresh failed after {crawled} course(s): {exc}"
+    finally:
+        save_step_timings()
+
+
+def run_report_job(process_id: str, params: dict) -> tuple[bool, str] | None:
+    """Run one report job with checkpointed retries in the calling thread.
+
+    The caller registers active_processes[process_id]; it is removed when the job ends.
+    """
+    process_info = active_processes.get(process_id)
+    if process_info is None:
+        return False, "Job is not registered in this process"
+    try:
+        # Check if cancelled before starting
+        if process_info.get('cancelled'):
+            return False, "Report generation was cancelled by user"
+
+        process_info["deadline_s"] = job_deadline_s(params)
+        _ensure_watchdog()
+        result = None
+        for attempt in range(1, JOB_MAX_ATTEMPTS + 1):
+            process_info['attempt'] = attempt
+            emit_job_event(
+                "attempt_started", process_id, attempt=attempt,
+                resume_from=job_checkpoint(process_id).get("step"),
+            )
+            if params.get("crawl_catalog"):
+                flow = crawl_catalog(**params, process_id=process_id)
+            elif params.get("items"):
+                # Scheduled batch: several reports in one session, nothing to keep open afterwards
+                flow = run_batch_in_session(
+                    **params,
+                    process_id=process_id,
+                    resume_from=dict(job_checkpoint(process_id)),
+                )
+            else:
+                flow = open_and_login_with_playwright(
+                    **params,
+                    keep_open_ms=300000,
+                    process_id=process_id,
+                    resume_from=dict(job_checkpoint(process_id)),
+                )
+            result = browser_supervisor.submit(flow).result()
+            if process_info.get("deadline_exceeded"):
+                # Already failed by the watchdog; the flow's own result is just the interruption
+                result = False, process_info["deadline_exceeded"]
+                break
+            # Store result for debugging
+            process_info['result'] = result
+            if result[0] or process_info.get('cancelled'):
+                break
+            log.error(f"Report generation failed (attempt {attempt}/{JOB_MAX_ATTEMPTS}): {result[1]}")
+            # Only retry jobs that got past login; earlier failures are usually bad input
+            if attempt == JOB_MAX_ATTEMPTS or not job_checkpoint(process_id).get("step"):
+                break
+            backoff = JOB_RETRY_BACKOFF_S * (2 ** (attempt - 1))
+            log.info(f"Retrying from checkpoint '{job_checkpoint(process_id)['step']}' in {backoff:.0f}s...")
+            deadline = time.time() + backoff
+            while time.time() < deadline and not process_info.get('cancelled'):
+                time.sleep(0.5)
+            if process_info.get("deadline_exceeded"):
+                result = False, process_info["deadline_exceeded"]
+                break
+        return result
+    except Exception as exc:
+        error_msg = f"Thread error: {exc}"
+        log.exception(error_msg)
+        # Store error in process info
+        process_info['error'] = error_msg
+        return False, error_msg
+    finally:
+        # Remove from active processes when done
+        active_processes.pop(process_id, None)
+
+
+def submit_report_job(params: dict) -> str:
+    """Queue a report job and return its id; it starts when the fair scheduler gives it a slot.
+
+    With the worker backend the worker.py pool claims it; otherwise this process's dispatcher does.
+    """
+    job_id = enqueue_job(params)
+    if JOB_BACKEND != "worker":
+        _ensure_dispatcher()
+        _dispatch_wakeup.set()
+    return job_id
+
+
+def _run_dispatched_job(job_id: str, params: dict):
+    process_info = active_processes.get(job_id, {})
+    result = None
+    try:
+        result = run_report_job(job_id, params)
+    finally:
+        if not process_info.get("deadline_exceeded"):  # the watchdog has finished it already
+            finish_job(job_id, result, process_info.get("checkpoint"))
+        _dispatch_wakeup.set()  # a slot is free
+
+
+def _dispatch_loop():
+    """Thread backend: claim queued jobs within the caps and run each in its own thread."""
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    requeue_orphaned_jobs()
+    while True:
+        try:
+            # Cancellations requested through another web process
+            for job_id in cancel_requested_job_ids(name):
+                if job_id in active_processes and not active_processes[job_id].get("cancelled"):
+                    cancel_job(job_id)
+            # Jobs wait for the browser install; nothing is claimed before it finishes
+            if browsers_ready() and not host_memory_status()["under_pressure"]:
+                release_browser_waiting_jobs()
+                autoscale_running_limit()
+                while (claimed := claim_next_job(name)) is not None:
+                    job_id, params = claimed
+                    thread = threading.Thread(target=_run_dispatched_job, args=(job_id, params), daemon=True)
+                    active_processes[job_id] = {
+                        'thread': thread,
+                        'cancelled': False,
+                        'started_at': time.time()
+                    }
+                    thread.start()
+        except Exception as exc:  # noqa: BLE001
+            log.error(f"Job dispatcher tick failed: {exc}")
+        _dispatch_wakeup.wait(QUEUE_POLL_S)
+        _dispatch_wakeup.clear()
+
+
+def _ensure_dispatcher():
+    global _dispatcher_thread
+    if _dispatcher_thread is None:
+        _dispatcher_thread = threading.Thread(target=_dispatch_loop, name="job-dispatcher", daemon=True)
+        _dispatcher_thread.start()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def requeue_orphaned_jobs():
+    """Requeue jobs left 'running' by processes on this host that no longer exist."""
+    host = socket.gethostname()
+    for job in running_jobs():
+        worker_host, _, pid = (job["worker"] or "").rpartition(":")
+        if worker_host == host and pid.isdigit() and not _pid_alive(int(pid)):
+            log.info(f"Requeueing job {job['id']} from dead worker {job['worker']}")
+            requeue_job(job["id"])
+
+
+def _jobs_db() -> sqlite3.Connection:
+    """Open the SQLite job queue shared by the web tier and worker processes."""
+    global _jobs_db_migrated
+    SERVER_STATE_DIR.mkdir(exist_ok=True)
+    conn = sqlite3.connect(JOB_QUEUE_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if not _jobs_db_migrated:
+        _migrate_jobs_db(conn)
+        _jobs_db_migrated = True
+    return conn
+
+
+def _migrate_jobs_db(conn: sqlite3.Connection):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            worker TEXT,
+            success INTEGER,
+            message TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            checkpoint TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+        CREATE TABLE IF NOT EXISTS queue_users (
+            user_key TEXT PRIMARY KEY,
+            last_finish REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS queue_state (
+            key TEXT PRIMARY KEY,
+            value REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS portal_budgets (
+            host TEXT PRIMARY KEY,
+            scale REAL NOT NULL DEFAULT 1,
+            adjusted_at REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS portal_buckets (
+            host TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (host, kind)
+        );
+        CREATE TABLE IF NOT EXISTS job_events (
+            job_id TEXT NOT NULL,
+            slot INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            at REAL NOT NULL,
+            type TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (job_id, slot)
+        );
+        CREATE TABLE IF NOT EXISTS downloaded_files (
+            file_id TEXT PRIMARY KEY,
+            metadata TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS catalog_courses (
+            host TEXT NOT NULL,
+            course TEXT NOT NULL,
+            crawled_at REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (host, course)
+        );
+        CREATE TABLE IF NOT EXISTS catalog_items (
+            host TEXT NOT NULL,
+            course TEXT NOT NULL,
+            module TEXT NOT NULL,
+            test TEXT NOT NULL,
+            PRIMARY KEY (host, course, module, test)
+        );
+        CREATE TABLE IF NOT EXISTS deep_links (
+            host TEXT NOT NULL,
+            course TEXT NOT NULL,
+            module TEXT NOT NULL DEFAULT '',
+            url TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (host, course, module)
+        );
+        CREATE TABLE IF NOT EXISTS report_columns (
+            host TEXT PRIMARY KEY,
+            columns TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS manifests (
+            id TEXT PRIMARY KEY,
+            host TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            duplicates INTEGER NOT NULL DEFAULT 0,
+            invalid INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS manifest_rows (
+            manifest_id TEXT NOT NULL,
+            row INTEGER NOT NULL,
+            course TEXT NOT NULL,
+            module TEXT NOT NULL,
+            test TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            job_id TEXT,
+            message TEXT,
+            updated_at REAL,
+            PRIMARY KEY (manifest_id, row)
+        );
+        CREATE TABLE IF NOT EXISTS schedules (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            cron TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            offpeak INTEGER NOT NULL DEFAULT 1,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            next_run_at REAL NOT NULL,
+            last_run_at REAL,
+            last_job_id TEXT,
+            created_at REAL NOT NULL
+        );
+    """)
+    # Scheduling columns, added to queues created before fair scheduling
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+    for column, ddl in (
+        ("user_key", "TEXT NOT NULL DEFAULT ''"),
+        ("priority", "INTEGER NOT NULL DEFAULT 0"),
+        ("cost", "REAL NOT NULL DEFAULT 1"),
+        ("finish_tag", "REAL NOT NULL DEFAULT 0"),
+    ):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {ddl}")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_fair_order ON jobs (status, priority, finish_tag)")
+
+
+def job_user_key(params: dict) -> str:
+    """Who a job is scheduled for: the portal host and username it logs in with."""
+    host = urlparse(params.get("url") or "").hostname or ""
+    return f"{host}|{(params.get('username') or '').strip().casefold()}"
+
+
+def enqueue_job(params: dict, priority: int | None = None) -> str:
+    """Queue a report job and return its id.
+
+    Each job gets a weighted-fair-queuing finish tag for its user, so one user's large
+    submission queues behind other users' jobs instead of starving them. Batches and
+    catalog crawls default to bulk priority; everything else is interactive. While browsers
+    are not installed yet, the job waits as 'waiting_for_browser' until release_browser_waiting_jobs().
+    """
+    job_id = str(uuid.uuid4())
+    user_key = job_user_key(params)
+    cost = max(1, len(params.get("items") or ()))
+    if priority is None:
+        priority = PRIORITY_BULK if params.get("items") or params.get("crawl_catalog") else PRIORITY_INTERACTIVE
+    with closing(_jobs_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            state = conn.execute("SELECT value FROM queue_state WHERE key = 'virtual_time'").fetchone()
+            user = conn.execute("SELECT last_finish FROM queue_users WHERE user_key = ?", (user_key,)).fetchone()
+            finish_tag = max(state["value"] if state else 0.0, user["last_finish"] if user else 0.0) + cost
+            conn.execute(
+                "INSERT OR REPLACE INTO queue_users (user_key, last_finish) VALUES (?, ?)", (user_key, finish_tag)
+            )
+            conn.execute(
+                "INSERT INTO jobs (id, status, payload, created_at, user_key, priority, cost, finish_tag) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id, "queued" if browsers_ready() else "waiting_for_browser", json.dumps(params),
+                    time.time(), user_key, priority, cost, finish_tag,
+                ),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return job_id
+
+
+def release_browser_waiting_jobs() -> int:
+    """Queue the jobs that were waiting for the browser install; returns how many."""
+    with closing(_jobs_db()) as conn:
+        if conn.execute("SELECT 1 FROM jobs WHERE status = 'waiting_for_browser' LIMIT 1").fetchone() is None:
+            return 0
+        released = conn.execute(
+            "UPDATE jobs SET status = 'queued' WHERE status = 'waiting_for_browser'"
+        ).rowcount
+    if released:
+        log.info(f"Browsers ready, queued {released} waiting job(s)")
+    return released
+
+
+def _cpu_utilisation() -> float | None:
+    """Host CPU utilisation (0-1) since the previous call, from /proc/stat or the load average."""
+    global _cpu_sample
+    try:
+        with open("/proc/stat", encoding="ascii") as fh:
+            fields = [float(v) for v in fh.readline().split()[1:]]
+        idle, total = fields[3] + (fields[4] if len(fields) > 4 else 0), sum(fields)
+        previous, _cpu_sample = _cpu_sample, (total - idle, total)
+        if previous and total > previous[1]:
+            return (total - idle - previous[0]) / (total - previous[1])
+    except Exception:
+        pass
+    if hasattr(os, "getloadavg"):
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    return None
+
+
+def step_latency_factor() -> float:
+    """Recent step latencies relative to their baselines, across all portal hosts (1.0 = normal)."""
+    with _step_timings_lock:
+        _load_step_timings()
+        ratios = [
+            _percentile(entry["samples"][-STEP_TIMING_MIN_SAMPLES:], 50) / entry["baseline_ms"]
+            for steps in step_timings.values() for entry in steps.values()
+            if len(entry["samples"]) >= STEP_TIMING_MIN_SAMPLES and entry["baseline_ms"] > 0
+        ]
+    return _percentile(ratios, 50) if ratios else 1.0
+
+
+def running_job_limit(conn: sqlite3.Connection) -> int:
+    """Jobs allowed to run at once across all processes: the autoscaled value within the bounds."""
+    if not QUEUE_AUTOSCALE:
+        return QUEUE_MAX_RUNNING
+    row = conn.execute("SELECT value FROM queue_state WHERE key = 'max_running'").fetchone()
+    limit = int(row["value"]) if row else QUEUE_MAX_RUNNING
+    return min(max(limit, QUEUE_MIN_RUNNING), QUEUE_MAX_RUNNING)
+
+
+def autoscale_running_limit() -> int:
+    """Adapt the running-job limit to host CPU, free memory and step latencies (AIMD).
+
+    Any overload signal halves the limit; when jobs are waiting, the limit is in full use and the
+    host has headroom, it grows by one. Changes at most every QUEUE_AUTOSCALE_INTERVAL_S.
+    """
+    now = time.time()
+    with closing(_jobs_db()) as conn:
+        state = {
+            row["key"]: row["value"] for row in conn.execute(
+                "SELECT key, value FROM queue_state WHERE key IN ('max_running', 'max_running_adjusted_at')"
+            )
+        }
+        if not QUEUE_AUTOSCALE or now - state.get("max_running_adjusted_at", 0) < QUEUE_AUTOSCALE_INTERVAL_S:
+            return running_job_limit(conn)
+        cpu = _cpu_utilisation()
+        mem_available = host_memory_status()["mem_available_mb"]
+        latency = step_latency_factor()
+        overloaded = []
+        if cpu is not None and cpu >= QUEUE_CPU_HIGH:
+            overloaded.append(f"cpu {cpu:.0%}")
+        if mem_available is not None and mem_available < HOST_MIN_AVAILABLE_MB * 2:
+            overloaded.append(f"{mem_available} MB free")
+        if latency >= QUEUE_LATENCY_HIGH:
+            overloaded.append(f"step latency x{latency:.2f}")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            adjusted_at = conn.execute(
+                "SELECT value FROM queue_state WHERE key = 'max_running_adjusted_at'"
+            ).fetchone()
+            limit = running_job_limit(conn)
+            if adjusted_at is None or now - adjusted_at["value"] >= QUEUE_AUTOSCALE_INTERVAL_S:
+                running = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+                waiting = conn.execute("SELECT 1 FROM jobs WHERE status = 'queued' LIMIT 1").fetchone() is not None
+                new_limit = limit
+                if overloaded:
+                    new_limit = max(QUEUE_MIN_RUNNING, limit // 2)
+                elif (
+                    waiting and running >= limit
+                    and (cpu is None or cpu < QUEUE_CPU_LOW)
+                    and (mem_available is None or mem_available >= QUEUE_MEM_HEADROOM_MB)
+                ):
+                    new_limit = min(QUEUE_MAX_RUNNING, limit + 1)
+                if new_limit != limit:
+                    log.info(
+                        f"Running-job limit {limit} -> {new_limit} "
+                        f"({', '.join(overloaded) if overloaded else 'host has headroom'})"
+                    )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO queue_state (key, value) VALUES (?, ?)",
+                    [("max_running", new_limit), ("max_running_adjusted_at", now)],
+                )
+                limit = new_limit
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    autoscale_status.update({
+        "limit": limit,
+        "checked_at": now,
+        "cpu": round(cpu, 2) if cpu is not None else None,
+        "mem_available_mb": mem_available,
+        "step_latency_factor": round(latency, 2),
+        "overloaded": overloaded,
+    })
+    return limit
+
+
+def claim_next_job(worker: str) -> tuple[str, dict] | None:
+    """Atomically take the next job allowed by the caps; returns (job_id, params) or None.
+
+    Interactive jobs go first, then the smallest finish tag among users below QUEUE_MAX_PER_USER
+    on portal hosts below their session budget, and nothing starts while the running-job limit
+    (see autoscale_running_limit) is reached.
+    """
+    global _queue_running_jobs
+    with closing(_jobs_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            running = conn.execute(
+                "SELECT user_key, COUNT(*) AS n FROM jobs WHERE status = 'running' GROUP BY user_key"
+            ).fetchall()
+            _queue_running_jobs = sum(r["n"] for r in running)
+            if _queue_running_jobs >= running_job_limit(conn):
+                conn.execute("COMMIT")
+                return None
+            busy_users = [r["user_key"] for r in running if r["n"] >= QUEUE_MAX_PER_USER]
+            user_filter = f"AND user_key NOT IN ({','.join('?' * len(busy_users))}) " if busy_users else ""
+            busy_hosts = _hosts_at_session_cap(conn, running)
+            host_filter = (
+                f"AND substr(user_key, 1, instr(user_key, '|') - 1) NOT IN ({','.join('?' * len(busy_hosts))}) "
+                if busy_hosts else ""
+            )
+            row = conn.execute(
+                "SELECT id, payload, cost, finish_tag FROM jobs WHERE status = 'queued' AND cancel_requested = 0 "
+                f"{user_filter}{host_filter}ORDER BY priority, finish_tag, created_at LIMIT 1",
+                busy_users + busy_hosts,
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, worker = ? WHERE id = ?",
+                (time.time(), worker, row["id"]),
+            )
+            _queue_running_jobs += 1
+            # Virtual time follows the start tag of the job entering service
+            state = conn.execute("SELECT value FROM queue_state WHERE key = 'virtual_time'").fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO queue_state (key, value) VALUES ('virtual_time', ?)",
+                (max(state["value"] if state else 0.0, row["finish_tag"] - row["cost"]),),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return row["id"], json.loads(row["payload"])
+
+
+def finish_job(job_id: str, result: tuple[bool, str] | None, checkpoint: dict | None = None):
+    """Store a job's outcome and drop its credentials from the queue."""
+    global _queue_running_jobs
+    success, message = result or (False, "Job ended without a result")
+    cancelled = not success and "cancelled" in message
+    with closing(_jobs_db()) as conn:
+        row = conn.execute("SELECT payload FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        payload = json.loads(row["payload"]) if row else {}
+        payload.pop("password", None)
+        conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, success = ?, message = ?, checkpoint = ?, payload = ? "
+            "WHERE id = ?",
+            (
+                "cancelled" if cancelled else ("done" if success else "failed"),
+                time.time(), int(success), message, json.dumps(checkpoint or {}), json.dumps(payload), job_id,
+            ),
+        )
+        conn.execute(
+            "DELETE FROM job_events WHERE job_id IN (SELECT id FROM jobs WHERE finished_at < ?)",
+            (time.time() - JOB_EVENTS_RETENTION_S,),
+        )
+        _queue_running_jobs = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+    emit_job_event("job_finished", job_id, success=success, message=message)
+
+
+def emit_job_event(event_type: str, job_id: str | None = None, **data):
+    """Queue a progress event for a job's ring buffer (the current job by default).
+
+    A background thread writes it, so a job on the supervisor loop never waits for the
+    jobs.db write lock. The sequence number only grows; slot seq % JOB_EVENTS_MAX is
+    overwritten, so a job never holds more than JOB_EVENTS_MAX events however long it runs.
+    """
+    job_id = job_id or _current_job_id.get()
+    if not job_id:
+        return
+    global _job_events_queued
+    _ensure_job_event_writer()
+    with _job_events_progress:
+        _job_events_queued += 1
+    _job_event_queue.put((job_id, time.time(), event_type, json.dumps(data)))
+
+
+def _ensure_job_event_writer():
+    global _job_event_writer
+    with _job_event_writer_lock:
+        # A forked process inherits the variable but not the thread
+        if _job_event_writer is None or not _job_event_writer.is_alive():
+            _job_event_writer = threading.Thread(target=_write_job_events, name="job-events", daemon=True)
+            _job_event_writer.start()
+
+
+def flush_job_events(timeout_s: float = 2.0) -> bool:
+    """Wait (at most `timeout_s`) until the events this process queued before the call are written.
+
+    Only for callers that must read their own events back, e.g. at exit or after a benchmark run;
+    the status endpoints read without it and may be one batch behind.
+    """
+    with _job_events_progress:
+        target = _job_events_queued
+        return _job_events_progress.wait_for(lambda: _job_events_written >= target, timeout_s)
+
+
+atexit.register(flush_job_events)
+
+
+def _write_job_events():
+    global _job_events_written
+    while True:
+        batch = [_job_event_queue.get()]
+        while len(batch) < JOB_EVENTS_MAX:
+            try:
+                batch.append(_job_event_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _store_job_events(batch)
+        except sqlite3.Error as exc:
+            # Progress reporting must never fail a job
+            log.warning(f"Could not record {len(batch)} job event(s): {exc}")
+        finally:
+            with _job_events_progress:
+                _job_events_written += len(batch)
+                _job_events_progress.notify_all()
+
+
+def _store_job_events(batch: list[tuple]):
+    """Append queued (job_id, at, type, data) events in one transaction."""
+    with closing(_jobs_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            next_seq: dict[str, int] = {}
+            for job_id, at, event_type, data in batch:
+                if job_id not in next_seq:
+                    next_seq[job_id] = conn.execute(
+                        "SELECT COALESCE(MAX(seq), 0) + 1 FROM job_events WHERE job_id = ?", (job_id,)
+                    ).fetchone()[0]
+                seq = next_seq[job_id]
+                next_seq[job_id] += 1
+                conn.execute(
+                    "INSERT OR REPLACE INTO job_events (job_id, slot, seq, at, type, data) VALUES (?, ?, ?, ?, ?, ?)",
+                    (job_id, seq % JOB_EVENTS_MAX, seq, at, event_type, data),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def job_events(job_id: str, since: int = 0, limit: int = JOB_EVENTS_MAX) -> dict:
+    """Events with seq > `since`, oldest first; `dropped` counts events already overwritten."""
+    with closing(_jobs_db()) as conn:
+        rows = conn.execute(
+            "SELECT seq, at, type, data FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (job_id, since, limit),
+        ).fetchall()
+    events = [{"seq": r["seq"], "at": r["at"], "type": r["type"], **json.loads(r["data"])} for r in rows]
+    return {
+        "events": events,
+        "next": events[-1]["seq"] if events else since,
+        "dropped": max(0, events[0]["seq"] - since - 1) if events else 0,
+    }
+
+
+def latest_job_event(job_id: str) -> dict | None:
+    with closing(_jobs_db()) as conn:
+        row = conn.execute(
+            "SELECT seq, at, type, data FROM job_events WHERE job_id = ? ORDER BY seq DESC LIMIT 1", (job_id,)
+        ).fetchone()
+    return {"seq": row["seq"], "at": row["at"], "type": row["type"], **json.loads(row["data"])} if row else None
+
+
+def requeue_job(job_id: str):
+    """Put a job that was interrupted by a worker shutdown back in the queue."""
+    with closing(_jobs_db()) as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', started_at = NULL, worker = NULL "
+            "WHERE id = ? AND status = 'running' AND cancel_requested = 0",
+            (job_id,),
+        )
+
+
+def running_jobs() -> list[dict]:
+    """Jobs currently marked running, with the worker that claimed them."""
+    with closing(_jobs_db()) as conn:
+        rows = conn.execute("SELECT id, worker, started_at FROM jobs WHERE status = 'running'").fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_job(job_id: str) -> dict | None:
+    """Return a queued job's status row (without its payload)."""
+    with closing(_jobs_db()) as conn:
+        row = conn.execute(
+            "SELECT id, status, created_at, started_at, finished_at, worker, success, message, "
+            "cancel_requested, checkpoint FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def request_job_cancel(job_id: str) -> bool:
+    """Flag a queued/running job as cancelled; the worker running it picks this up."""
+    with closing(_jobs_db()) as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'cancelled', finished_at = ? "
+            "WHERE id = ? AND status IN ('queued', 'waiting_for_browser')",
+            (time.time(), job_id),
+        )
+        updated = conn.execute(
+            "UPDATE jobs SET cancel_requested = 1 "
+            "WHERE id = ? AND status IN ('queued', 'waiting_for_browser', 'running', 'cancelled')",
+            (job_id,),
+        ).rowcount
+    return bool(updated)
+
+
+def active_job_ids() -> list[str]:
+    """Ids of waiting, queued or running jobs in the worker queue, newest first."""
+    with closing(_jobs_db()) as conn:
+        rows = conn.execute(
+            "SELECT id FROM jobs WHERE status IN ('waiting_for_browser', 'queued', 'running') ORDER BY created_at DESC"
+        ).fetchall()
+    return [row["id"] for row in rows]
+
+
+def queue_position(job_id: str) -> dict | None:
+    """Position and estimated start of a queued job (None once it has left the queue)."""
+    with closing(_jobs_db()) as conn:
+        job = conn.execute(
+            "SELECT status, user_key, priority, finish_tag, created_at FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if job is None or job["status"] != "queued":
+            return None
+        ahead_rows = conn.execute(
+            "SELECT user_key FROM jobs WHERE status = 'queued' AND cancel_requested = 0 AND id != ? AND "
+            "(priority < ? OR (priority = ? AND (finish_tag < ? OR (finish_tag = ? AND created_at < ?))))",
+            (job_id, job["priority"], job["priority"], job["finish_tag"], job["finish_tag"], job["created_at"]),
+        ).fetchall()
+        running_rows = conn.execute("SELECT user_key FROM jobs WHERE status = 'running'").fetchall()
+        limit = running_job_limit(conn)
+        durations = [
+            row[0] for row in conn.execute(
+                "SELECT finished_at - started_at FROM jobs WHERE status = 'done' AND started_at IS NOT NULL "
+                "ORDER BY finished_at DESC LIMIT 20"
+            )
+        ]
+    average_s = sum(durations) / len(durations) if durations else QUEUE_DEFAULT_JOB_S
+    ahead, running = len(ahead_rows), len(running_rows)
+    own = sum(row["user_key"] == job["user_key"] for row in ahead_rows + running_rows)
+    # Jobs ahead (and running) drain `limit` at a time, the user's own QUEUE_MAX_PER_USER at a time
+    waves = max(
+        math.ceil(max(0, ahead + running + 1 - limit) / limit),
+        math.ceil(max(0, own + 1 - QUEUE_MAX_PER_USER) / QUEUE_MAX_PER_USER),
+    )
+    eta_s = waves * average_s
+    return {
+        "position": ahead + 1,
+        "running": running,
+        "eta_s": round(eta_s),
+        "estimated_start": time.time() + eta_s,
+    }
+
+
+def cancel_requested_job_ids(worker: str) -> list[str]:
+    """Running jobs claimed by `worker` whose cancellation was requested."""
+    with closing(_jobs_db()) as conn:
+        rows = conn.execute(
+            "SELECT id FROM jobs WHERE status = 'running' AND cancel_requested = 1 AND worker = ?", (worker,)
+        ).fetchall()
+    return [row["id"] for row in rows]
+
+
+def cancel_report_job(job_id: str) -> bool:
+    """Cancel a queued or running job, stopping it right away if it runs in this process."""
+    requested = request_job_cancel(job_id)
+    if job_id in active_processes:
+        return cancel_job(job_id) or requested
+    return requested
+
+
+def job_cancel_requested(job_id: str) -> bool:
+    with closing(_jobs_db()) as conn:
+        row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return bool(row and row["cancel_requested"])
+
+
+def publish_downloaded_file(file_id: str):
+    """Make a downloaded file visible to every web process, whichever process or worker downloaded it."""
+    with closing(_jobs_db()) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO downloaded_files (file_id, metadata, created_at) VALUES (?, ?, ?)",
+            (file_id, json.dumps(file_metadata[file_id]), time.time()),
+        )
+
+
+def sync_downloaded_files():
+    """Pull files registered by other processes into this process's file_metadata."""
+    global _files_synced_at
+    with closing(_jobs_db()) as conn:
+        rows = conn.execute(
+            "SELECT file_id, metadata, created_at FROM downloaded_files WHERE created_at > ? ORDER BY created_at",
+            (_files_synced_at,),
+        ).fetchall()
+    for row in rows:
+        file_metadata.setdefault(row["file_id"], json.loads(row["metadata"]))
+        _files_synced_at = max(_files_synced_at, row["created_at"])
+
+
+def _portal_budget_scale(conn: sqlite3.Connection, host: str) -> float:
+    row = conn.execute("SELECT scale FROM portal_budgets WHERE host = ?", (host,)).fetchone()
+    return row["scale"] if row else 1.0
+
+
+def portal_session_cap(conn: sqlite3.Connection, host: str) -> int:
+    """Jobs allowed to run at once against `host` (0 = unlimited), scaled down while it is slow."""
+    if PORTAL_MAX_SESSIONS <= 0:
+        return 0
+    return max(1, int(PORTAL_MAX_SESSIONS * _portal_budget_scale(conn, host)))
+
+
+def _hosts_at_session_cap(conn: sqlite3.Connection, running: list[sqlite3.Row]) -> list[str]:
+    """Portal hosts whose running jobs (grouped by user_key) already use their session budget."""
+    per_host: dict[str, int] = {}
+    for row in running:
+        host = row["user_key"].split("|", 1)[0]
+        per_host[host] = per_host.get(host, 0) + row["n"]
+    return [
+        host for host, n in per_host.items()
+        if host and portal_session_cap(conn, host) and n >= portal_session_cap(conn, host)
+    ]
+
+
+def adjust_portal_budget(host: str, speed_factor: float) -> float:
+    """Adapt a host's budgets to its latency: halve them while it is slow, regrow them slowly.
+
+    Returns the new scale applied to the session cap and the per-minute rates.
+    """
+    now = time.time()
+    with closing(_jobs_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT scale, adjusted_at FROM portal_budgets WHERE host = ?", (host,)).fetchone()
+            scale = row["scale"] if row else 1.0
+            if not row or now - row["adjusted_at"] >= PORTAL_ADJUST_INTERVAL_S:
+                if speed_factor >= PORTAL_SLOW_FACTOR:
+                    new_scale = max(PORTAL_MIN_BUDGET, scale * 0.5)
+                elif speed_factor <= 1.1:
+                    new_scale = min(1.0, scale + 0.1)
+                else:
+                    new_scale = scale
+                if new_scale != scale:
+                    log.info(f"Portal budget for {host}: {scale:.2f} -> {new_scale:.2f} (speed factor {speed_factor:.2f})")
+                conn.execute(
+                    "INSERT OR REPLACE INTO portal_budgets (host, scale, adjusted_at) VALUES (?, ?, ?)",
+                    (host, new_scale, now),
+                )
+                scale = new_scale
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return scale
+
+
+def take_portal_token(host: str, kind: str) -> float:
+    """Take one token from the host's `kind` bucket; returns 0, or the seconds until one is available."""
+    now = time.time()
+    with closing(_jobs_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            per_min = PORTAL_RATE_LIMITS[kind] * _portal_budget_scale(conn, host)
+            rate, capacity = per_min / 60, max(1.0, per_min)
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM portal_buckets WHERE host = ? AND kind = ?", (host, kind)
+            ).fetchone()
+            tokens = capacity if row is None else min(capacity, row["tokens"] + (now - row["updated_at"]) * rate)
+            wait_s = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait_s = (1 - tokens) / rate
+            conn.execute(
+                "INSERT OR REPLACE INTO portal_buckets (host, kind, tokens, updated_at) VALUES (?, ?, ?, ?)",
+                (host, kind, tokens, now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return wait_s
+
+
+async def acquire_portal_slot(kind: str):
+    """Wait for a `kind` ("login" or "export") token for the current portal host.
+
+    Gives up waiting after PORTAL_LIMIT_MAX_WAIT_S and proceeds, so a misconfigured limit
+    slows jobs down instead of failing them.
+    """
+    host = _portal_host.get()
+    if not host or PORTAL_RATE_LIMITS.get(kind, 0) <= 0:
+        return
+    # The buckets live in jobs.db; its write lock must not stall the other jobs on this loop
+    await asyncio.to_thread(adjust_portal_budget, host, portal_speed_factor())
+    note_progress(PORTAL_LIMIT_MAX_WAIT_S + STEP_DEADLINE_GRACE_S, wait=f"portal_{kind}_slot")
+    deadline = time.monotonic() + PORTAL_LIMIT_MAX_WAIT_S
+    while True:
+        wait_s = await asyncio.to_thread(take_portal_token, host, kind)
+        if wait_s <= 0:
+            return
+        if time.monotonic() + wait_s > deadline:
+            log.warning(f"Waited {PORTAL_LIMIT_MAX_WAIT_S:.0f}s for a {kind} slot on {host}, proceeding")
+            return
+        log.info(f"{kind.capitalize()} budget for {host} used up, waiting {wait_s:.1f}s")
+        check_cancelled()
+        await asyncio.sleep(wait_s)
+
+
+def portal_budgets() -> dict:
+    """Current per-host budgets for /api/portal-budgets."""
+    with closing(_jobs_db()) as conn:
+        hosts = {row["host"]: {"scale": row["scale"]} for row in conn.execute("SELECT host, scale FROM portal_budgets")}
+        for row in conn.execute(
+            "SELECT substr(user_key, 1, instr(user_key, '|') - 1) AS host, COUNT(*) AS n FROM jobs "
+            "WHERE status = 'running' GROUP BY host"
+        ):
+            hosts.setdefault(row["host"], {"scale": 1.0})["sessions"] = row["n"]
+        for host, entry in hosts.items():
+            entry.setdefault("sessions", 0)
+            entry["max_sessions"] = portal_session_cap(conn, host)
+            entry["per_min"] = {kind: round(limit * entry["scale"], 2) for kind, limit in PORTAL_RATE_LIMITS.items()}
+    return hosts
+
+
+CRON_FIELDS = (("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 6))
+
+
+def parse_cron(expr: str) -> list[set[int]]:
+    """Parse a 5-field cron expression (minute hour day month weekday) into allowed values.
+
+    Supports *, lists, ranges and steps (e.g. "*/15", "1-5", "0,30"). Weekday 0 and 7 are Sunday.
+    Raises ValueError for malformed expressions.
+    """
+    parts = expr.split()
+    if len(parts) != len(CRON_FIELDS):
+        raise ValueError("cron expression needs 5 fields: minute hour day month weekday")
+    fields = []
+    for part, (name, low, high) in zip(parts, CRON_FIELDS):
+        values: set[int] = set()
+        for chunk in part.split(","):
+            spec, _, step_text = chunk.partition("/")
+            step = int(step_text) if step_text else 1
+            if spec == "*":
+                start, end = low, high
+            elif "-" in spec:
+                start, end = (int(v) for v in spec.split("-", 1))
+            else:
+                start = end = int(spec)
+            if name == "weekday":
+                end = min(end, 7)
+            if step < 1 or start < low or end > (7 if name == "weekday" else high) or start > end:
+                raise ValueError(f"invalid {name} field: {part}")
+            values.update(v % 7 if name == "weekday" else v for v in range(start, end + 1, step))
+        fields.append(values)
+    return fields
+
+
+def cron_next(expr: str, after: datetime) -> datetime:
+    """First time strictly after `after` (minute resolution) matching the cron expression."""
+    minutes, hours, days, months, weekdays = parse_cron(expr)
+    day_any = len(days) == 31
+    weekday_any = len(weekdays) == 7
+    candidate = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = candidate + timedelta(days=366 * 4)
+    while candidate < limit:
+        cron_weekday = (candidate.weekday() + 1) % 7  # cron counts from Sunday
+        if day_any or weekday_any:
+            day_ok = candidate.day in days and cron_weekday in weekdays
+        else:
+            # Classic cron: when both are restricted, either one matching is enough
+            day_ok = candidate.day in days or cron_weekday in weekdays
+        if candidate.month not in months or not day_ok:
+            candidate = (candidate + timedelta(days=1)).replace(hour=0, minute=0)
+        elif candidate.hour not in hours:
+            candidate = (candidate + timedelta(hours=1)).replace(minute=0)
+        elif candidate.minute not in minutes:
+            candidate += timedelta(minutes=1)
+        else:
+            return candidate
+    raise ValueError(f"cron expression never matches: {expr}")
+
+
+def in_offpeak_window(now: datetime | None = None) -> bool:
+    """Whether `now` falls inside SCHEDULE_OFFPEAK_WINDOW ("HH:MM-HH:MM", may wrap midnight)."""
+    now = now or datetime.now()
+    try:
+        start_text, end_text = SCHEDULE_OFFPEAK_WINDOW.split("-", 1)
+        start = datetime.strptime(start_text.strip(), "%H:%M").time()
+        end = datetime.strptime(end_text.strip(), "%H:%M").time()
+    except ValueError:
+        return True  # misconfigured window: don't hold schedules back forever
+    current = now.time()
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+
+def _credential_cipher():
+    """Fernet cipher for stored portal passwords, keyed by CREDENTIAL_KEY or the generated key file."""
+    global _credential_cipher_cache
+    if _credential_cipher_cache is None:
+        from cryptography.fernet import Fernet  # type: ignore[reportMissingImports]
+        secret = CREDENTIAL_KEY.encode()
+        if not secret:
+            SERVER_STATE_DIR.mkdir(exist_ok=True)
+            try:
+                fd = os.open(CREDENTIAL_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:
+                secret = CREDENTIAL_KEY_FILE.read_bytes().strip()
+            else:
+                log.warning(f"CREDENTIAL_KEY is not set; schedule passwords are encrypted with {CREDENTIAL_KEY_FILE}")
+                secret = Fernet.generate_key()
+                with os.fdopen(fd, "wb") as key_file:
+                    key_file.write(secret)
+        # Any string works as CREDENTIAL_KEY; Fernet wants 32 url-safe base64 bytes
+        _credential_cipher_cache = Fernet(base64.urlsafe_b64encode(hashlib.sha256(secret).digest()))
+    return _credential_cipher_cache
+
+
+def encrypt_credential(secret: str) -> str:
+    return _credential_cipher().encrypt(secret.encode()).decode()
+
+
+def decrypt_credential(token: str) -> str:
+    return _credential_cipher().decrypt(token.encode()).decode()
+
+
+def _stored_schedule_payload(params: dict) -> str:
+    """A schedule's params as stored: the password only in encrypted form."""
+    stored = {key: value for key, value in params.items() if key != "password"}
+    stored["password_enc"] = encrypt_credential(params.get("password") or "")
+    return json.dumps(stored)
+
+
+def _schedule_params(row: sqlite3.Row) -> dict:
+    """A stored schedule's params with its password decrypted (or plaintext, from before encryption)."""
+    params = json.loads(row["payload"])
+    token = params.pop("password_enc", None)
+    if token is not None:
+        params["password"] = decrypt_credential(token)
+    return params
+
+
+def protect_schedule_credentials() -> int:
+    """Encrypt the plaintext passwords of schedules created before encryption; returns how many."""
+    protected = 0
+    with closing(_jobs_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row in conn.execute("SELECT id, payload FROM schedules").fetchall():
+                params = json.loads(row["payload"])
+                if "password" in params:
+                    conn.execute(
+                        "UPDATE schedules SET payload = ? WHERE id = ?", (_stored_schedule_payload(params), row["id"])
+                    )
+                    protected += 1
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    if protected:
+        log.info(f"Encrypted the stored password of {protected} schedule(s)")
+    return protected
+
+
+def update_schedule_password(url: str, username: str, password: str) -> int:
+    """Replace the stored password of every schedule for this portal user; returns how many changed."""
+    user_key = job_user_key({"url": url, "username": username})
+    updated = 0
+    with closing(_jobs_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row in conn.execute("SELECT id, payload FROM schedules").fetchall():
+                params = json.loads(row["payload"])
+                if job_user_key(params) == user_key:
+                    params["password"] = password
+                    conn.execute(
+                        "UPDATE schedules SET payload = ? WHERE id = ?", (_stored_schedule_payload(params), row["id"])
+                    )
+                    updated += 1
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return updated
+
+
+def create_schedule(name: str, cron: str, params: dict, offpeak: bool = True) -> dict:
+    """Store a recurring report schedule; raises ValueError for a bad cron expression.
+
+    The portal password is stored encrypted (see _credential_cipher), never in plaintext.
+    """
+    next_run = cron_next(cron, datetime.now())
+    schedule_id = str(uuid.uuid4())
+    with closing(_jobs_db()) as conn:
+        conn.execute(
+            "INSERT INTO schedules (id, name, cron, payload, offpeak, enabled, next_run_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?, 1, ?, ?)",
+            (schedule_id, name, cron, _stored_schedule_payload(params), int(offpeak), next_run.timestamp(), time.time()),
+        )
+    return get_schedule(schedule_id)
+
+
+def get_schedule(schedule_id: str) -> dict | None:
+    """Return a schedule without its stored password."""
+    with closing(_jobs_db()) as conn:
+        row = conn.execute("SELECT * FROM schedules WHERE id = ?", (schedule_id,)).fetchone()
+    return _public_schedule(row) if row else None
+
+
+def list_schedules() -> list[dict]:
+    with closing(_jobs_db()) as conn:
+        rows = conn.execute("SELECT * FROM schedules ORDER BY next_run_at").fetchall()
+    return [_public_schedule(row) for row in rows]
+
+
+def delete_schedule(schedule_id: str) -> bool:
+    with closing(_jobs_db()) as conn:
+        return bool(conn.execute("DELETE FROM schedules WHERE id = ?", (schedule_id,)).rowcount)
+
+
+def _public_schedule(row: sqlite3.Row) -> dict:
+    schedule = dict(row)
+    payload = json.loads(schedule.pop("payload"))
+    payload.pop("password", None)
+    payload.pop("password_enc", None)
+    schedule.update(params=payload, offpeak=bool(schedule["offpeak"]), enabled=bool(schedule["enabled"]))
+    return schedule
+
+
+def dispatch_due_schedules(now: datetime | None = None, force_ids: list[str] | None = None) -> list[str]:
+    """Submit due schedules as batch jobs, one per (portal, user), and advance their next run.
+
+    Off-peak schedules that fall due outside the window stay due until it opens.
+    `force_ids` runs the given schedules immediately regardless of time and window.
+    """
+    now = now or datetime.now()
+    offpeak_open = in_offpeak_window(now)
+    with closing(_jobs_db()) as conn:
+        if force_ids:
+            marks = ",".join("?" * len(force_ids))
+            rows = conn.execute(f"SELECT * FROM schedules WHERE id IN ({marks})", force_ids).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT * FROM schedules WHERE enabled = 1 AND next_run_at <= ? ORDER BY next_run_at",
+                (now.timestamp(),),
+            ).fetchall()
+            rows = [row for row in rows if offpeak_open or not row["offpeak"]]
+        if not rows:
+            return []
+
+        # Group by portal host and user so each group needs a single login
+        groups: dict[tuple[str, str, str], list[sqlite3.Row]] = {}
+        for row in rows:
+            try:
+                params = _schedule_params(row)
+            except Exception as exc:  # noqa: BLE001
+                # e.g. CREDENTIAL_KEY changed; the schedule waits until its password is re-entered
+                log.error(f"Cannot read the stored password of schedule {row['id']}: {type(exc).__name__}")
+                continue
+            key = (urlparse(params["url"]).hostname or params["url"], params["username"], params["password"])
+            groups.setdefault(key, []).append(row)
+
+        job_ids = []
+        for group in groups.values():
+            first = _schedule_params(group[0])
+            items = []
+            for row in group:
+                params = json.loads(row["payload"])
+                items.append({key: params.get(key, "") for key in ("course", "module", "test", "filename_choice")})
+            job_id = submit_report_job({
+                "url": first["url"],
+                "username": first["username"],
+                "password": first["password"],
+                "items": items,
+                "schedule_ids": [row["id"] for row in group],
+            })
+            job_ids.append(job_id)
+            log.info(f"Scheduled batch {job_id} started with {len(items)} report(s) for {first['url']}")
+            for row in group:
+                next_run = cron_next(row["cron"], now)
+                conn.execute(
+                    "UPDATE schedules SET last_run_at = ?, last_job_id = ?, next_run_at = ? WHERE id = ?",
+                    (now.timestamp(), job_id, next_run.timestamp(), row["id"]),
+                )
+    return job_ids
+
+
+def catalog_sync_courses(host: str, courses: list[str], complete: bool = True) -> dict[str, float]:
+    """Record the portal's current course list; returns course -> crawled_at.
+
+    Vanished courses are dropped only when `complete` says the whole list was read.
+    """
+    with closing(_jobs_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            known = {
+                row["course"]: row["crawled_at"]
+                for row in conn.execute("SELECT course, crawled_at FROM catalog_courses WHERE host = ?", (host,))
+            }
+            conn.executemany(
+                "INSERT OR IGNORE INTO catalog_courses (host, course) VALUES (?, ?)",
+                [(host, course) for course in courses],
+            )
+            if complete:
+                vanished = [(host, course) for course in set(known) - set(courses)]
+                conn.executemany("DELETE FROM catalog_courses WHERE host = ? AND course = ?", vanished)
+                conn.executemany("DELETE FROM catalog_items WHERE host = ? AND course = ?", vanished)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return known
+
+
+def catalog_store_course(host: str, course: str, tree: dict[str, list[str]]):
+    """Replace a course's modules and tests with a freshly crawled tree."""
+    rows = [(host, course, module, test) for module, tests in tree.items() for test in (tests or [""])]
+    with closing(_jobs_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM catalog_items WHERE host = ? AND course = ?", (host, course))
+            conn.executemany("INSERT OR IGNORE INTO catalog_items VALUES (?, ?, ?, ?)", rows)
+            conn.execute(
+                "INSERT OR REPLACE INTO catalog_courses (host, course, crawled_at) VALUES (?, ?, ?)",
+                (host, course, time.time()),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def catalog_store_module(host: str, course: str, module: str, tests: list[str]):
+    """Refresh one module's tests, as seen by a report job, for a course already in the catalog."""
+    with closing(_jobs_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            # Try to find by input value="excel"
-            excel_input = page.locator('input[type="radio"][name="downloadFileType"][value="excel"]')
-            await excel_input.wait_for(state="visible", timeout=5000)
-            await excel_input.click()
-            excel_option_clicked = True
+            conn.execute(
+                "DELETE FROM catalog_items WHERE host = ? AND course = ? AND module = ?", (host, course, module)
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO catalog_items VALUES (?, ?, ?, ?)",
+                [(host, course, module, test) for test in (tests or [""])],
+            )
+            conn.execute("COMMIT")
         except Exception:
-            try:
-                # Try to find p-radiobutton with label="Excel (.xlsx)"
-                excel_radio = page.locator('p-radiobutton[label="Excel (.xlsx)"]').first
-                await excel_radio.wait_for(state="visible", timeout=5000)
-                await excel_radio.click()
-                excel_option_clicked = True
-            except Exception:
-                # Fallback: find span inside p-radiobutton with Excel label
-                excel_span = page.locator('p-radiobutton:has(label:has-text("Excel")) span.ui-radiobutton-icon').first
-                await excel_span.wait_for(state="visible", timeout=5000)
-                await excel_span.click()
-                excel_option_clicked = True
+            conn.execute("ROLLBACK")
+            raise
 
-    download_button = page.locator("button.download-button").first
-    await download_button.wait_for(state="visible", timeout=5000)
-    try:
-        async with page.expect_download() as download_info:
-            await download_button.click()
-        download = await download_info.value
-        suggested_name = download.suggested_filename
-        extension = Path(suggested_name).suffix or ".xlsx"
-        # Create unique filename with timestamp
-        timestamp = int(time.time())
-        if sanitized_filename:
-            unique_filename = f"{timestamp}_{sanitized_filename}{extension}"
-            # Use sanitized filename (based on user's choice) as the download name
-            download_filename = f"{sanitized_filename}{extension}"
-        else:
-            base_name = Path(suggested_name).stem
-            unique_filename = f"{timestamp}_{base_name}{extension}"
-            download_filename = suggested_name
-        target_path = download_dir / unique_filename
-        await download.save_as(str(target_path))
-        print(f"INFO: File downloaded successfully: {download_filename} (saved as {unique_filename})")
-        
-        # Register the file with the correct filename based on user's choice
-        register_downloaded_file(
-            target_path,
-            download_filename,  # Use the filename based on user's choice
-            course_query or "",
-            test_query or ""
+
+def _catalog_candidates(conn, host: str, field: str, course: str = "", module: str = "") -> list[str]:
+    if field == "course":
+        rows = conn.execute("SELECT course FROM catalog_courses WHERE host = ?", (host,))
+    elif field == "module":
+        sql = "SELECT DISTINCT module FROM catalog_items WHERE host = ?"
+        args: list[str] = [host]
+        if course:
+            sql += " AND course = ? COLLATE NOCASE"
+            args.append(course)
+        rows = conn.execute(sql, args)
+    else:
+        sql = "SELECT DISTINCT test FROM catalog_items WHERE host = ? AND test != ''"
+        args = [host]
+        if course:
+            sql += " AND course = ? COLLATE NOCASE"
+            args.append(course)
+        if module:
+            sql += " AND module = ? COLLATE NOCASE"
+            args.append(module)
+        rows = conn.execute(sql, args)
+    return [row[0] for row in rows]
+
+
+def catalog_suggest(host: str, field: str, query: str, course: str = "", module: str = "", limit: int = 20) -> list[str]:
+    """Catalog names for autocomplete: prefix matches first, then substring matches."""
+    needle = " ".join(query.split()).casefold()
+    with closing(_jobs_db()) as conn:
+        names = _catalog_candidates(conn, host, field, course, module)
+    prefix = sorted(name for name in names if name.casefold().startswith(needle))
+    contains = sorted(name for name in names if needle in name.casefold() and not name.casefold().startswith(needle))
+    return (prefix + contains)[:limit]
+
+
+def catalog_canonical(host: str, field: str, name: str | None, course: str = "", module: str = "") -> str | None:
+    """The catalog's exact spelling of `name` (case/whitespace-insensitive), or None if unknown."""
+    needle = " ".join((name or "").split()).casefold()
+    if not host or not needle:
+        return None
+    with closing(_jobs_db()) as conn:
+        names = _catalog_candidates(conn, host, field, course, module)
+    return next((candidate for candidate in names if candidate.casefold() == needle), None)
+
+
+def _link_key(name: str | None) -> str:
+    return " ".join((name or "").split()).casefold()
+
+
+def deep_link(host: str, course: str | None, module: str | None = None) -> str | None:
+    """Learned URL of the course page (or of the module within it, when known), or None."""
+    course_key = _link_key(course)
+    if not host or not course_key:
+        return None
+    with closing(_jobs_db()) as conn:
+        rows = conn.execute(
+            "SELECT module, url FROM deep_links WHERE host = ? AND course = ? AND module IN ('', ?)",
+            (host, course_key, _link_key(module)),
+        ).fetchall()
+    links = {row["module"]: row["url"] for row in rows}
+    return links.get(_link_key(module)) or links.get("")
+
+
+def remember_deep_link(host: str, course: str | None, url: str, module: str | None = None):
+    """Store the address a job reached for a course (or module) so later jobs can go there directly.
+
+    JSF postback navigation often leaves one shared view URL for every course. Such a URL (the
+    Courses tool's own, or one already learned for another course) is not stored, and the other
+    course's copy is dropped too.
+    """
+    course_key = _link_key(course)
+    if not host or not course_key or not url.startswith("http"):
+        return
+    if url == _courses_tool_urls.get(host):
+        return
+    with closing(_jobs_db()) as conn:
+        shared = conn.execute(
+            "DELETE FROM deep_links WHERE host = ? AND url = ? AND course != ?", (host, url, course_key)
+        ).rowcount
+        if shared:
+            log.info(f"{url} is shared by several courses; not using it as a deep link")
+            return
+        conn.execute(
+            "INSERT OR REPLACE INTO deep_links (host, course, module, url, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (host, course_key, _link_key(module), url, time.time()),
         )
-        print(f"INFO: File registered in system: {download_filename}")
-    except Exception:
-        await download_button.click()
 
 
-async def open_and_login_with_playwright(
-    url: str,
-    username: str,
-    password: str,
-    course_query: str | None = None,
-    module_query: str | None = None,
-    test_query: str | None = None,
-    filename_choice: str = "test",
-    report_type: str = "performance",
-    keep_open_ms: int = 300000,
-    process_id: str | None = None,
-    campus: str = "",
-    batch: str = "",
-) -> tuple[bool, str]:
-    try:
-        from playwright.async_api import async_playwright  # type: ignore[reportMissingImports]
-    except Exception as exc:  # noqa: BLE001
-        return False, f"Playwright not installed: {exc}"
+def forget_deep_link(host: str, course: str | None):
+    """Drop a course's links after one of them turned out to be stale."""
+    with closing(_jobs_db()) as conn:
+        conn.execute("DELETE FROM deep_links WHERE host = ? AND course = ?", (host, _link_key(course)))
 
-    try:
-        async with async_playwright() as p:
-            # Determine if we should run in headless mode
-            # On Render/cloud servers, there's no display, so we must use headless mode
-            # Check for explicit HEADLESS env var, or detect server environment
-            explicit_headless = os.environ.get("HEADLESS", "").lower() == "true"
-            
-            # Detect if we're on a server (headless environment)
-            # Windows/Mac should use visible browser unless explicitly set to headless
-            system = platform.system()
-            is_server = False
-            
-            if explicit_headless:
-                # Explicitly requested headless mode
-                is_server = True
-            elif os.environ.get("RENDER") is not None:
-                # Render.com environment
-                is_server = True
-            elif system == "Linux" and os.environ.get("DISPLAY") is None:
-                # Linux server without X11 display
-                is_server = True
-            # Windows and macOS should use visible browser by default
-            # (DISPLAY check doesn't apply to Windows/Mac)
-            
-            is_headless = is_server
-            
-            # Debug output
-            print(f"DEBUG: Platform: {system}, Headless: {is_headless}, RENDER: {os.environ.get('RENDER')}, HEADLESS: {os.environ.get('HEADLESS')}")
-            
-            # Prefer the user's installed Google Chrome; fallback to bundled Chromium
-            browser = None
-            
-            # On headless servers, use bundled Chromium (system Chrome may not be available)
-            if not is_headless:
-                # Try to use system Chrome first (visible browser)
-                try:
-                    print("DEBUG: Attempting to launch system Chrome...")
-                    browser = await p.chromium.launch(
-                        channel="chrome",
-                        headless=False,
-                        args=['--start-maximized'] if system == "Windows" else []
-                    )
-                    print("DEBUG: System Chrome launched successfully!")
-                except Exception as chrome_exc:
-                    print(f"DEBUG: System Chrome launch failed: {chrome_exc}, trying bundled Chromium...")
-                    # Fallback to bundled Chromium if system Chrome not available
-                    try:
-                        browser = await p.chromium.launch(
-                            headless=False,
-                            args=['--start-maximized'] if system == "Windows" else []
-                        )
-                        print("DEBUG: Bundled Chromium launched successfully!")
-                    except Exception as chromium_exc:
-                        error_msg = f"Failed to launch browser: {chromium_exc}. Make sure Playwright is installed: 'pip install playwright' and 'python -m playwright install chromium'"
-                        print(f"ERROR: {error_msg}")  # Debug output
-                        return False, error_msg
-            else:
-                # On headless servers, try Chrome first, fall back to Chromium
-                try:
-                    print("DEBUG: Attempting to launch Chrome in headless mode...")
-                    try:
-                        browser = await p.chromium.launch(
-                            channel="chrome",
-                            headless=True,
-                            args=['--no-sandbox', '--disable-setuid-sandbox']  # Required for some Linux servers
-                        )
-                        print("DEBUG: Chrome launched successfully in headless mode!")
-                    except Exception:
-                        # Chrome not available, use Chromium
-                        print("DEBUG: Chrome not available, using Chromium...")
-                        browser = await p.chromium.launch(
-                            headless=True,
-                            args=['--no-sandbox', '--disable-setuid-sandbox']  # Required for some Linux servers
-                        )
-                        print("DEBUG: Chromium launched successfully in headless mode!")
-                except Exception as headless_exc:
-                    error_msg = f"Failed to launch browser: {headless_exc}. Please ensure browsers are installed via 'python -m playwright install chrome' or 'python -m playwright install chromium-headless-shell'."
-                    print(f"ERROR: {error_msg}")  # Debug output
-                    return False, error_msg
-            
-            # Store browser reference for cancellation
-            if process_id and process_id in active_processes:
-                active_processes[process_id]['browser'] = browser
-            
-            download_dir = get_server_downloads_dir()
-            try:
-                download_dir.mkdir(parents=True, exist_ok=True)
-            except Exception:
-                pass
 
-            context = await browser.new_context(accept_downloads=True)
-            page = await context.new_page()
-            
-            # Navigate and wait for redirects to complete
-            print(f"INFO: Navigating to URL: {url}")
-            await page.goto(url, wait_until="domcontentloaded")
-            await page.wait_for_load_state("networkidle")
-            print("INFO: Page loaded successfully")
-            
-            # Wait for the Angular form fields to be available (using your exact selectors)
-            email_selector = 'input[id="emailAddress"]'
-            password_selector = 'input[id="password"]'
-            
-            try:
-                # Wait for email field to be visible and ready
-                print("INFO: Waiting for login form...")
-                await page.wait_for_selector(email_selector, state="visible", timeout=30000)
-                print(f"INFO: Filling email field: {username}")
-                await page.fill(email_selector, username)
-                
-                # Wait for password field to be visible and ready
-                await page.wait_for_selector(password_selector, state="visible", timeout=10000)
-                print("INFO: Filling password field")
-                await page.fill(password_selector, password)
-                
-                # Try to find and click the Login button using your markup
-                clicked = False
-                try:
-                    await page.get_by_role("button", name="Login").click()
-                    clicked = True
-                except Exception:
-                    pass
+def remember_report_columns(host: str, header: list[str]):
+    """Keep the header row of a portal export, so grid-built reports use the same columns."""
+    header = [cell.strip() for cell in header]
+    while header and not header[-1]:
+        header.pop()
+    if not host or not header:
+        return
+    with closing(_jobs_db()) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO report_columns (host, columns, updated_at) VALUES (?, ?, ?)",
+            (host, json.dumps(header), time.time()),
+        )
 
-                if not clicked:
-                    try:
-                        await page.locator("button[label='Login']").click()
-                        clicked = True
-                    except Exception:
-                        pass
 
-                if not clicked:
-                    try:
-                        await page.locator("button.form__button:has-text('Login')").click()
-                        clicked = True
-                    except Exception:
-                        pass
+def report_columns(host: str) -> list[str]:
+    """Columns of the host's export as last seen, or GRID_DEFAULT_COLUMNS before any export."""
+    with closing(_jobs_db()) as conn:
+        row = conn.execute("SELECT columns FROM report_columns WHERE host = ?", (host,)).fetchone()
+    return json.loads(row["columns"]) if row else list(GRID_DEFAULT_COLUMNS)
 
-                if not clicked:
-                    try:
-                        await page.click("button[type='submit']")
-                        clicked = True
-                    except Exception:
-                        # If still not found, press Enter in password field
-                        await page.press(password_selector, "Enter")
-                
-                # Wait for navigation and then attempt to select the Courses tool
-                try:
-                    print("INFO: Waiting for page to load after login...")
-                    await page.wait_for_load_state("networkidle", timeout=60000)
-                    # Additional wait for Angular to render the menu items
-                    await page.wait_for_timeout(2000)
-                    print("INFO: Login successful, page loaded")
-                except Exception:
-                    pass
 
-                # Route based on report type - Test Level Analysis has different flow after login
-                if report_type == "test_analysis":
-                    # For Test Level Analysis, skip course/module/test navigation
-                    # Go directly to Test Level Analysis flow after login
-                    sanitized_filename = None
-                    import re as _re
-                    if filename_choice == "course" and (course_query or "").strip():
-                        sanitized_filename = (
-                            _re.sub(r"[^A-Za-z0-9._-]+", "_", course_query.strip()).strip("_") or "report"
-                        )
-                    elif filename_choice == "test" and (test_query or "").strip():
-                        sanitized_filename = (
-                            _re.sub(r"[^A-Za-z0-9._-]+", "_", test_query.strip()).strip("_") or "report"
-                        )
-                    
-                    # Proceed to Test Level Analysis flow after login
-                    await download_test_level_analysis_report(
-                        page, download_dir, sanitized_filename,
-                        course_query or "", test_query or "", campus, batch
-                    )
-                else:
-                    # Performance and Participation Report flow (unchanged)
-                    # Wait for the left-menu container and then click the Courses option
-                    course_clicked = False
-                    
-                    # First, wait for the left-menu container to be visible
-                    try:
-                        await page.wait_for_selector("div.left-menu", state="visible", timeout=30000)
-                        await page.wait_for_timeout(1000)  # Additional wait for menu items to render
-                    except Exception:
-                        pass
+def _iter_csv_rows(stream):
+    yield from csv.reader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
 
-                    # Primary: Wait for and click Courses within the left-menu using ptooltip attribute
-                    try:
-                        course_locator = page.locator("div.left-menu li[ptooltip='Courses']")
-                        await course_locator.wait_for(state="visible", timeout=30000)
-                        await course_locator.first.click()
-                        course_clicked = True
-                    except Exception:
-                        pass
-
-                    # Fallback 1: Click via class and icon within left-menu
-                    if not course_clicked:
-                        try:
-                            course_locator = page.locator("div.left-menu li.each-tool:has(span.icon-learning)")
-                            await course_locator.wait_for(state="visible", timeout=10000)
-                            # Filter to only the one with ptooltip="Courses"
-                            course_locator = page.locator("div.left-menu li.each-tool[ptooltip='Courses']")
-                            await course_locator.first.click()
-                            course_clicked = True
-                        except Exception:
-                            pass
-
-                    # Fallback 2: Click the span inside the li within left-menu
-                    if not course_clicked:
-                        try:
-                            course_locator = page.locator("div.left-menu li[ptooltip='Courses'] span.icon-learning")
-                            await course_locator.wait_for(state="visible", timeout=10000)
-                            await course_locator.first.click()
-                            course_clicked = True
-                        except Exception:
-                            pass
-
-                    # Fallback 3: Try clicking by text content within left-menu
-                    if not course_clicked:
-                        try:
-                            course_locator = page.locator("div.left-menu").get_by_role("listitem").filter(has_text="Courses")
-                            await course_locator.first.click()
-                            course_clicked = True
-                        except Exception:
-                            pass
-
-                    # If a course query was provided, focus search and type it
-                    if course_clicked and (course_query or "").strip():
-                        print(f"INFO: Searching for course: {course_query.strip()}")
-                        search_sel = "input[placeholder='Enter course name to search']"
-                        try:
-                            await page.wait_for_selector(search_sel, state="visible", timeout=20000)
-                            await page.click(search_sel)
-                            await page.fill(search_sel, course_query.strip())
-                            # Submit with Enter to trigger search
-                            await page.press(search_sel, "Enter")
-                            print(f"INFO: Course search submitted: {course_query.strip()}")
-                            
-                            # Wait for search results to appear and click on the course row
-                            try:
-                                # Wait for the results table to appear
-                                await page.wait_for_selector("tbody.ui-datatable-data", state="visible", timeout=10000)
-                                await page.wait_for_timeout(2000)  # Additional wait for table to fully render
-                                
-                                # Try to click the row containing the course name (partial match)
-                                course_row_clicked = False
-                                try:
-                                    # Look for a row containing the course name text
-                                    course_row = page.locator("tbody.ui-datatable-data tr").filter(has_text=course_query.strip())
-                                    await course_row.first.wait_for(state="visible", timeout=10000)
-                                    await course_row.first.click()
-                                    course_row_clicked = True
-                                except Exception:
-                                    pass
-                                
-                                # Fallback: Click the first result row if specific match failed
-                                if not course_row_clicked:
-                                    try:
-                                        await page.locator("tbody.ui-datatable-data tr.ui-datatable-even").first.click()
-                                        course_row_clicked = True
-                                    except Exception:
-                                        pass
-                                
-                                # Fallback: Click anywhere on the first row
-                                if not course_row_clicked:
-                                    try:
-                                        await page.locator("tbody.ui-datatable-data tr").first.click()
-                                        course_row_clicked = True
-                                    except Exception:
-                                        pass
-                                
-                                # After clicking the course row, wait for navigation to course page
-                                if course_row_clicked:
-                                    try:
-                                        await page.wait_for_load_state("networkidle", timeout=10000)
-                                    except Exception:
-                                        pass
-                            except Exception:
-                                pass
-                        except Exception:
-                            pass
-
-                    # If a module was supplied, click the matching module in the sidebar
-                    if (module_query or "").strip():
-                        target_module = " ".join(module_query.strip().split())
-                        print(f"INFO: Selecting module: {target_module}")
-                        try:
-                            sidebar = page.locator("div.ui-g-3.sidedivpre")
-                            module_entries = sidebar.locator("span.modulelist")
-
-                            import re as _re_mod
-
-                            pattern_module = _re_mod.compile(_re_mod.escape(target_module), flags=_re_mod.IGNORECASE)
-                            matching_module = module_entries.filter(has_text=pattern_module)
-                            await matching_module.first.click()
-                            await page.wait_for_timeout(10000)
-                        except Exception:
-                            pass
-
-                    # If a specific test should be interacted with, search the preview page
-                    test_clicked = False
-                    sanitized_filename = None
-                    
-                    # Determine which name to use for the filename based on user choice
-                    import re as _re  # local import to keep scope limited
-                    if filename_choice == "course" and (course_query or "").strip():
-                        sanitized_filename = (
-                            _re.sub(r"[^A-Za-z0-9._-]+", "_", course_query.strip()).strip("_") or "report"
-                        )
-                    elif filename_choice == "test" and (test_query or "").strip():
-                        sanitized_filename = (
-                            _re.sub(r"[^A-Za-z0-9._-]+", "_", test_query.strip()).strip("_") or "report"
-                        )
-                    
-                    if (test_query or "").strip():
-                        target_test = " ".join(test_query.strip().split())
-                        print(f"INFO: Selecting test: {target_test}")
-                        try:
-                            main_container = page.locator("div.ui-g-9.maindivpre")
-                            await main_container.wait_for(state="visible", timeout=5000)
-                            test_cards = main_container.locator("div.ui-g-12.moduletest")
-
-                            pattern = _re.compile(_re.escape(target_test), flags=_re.IGNORECASE)
-                            matching_card = test_cards.filter(has_text=pattern)
-
-                            await matching_card.first.wait_for(state="visible", timeout=5000)
-                            card = matching_card.first
-                            await card.scroll_into_view_if_needed()
-
-                            completed_counter = card.locator(
-                                "div.confirmModal.st-count span.meta-data.ui-g-12.ui-g-nopad"
-                            )
-                            await completed_counter.first.wait_for(state="visible", timeout=5000)
-                            await completed_counter.first.click()
-                            test_clicked = True
-                        except Exception:
-                            pass
-
-                    if test_clicked:
-                        try:
-                            await page.wait_for_load_state("networkidle", timeout=2000)
-                        except Exception:
-                            pass
-                        
-                        try:
-                            # Performance and Participation Report flow (existing)
-                            print("INFO: Starting report download process...")
-                            await download_performance_participation_report(
-                                page, download_dir, sanitized_filename,
-                                course_query or "", test_query or ""
-                            )
-                            print(f"INFO: Report download completed for: {course_query or ''} - {test_query or ''}")
-                            
-                            # Click the close button after download completes
-                            await page.wait_for_timeout(10000)  # Wait 10 seconds after download completes
-                            
-                            # Function to click the close button
-                            async def click_close_button():
-                                close_clicked = False
-                                
-                                # Strategy 1: Directly click the span.pi.pi-times element
-                                try:
-                                    close_span = page.locator("a.ui-dialog-titlebar-close span.pi.pi-times, a[class*='ui-dialog-titlebar-close'] span.pi.pi-times").first
-                                    await close_span.wait_for(state="visible", timeout=10000)
-                                    await close_span.scroll_into_view_if_needed()
-                                    await page.wait_for_timeout(500)
-                                    await close_span.click(force=True)
-                                    close_clicked = True
-                                except Exception:
-                                    try:
-                                        close_span = page.locator("div.ui-dialog-titlebar span.pi.pi-times").first
-                                        await close_span.wait_for(state="visible", timeout=5000)
-                                        await close_span.scroll_into_view_if_needed()
-                                        await close_span.click(force=True)
-                                        close_clicked = True
-                                    except Exception:
-                                        try:
-                                            close_span = page.locator("span.pi.pi-times").first
-                                            await close_span.wait_for(state="visible", timeout=5000)
-                                            await close_span.scroll_into_view_if_needed()
-                                            await close_span.click(force=True)
-                                            close_clicked = True
-                                        except Exception:
-                                            pass
-                                
-                                # Strategy 2: Use JavaScript
-                                if not close_clicked:
-                                    try:
-                                        result = await page.evaluate("""
-                                            () => {
-                                                let closeSpan = document.querySelector('a.ui-dialog-titlebar-close span.pi.pi-times') || 
-                                                               document.querySelector('a[class*="ui-dialog-titlebar-close"] span.pi.pi-times') ||
-                                                               document.querySelector('div.ui-dialog-titlebar span.pi.pi-times') ||
-                                                               document.querySelector('span.pi.pi-times');
-                                                if (closeSpan) {
-                                                    closeSpan.scrollIntoView({ behavior: 'smooth', block: 'center' });
-                                                    closeSpan.click();
-                                                    const clickEvent = new MouseEvent('click', {
-                                                        bubbles: true,
-                                                        cancelable: true,
-                                                        view: window,
-                                                        button: 0
-                                                    });
-                                                    closeSpan.dispatchEvent(clickEvent);
-                                                    return true;
-                                                }
-                                                return false;
-                                            }
-                                        """)
-                                        close_clicked = result if result else False
-                                    except Exception:
-                                        pass
-                                
-                                return close_clicked
-                            
-                            # Click close button twice to close both dialogs
-                            first_click = await click_close_button()
-                            await page.wait_for_timeout(2000)
-                            second_click = await click_close_button()
-                        except Exception:
-                            pass
-
-                # Wait with periodic cancellation checks
-                wait_interval = 5000  # Check every 5 seconds
-                total_waited = 0
-                while total_waited < keep_open_ms:
-                    # Check if cancelled
-                    if process_id and process_id in active_processes:
-                        if active_processes[process_id].get('cancelled'):
-                            # Close browser if cancelled
-                            try:
-                                await browser.close()
-                            except Exception:
-                                pass
-                            return False, "Report generation was cancelled by user"
-                    
-                    await page.wait_for_timeout(min(wait_interval, keep_open_ms - total_waited))
-                    total_waited += wait_interval
 
-                return True, f"Opened in Chrome, logged in, navigated to Courses, and opened the course. Browser kept open for {(keep_open_ms//6000)} min."
-            except Exception as exc:  # noqa: BLE001
-                return False, f"Failed to fill login fields: {exc}. Please check if the page loaded correctly."
-    except Exception as exc:  # noqa: BLE001
-        return False, f"Playwright error: {exc}"
+def _iter_xlsx_rows(stream):
+    """Rows of the first worksheet as lists of strings, parsed incrementally."""
+    ns = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+    with zipfile.ZipFile(stream) as book:
+        names = book.namelist()
+        shared: list[str] = []
+        if "xl/sharedStrings.xml" in names:
+            with book.open("xl/sharedStrings.xml") as fh:
+                for _, element in ElementTree.iterparse(fh):
+                    if element.tag == f"{ns}si":
+                        shared.append("".join(t.text or "" for t in element.iter(f"{ns}t")))
+                        element.clear()
+        sheets = sorted(n for n in names if n.startswith("xl/worksheets/sheet") and n.endswith(".xml"))
+        if not sheets:
+            raise ValueError("Manifest workbook has no worksheet")
+        with book.open(sheets[0]) as fh:
+            for _, element in ElementTree.iterparse(fh):
+                if element.tag != f"{ns}row":
+                    continue
+                cells: dict[int, str] = {}
+                for index, cell in enumerate(element.iter(f"{ns}c")):
+                    letters = "".join(ch for ch in cell.get("r", "") if ch.isalpha())
+                    column = sum((ord(ch) - 64) * 26 ** i for i, ch in enumerate(reversed(letters.upper()))) - 1
+                    value = cell.find(f"{ns}v")
+                    if cell.get("t") == "s" and value is not None:
+                        text = shared[int(value.text)]
+                    elif cell.get("t") == "inlineStr":
+                        text = "".join(t.text or "" for t in cell.iter(f"{ns}t"))
+                    else:
+                        text = (value.text or "") if value is not None else ""
+                    cells[column if letters else index] = text
+                element.clear()
+                yield [cells.get(i, "") for i in range(max(cells, default=-1) + 1)]
 
 
-async def process_single_course_in_session(
-    page,
-    download_dir: Path,
-    course_query: str,
-    module_query: str,
-    test_query: str,
-    filename_choice: str = "test",
-) -> tuple[bool, str]:
-    """Process a single course/module/test within an existing browser session (assumes already on courses page) - uses EXACT same flow as single course"""
-    try:
-        # Use EXACT same flow from open_and_login_with_playwright starting from course search
-        # If a course query was provided, focus search and type it
-        if (course_query or "").strip():
-            search_sel = "input[placeholder='Enter course name to search']"
-            try:
-                await page.wait_for_selector(search_sel, state="visible", timeout=20000)
-                await page.click(search_sel)
-                await page.fill(search_sel, course_query.strip())
-                # Submit with Enter to trigger search
-                await page.press(search_sel, "Enter")
-                
-                # Wait for search results to appear and click on the course row
-                try:
-                    # Wait for the results table to appear
-                    await page.wait_for_selector("tbody.ui-datatable-data", state="visible", timeout=10000)
-                    await page.wait_for_timeout(2000)  # Additional wait for table to fully render
-                    
-                    # Try to click the row containing the course name (partial match)
-                    course_row_clicked = False
-                    try:
-                        # Look for a row containing the course name text
-                        course_row = page.locator("tbody.ui-datatable-data tr").filter(has_text=course_query.strip())
-                        await course_row.first.wait_for(state="visible", timeout=10000)
-                        await course_row.first.click()
-                        course_row_clicked = True
-                    except Exception:
-                        pass
-                    
-                    # Fallback: Click the first result row if specific match failed
-                    if not course_row_clicked:
-                        try:
-                            await page.locator("tbody.ui-datatable-data tr.ui-datatable-even").first.click()
-                            course_row_clicked = True
-                        except Exception:
-                            pass
-                    
-                    # Fallback: Click anywhere on the first row
-                    if not course_row_clicked:
-                        try:
-                            await page.locator("tbody.ui-datatable-data tr").first.click()
-                            course_row_clicked = True
-                        except Exception:
-                            pass
-                    
-                    # After clicking the course row, wait for navigation to course page
-                    if course_row_clicked:
-                        try:
-                            await page.wait_for_load_state("networkidle", timeout=10000)
-                        except Exception:
-                            pass
-                except Exception:
-                    pass
-            except Exception:
-                pass
+def iter_manifest_rows(stream, filename: str):
+    """Yield (row number, fields) for each non-empty row of a CSV or XLSX manifest, without loading it whole.
 
-        # If a module was supplied, click the matching module in the sidebar - EXACT same code
-        if (module_query or "").strip():
-            target_module = " ".join(module_query.strip().split())
-            try:
-                sidebar = page.locator("div.ui-g-3.sidedivpre")
-                module_entries = sidebar.locator("span.modulelist")
+    Raises ValueError for other file types or a header without course, module and test columns.
+    """
+    suffix = Path(filename or "").suffix.lower()
+    if suffix == ".csv":
+        rows = _iter_csv_rows(stream)
+    elif suffix == ".xlsx":
+        rows = _iter_xlsx_rows(stream)
+    else:
+        raise ValueError("Manifest must be a .csv or .xlsx file")
+    header = next(rows, None)
+    if header is None:
+        raise ValueError("Manifest is empty")
+    names = [" ".join(cell.replace("_", " ").split()).casefold() for cell in header]
+    columns = {}
+    for field, aliases in MANIFEST_COLUMNS.items():
+        index = next((i for i, name in enumerate(names) if name in aliases), None)
+        if index is not None:
+            columns[field] = index
+    missing = [field for field in ("course", "module", "test") if field not in columns]
+    if missing:
+        raise ValueError(f"Manifest header needs these columns: {', '.join(missing)}")
+    for row_no, cells in enumerate(rows, start=2):
+        if any((cell or "").strip() for cell in cells):
+            yield row_no, {field: (cells[i] or "").strip() if i < len(cells) else "" for field, i in columns.items()}
 
-                import re as _re_mod
 
-                pattern_module = _re_mod.compile(_re_mod.escape(target_module), flags=_re_mod.IGNORECASE)
-                matching_module = module_entries.filter(has_text=pattern_module)
-                await matching_module.first.click()
-                await page.wait_for_timeout(10000)
-            except Exception:
-                pass
+def load_manifest(stream, filename: str, host: str, filename_choice: str = "test") -> dict:
+    """Validate and deduplicate a manifest; names the catalog knows get its exact spelling.
 
-        # If a specific test should be interacted with, search the preview page - EXACT same code
-        test_clicked = False
-        sanitized_filename = None
-        
-        # Determine which name to use for the filename based on user choice
-        import re as _re  # local import to keep scope limited
-        if filename_choice == "course" and (course_query or "").strip():
-            sanitized_filename = (
-                _re.sub(r"[^A-Za-z0-9._-]+", "_", course_query.strip()).strip("_") or "report"
+    Returns {"rows": [...], "duplicates": n, "errors": [{"row", "error"}]}. Raises ValueError
+    for unreadable manifests or more than MANIFEST_MAX_ROWS distinct rows.
+    """
+    rows: list[dict] = []
+    errors: list[dict] = []
+    seen: set[tuple[str, str, str]] = set()
+    duplicates = 0
+    canonical: dict[tuple, str] = {}
+
+    def _canonical(field: str, name: str, course: str = "", module: str = "") -> str:
+        key = (field, _link_key(name), _link_key(course), _link_key(module))
+        if key not in canonical:
+            canonical[key] = catalog_canonical(host, field, name, course, module) or name
+        return canonical[key]
+
+    for row_no, fields in iter_manifest_rows(stream, filename):
+        missing = [field for field in ("course", "module", "test") if not fields.get(field)]
+        if missing:
+            errors.append({"row": row_no, "error": f"missing {', '.join(missing)}"})
+            continue
+        choice = (fields.get("filename_choice") or filename_choice).casefold()
+        if choice not in ("course", "test"):
+            errors.append({"row": row_no, "error": f"filename must be 'course' or 'test', not '{choice}'"})
+            continue
+        key = (_link_key(fields["course"]), _link_key(fields["module"]), _link_key(fields["test"]))
+        if key in seen:
+            duplicates += 1
+            continue
+        seen.add(key)
+        if len(rows) >= MANIFEST_MAX_ROWS:
+            raise ValueError(f"Manifest has more than {MANIFEST_MAX_ROWS} distinct rows")
+        course = _canonical("course", fields["course"])
+        module = _canonical("module", fields["module"], course)
+        rows.append({
+            "row": row_no,
+            "course": course,
+            "module": module,
+            "test": _canonical("test", fields["test"], course, module),
+            "filename_choice": choice,
+        })
+    return {"rows": rows, "duplicates": duplicates, "errors": errors}
+
+
+def plan_manifest(rows: list[dict], sessions: int) -> list[list[dict]]:
+    """Split manifest rows into per-session item lists that open each course and module once.
+
+    Rows are grouped by course, then module. Whole courses are assigned longest first to
+    the least loaded session, so expected runtimes stay balanced. A course larger than one
+    session's share is split at module boundaries, and a module larger than that into runs
+    of tests. Each session visits its groups in manifest order.
+    """
+    courses: dict[str, dict[str, list[dict]]] = {}
+    for row in rows:
+        courses.setdefault(_link_key(row["course"]), {}).setdefault(_link_key(row["module"]), []).append(row)
+    course_order = {key: i for i, key in enumerate(courses)}
+    module_order = {(c, m): i for c, modules in courses.items() for i, m in enumerate(modules)}
+
+    def _cost(modules: dict[str, list[dict]]) -> float:
+        return MANIFEST_COURSE_NAV_S + sum(MANIFEST_MODULE_NAV_S + MANIFEST_REPORT_S * len(r) for r in modules.values())
+
+    sessions = max(1, min(sessions, len(rows)))
+    share = sum(_cost(modules) for modules in courses.values()) / sessions
+    units: list[dict[str, list[dict]]] = []
+    for modules in courses.values():
+        if _cost(modules) <= share:
+            units.append(modules)
+            continue
+        for module, module_rows in modules.items():
+            pieces = max(1, min(len(module_rows), math.ceil(_cost({module: module_rows}) / share)))
+            size = math.ceil(len(module_rows) / pieces)
+            units.extend({module: module_rows[i:i + size]} for i in range(0, len(module_rows), size))
+
+    loads = [0.0] * sessions
+    plans: list[list[dict]] = [[] for _ in range(sessions)]
+    for unit in sorted(units, key=_cost, reverse=True):
+        target = loads.index(min(loads))
+        loads[target] += _cost(unit)
+        plans[target].extend(row for unit_rows in unit.values() for row in unit_rows)
+    for plan in plans:
+        plan.sort(key=lambda row: (
+            course_order[_link_key(row["course"])],
+            module_order[(_link_key(row["course"]), _link_key(row["module"]))],
+            row["row"],
+        ))
+    return [plan for plan in plans if plan]
+
+
+def submit_manifest(url: str, username: str, password: str, manifest: dict, sessions: int) -> dict:
+    """Store a loaded manifest and queue one batch job per planned session."""
+    manifest_id = str(uuid.uuid4())
+    plans = plan_manifest(manifest["rows"], sessions)
+    now = time.time()
+    with closing(_jobs_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO manifests (id, host, total, duplicates, invalid, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (manifest_id, urlparse(url).hostname or "", len(manifest["rows"]),
+                 manifest["duplicates"], len(manifest["errors"]), now),
             )
-        elif filename_choice == "test" and (test_query or "").strip():
-            sanitized_filename = (
-                _re.sub(r"[^A-Za-z0-9._-]+", "_", test_query.strip()).strip("_") or "report"
+            conn.executemany(
+                "INSERT INTO manifest_rows (manifest_id, row, course, module, test, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(manifest_id, r["row"], r["course"], r["module"], r["test"], now) for r in manifest["rows"]],
             )
-        
-        if (test_query or "").strip():
-            target_test = " ".join(test_query.strip().split())
-            try:
-                main_container = page.locator("div.ui-g-9.maindivpre")
-                await main_container.wait_for(state="visible", timeout=5000)
-                test_cards = main_container.locator("div.ui-g-12.moduletest")
-
-                pattern = _re.compile(_re.escape(target_test), flags=_re.IGNORECASE)
-                matching_card = test_cards.filter(has_text=pattern)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    job_ids = []
+    for plan in plans:
+        job_id = submit_report_job({
+            "url": url,
+            "username": username,
+            "password": password,
+            "items": [{**row, "manifest_id": manifest_id} for row in plan],
+        })
+        with closing(_jobs_db()) as conn:
+            conn.executemany(
+                "UPDATE manifest_rows SET job_id = ? WHERE manifest_id = ? AND row = ?",
+                [(job_id, manifest_id, row["row"]) for row in plan],
+            )
+        job_ids.append(job_id)
+    log.info(f"Manifest {manifest_id}: {len(manifest['rows'])} report(s) in {len(job_ids)} session(s)")
+    return {"manifest_id": manifest_id, "jobs": job_ids}
 
-                await matching_card.first.wait_for(state="visible", timeout=5000)
-                card = matching_card.first
-                await card.scroll_into_view_if_needed()
 
-                completed_counter = card.locator(
-                    "div.confirmModal.st-count span.meta-data.ui-g-12.ui-g-nopad"
-                )
-                await completed_counter.first.wait_for(state="visible", timeout=5000)
-                await completed_counter.first.click()
-                test_clicked = True
-            except Exception:
-                pass
+def record_manifest_row(item: dict, status: str, message: str = ""):
+    """Per-row progress of a batch item that came from a manifest (no-op for other items)."""
+    if not item.get("manifest_id"):
+        return
+    with closing(_jobs_db()) as conn:
+        conn.execute(
+            "UPDATE manifest_rows SET status = ?, message = ?, updated_at = ? WHERE manifest_id = ? AND row = ?",
+            (status, message, time.time(), item["manifest_id"], item["row"]),
+        )
 
-        if test_clicked:
-            try:
-                await page.wait_for_load_state("networkidle", timeout=2000)
-            except Exception:
-                pass
-            
-            try:
-                checkbox = page.locator(
-                    "div.ui-chkbox-box.ui-widget.ui-corner-all.ui-state-default"
-                ).first
-                await checkbox.wait_for(state="visible", timeout=10000)
-                await checkbox.click()
-
-                select_all = (
-                    page.locator("span.text-underline")
-                    .filter(has_text="Select all")
-                    .first
-                )
-                try:
-                    await select_all.wait_for(state="visible", timeout=3000)
-                    await select_all.click()
-                except Exception:
-                    pass
 
-                action_label = (
-                    page.locator("label.ui-dropdown-label")
-                    .filter(has_text="Action")
-                    .first
-                )
-                await action_label.wait_for(state="visible", timeout=10000)
-                dropdown_container = action_label.locator(
-                    "xpath=ancestor::div[contains(@class, 'ui-dropdown')]"
-                )
-                await dropdown_container.first.click()
+def manifest_progress(manifest_id: str, status: str | None = None, limit: int = 200, offset: int = 0) -> dict | None:
+    """Row counts per status and a page of rows; rows left behind by a finished job count as 'not_run'."""
+    row_status = (
+        "CASE WHEN r.status IN ('pending', 'running') AND j.status IN ('done', 'failed', 'cancelled') "
+        "THEN 'not_run' ELSE r.status END"
+    )
+    with closing(_jobs_db()) as conn:
+        manifest = conn.execute("SELECT * FROM manifests WHERE id = ?", (manifest_id,)).fetchone()
+        if manifest is None:
+            return None
+        counts = {
+            row["status"]: row["n"] for row in conn.execute(
+                f"SELECT {row_status} AS status, COUNT(*) AS n FROM manifest_rows r "
+                "LEFT JOIN jobs j ON j.id = r.job_id WHERE r.manifest_id = ? GROUP BY 1",
+                (manifest_id,),
+            )
+        }
+        rows = conn.execute(
+            f"SELECT r.row, r.course, r.module, r.test, {row_status} AS status, r.job_id, r.message "
+            "FROM manifest_rows r LEFT JOIN jobs j ON j.id = r.job_id WHERE r.manifest_id = ? "
+            f"{'AND ' + row_status + ' = ? ' if status else ''}ORDER BY r.row LIMIT ? OFFSET ?",
+            (manifest_id, *((status,) if status else ()), limit, offset),
+        ).fetchall()
+    return {
+        "manifest_id": manifest_id,
+        "total": manifest["total"],
+        "duplicates": manifest["duplicates"],
+        "invalid": manifest["invalid"],
+        "counts": counts,
+        "rows": [dict(row) for row in rows],
+    }
 
-                shareable_option = page.locator(
-                    "li.ui-dropdown-item.ui-corner-all[aria-label='Generate Shareable Link']"
-                )
-                await shareable_option.first.wait_for(state="visible", timeout=5000)
-                await shareable_option.first.click()
-                await page.wait_for_timeout(90000)
-
-                completed_label = page.locator(
-                    "span.ui-multiselect-label.ui-corner-all"
-                ).filter(has_text="Completed").first
-                await completed_label.wait_for(state="visible", timeout=5000)
-                await completed_label.click()
-
-                multiselect_checkbox = page.locator(
-                    "div.ui-multiselect-panel div.ui-chkbox-box.ui-widget.ui-corner-all.ui-state-default"
-                ).first
-                await multiselect_checkbox.wait_for(state="visible", timeout=5000)
-                await multiselect_checkbox.click()
-
-                download_results = (
-                    page.locator("span", has_text="Download results").first
-                )
-                await download_results.wait_for(state="visible", timeout=10000)
-                await download_results.scroll_into_view_if_needed()
-                await download_results.click()
 
-                # Select Excel option instead of CSV
-                excel_option_clicked = False
-                try:
-                    # Try to find by label text "Excel (.xlsx)"
-                    excel_label = page.locator("label", has_text="Excel (.xlsx)").first
-                    await excel_label.wait_for(state="visible", timeout=5000)
-                    await excel_label.click()
-                    excel_option_clicked = True
-                except Exception:
-                    try:
-                        # Try to find by input value="excel"
-                        excel_input = page.locator('input[type="radio"][name="downloadFileType"][value="excel"]')
-                        await excel_input.wait_for(state="visible", timeout=5000)
-                        await excel_input.click()
-                        excel_option_clicked = True
-                    except Exception:
-                        try:
-                            # Try to find p-radiobutton with label="Excel (.xlsx)"
-                            excel_radio = page.locator('p-radiobutton[label="Excel (.xlsx)"]').first
-                            await excel_radio.wait_for(state="visible", timeout=5000)
-                            await excel_radio.click()
-                            excel_option_clicked = True
-                        except Exception:
-                            # Fallback: find span inside p-radiobutton with Excel label
-                            excel_span = page.locator('p-radiobutton:has(label:has-text("Excel")) span.ui-radiobutton-icon').first
-                            await excel_span.wait_for(state="visible", timeout=5000)
-                            await excel_span.click()
-                            excel_option_clicked = True
-
-                download_button = page.locator(
-                    "button.download-button"
-                ).first
-                await download_button.wait_for(state="visible", timeout=5000)
+def _scheduler_loop():
+    """Dispatch due schedules forever; only the process holding the scheduler lock does so."""
+    lock_handle = None
+    while True:
+        try:
+            if lock_handle is None:
+                SERVER_STATE_DIR.mkdir(exist_ok=True)
+                handle = open(SCHEDULER_LOCK_FILE, "a+")
                 try:
-                    async with page.expect_download() as download_info:
-                        await download_button.click()
-                    download = await download_info.value
-                    suggested_name = download.suggested_filename
-                    extension = Path(suggested_name).suffix or ".xlsx"
-                    # Create unique filename with timestamp
-                    timestamp = int(time.time())
-                    if sanitized_filename:
-                        unique_filename = f"{timestamp}_{sanitized_filename}{extension}"
-                        # Use sanitized filename (based on user's choice) as the download name
-                        download_filename = f"{sanitized_filename}{extension}"
-                    else:
-                        base_name = Path(suggested_name).stem
-                        unique_filename = f"{timestamp}_{base_name}{extension}"
-                        download_filename = suggested_name
-                    target_path = download_dir / unique_filename
-                    await download.save_as(str(target_path))
-                    
-                    # Register the file with the correct filename based on user's choice
-                    register_downloaded_file(
-                        target_path,
-                        download_filename,  # Use the filename based on user's choice
-                        course_query or "",
-                        test_query or ""
-                    )
-                    
-                    # Close dialogs after download - EXACT same code
-                    await page.wait_for_timeout(10000)  # Wait 10 seconds after download completes
-                    
-                    close_clicked = False
-                    
-                    # Strategy 1: Directly click the span.pi.pi-times element inside ui-dialog-titlebar-close
-                    try:
-                        close_span = page.locator("a.ui-dialog-titlebar-close span.pi.pi-times, a[class*='ui-dialog-titlebar-close'] span.pi.pi-times").first
-                        await close_span.wait_for(state="visible", timeout=10000)
-                        await close_span.scroll_into_view_if_needed()
-                        await page.wait_for_timeout(500)
-                        await close_span.click(force=True)
-                        close_clicked = True
-                    except Exception:
-                        try:
-                            close_span = page.locator("div.ui-dialog-titlebar span.pi.pi-times").first
-                            await close_span.wait_for(state="visible", timeout=5000)
-                            await close_span.scroll_into_view_if_needed()
-                            await close_span.click(force=True)
-                            close_clicked = True
-                        except Exception:
-                            try:
-                                close_span = page.locator("span.pi.pi-times").first
-                                await close_span.wait_for(state="visible", timeout=5000)
-                                await close_span.scroll_into_view_if_needed()
-                                await close_span.click(force=True)
-                                close_clicked = True
-                            except Exception:
-                                pass
-                    
-                    # Strategy 2: Use JavaScript to directly click the span.pi.pi-times element
-                    if not close_clicked:
-                        try:
-                            result = await page.evaluate("""
-                                () => {
-                                    let closeSpan = document.querySelector('a.ui-dialog-titlebar-close span.pi.pi-times') || 
-                                                   document.querySelector('a[class*="ui-dialog-titlebar-close"] span.pi.pi-times') ||
-                                                   document.querySelector('div.ui-dialog-titlebar span.pi.pi-times') ||
-                                                   document.querySelector('span.pi.pi-times');
-                                    if (closeSpan) {
-                                        closeSpan.scrollIntoView({ behavior: 'smooth', block: 'center' });
-                                        closeSpan.click();
-                                        const clickEvent = new MouseEvent('click', {
-                                            bubbles: true,
-                                            cancelable: true,
-                                            view: window,
-                                            button: 0
-                                        });
-                                        closeSpan.dispatchEvent(clickEvent);
-                                        return true;
-                                    }
-                                    return false;
-                                }
-                            """)
-                            close_clicked = result if result else False
-                        except Exception:
-                            pass
-                    
-                    # Click close button second time
-                    await page.wait_for_timeout(2000)
-                    
-                    try:
-                        close_span = page.locator("a.ui-dialog-titlebar-close span.pi.pi-times, a[class*='ui-dialog-titlebar-close'] span.pi.pi-times").first
-                        await close_span.wait_for(state="visible", timeout=5000)
-                        await close_span.scroll_into_view_if_needed()
-                        await close_span.click(force=True)
-                    except Exception:
-                        try:
-                            close_span = page.locator("span.pi.pi-times").first
-                            await close_span.wait_for(state="visible", timeout=3000)
-                            await close_span.scroll_into_view_if_needed()
-                            await close_span.click(force=True)
-                        except Exception:
-                            pass
-                except Exception:
-                    await download_button.click()
-            except Exception as exc:  # noqa: BLE001
-                return False, f"Error during download: {exc}"
+                    if fcntl is not None:
+                        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    lock_handle = handle  # held for the life of this process
+                    log.info(f"Scheduler leader is process {os.getpid()}")
+                    protect_schedule_credentials()
+                except OSError:
+                    handle.close()  # another gunicorn worker is the leader
+            if lock_handle is not None:
+                dispatch_due_schedules()
+        except Exception as exc:  # noqa: BLE001
+            log.error(f"Scheduler tick failed: {exc}")
+        time.sleep(SCHEDULER_TICK_S)
 
-            return True, f"Successfully processed {course_query} - {test_query}"
-        else:
-            return False, "Test was not clicked successfully"
-    
-    except Exception as exc:  # noqa: BLE001
-        return False, f"Error processing course: {exc}"
+
+@app.before_request
+def _start_background_threads():
+    """Start the job dispatcher (thread backend) and the schedule dispatcher in web processes.
+
+    Every web worker runs a job dispatcher; only the holder of the scheduler lock dispatches schedules.
+    """
+    global _scheduler_thread
+    if JOB_BACKEND != "worker":
+        _ensure_dispatcher()
+    if not SCHEDULER_ENABLED or _scheduler_thread is not None:
+        return
+    _scheduler_thread = threading.Thread(target=_scheduler_loop, name="report-scheduler", daemon=True)
+    _scheduler_thread.start()
 
 
 @app.get("/")
@@ -1387,10 +4590,10 @@ def index():
     """Home page - start browser installation in background when user visits."""
     # Start installing browsers in background when user visits
     # Only start if not already installed and not already installing
-    if not _browser_install_success and not _browser_install_in_progress:
-        print("INFO: User visited homepage, starting browser installation in background...")
+    if not browsers_ready() and not _browser_install_in_progress:
+        log.info("User visited homepage, starting browser installation in background...")
         _install_browsers_in_background()
-    return render_template("index.html", status=None)
+    return render_template("index.html", status=None, current_job_id=session.get("last_job_id", ""))
 
 
 @app.get("/api/browser-status")
@@ -1398,32 +4601,63 @@ def browser_status():
     """API endpoint to check browser installation status."""
     global _browser_install_in_progress
     
-    # Check if browsers are actually installed
-    browsers_ready = False
-    try:
-        from playwright.sync_api import sync_playwright  # type: ignore[reportMissingImports]
-        p_check = sync_playwright().start()
-        try:
-            browser = p_check.chromium.launch(headless=True)
-            browser.close()
-            browsers_ready = True
-        except Exception:
-            browsers_ready = False
-        finally:
-            p_check.stop()
-    except Exception:
-        browsers_ready = False
-    
+    # Answered from the shared readiness marker; no browser launch per request
+    marker = read_browser_marker()
     return jsonify({
-        "installed": browsers_ready,
+        "installed": marker is not None or browsers_ready(),
         "installing": _browser_install_in_progress,
-        "success": _browser_install_success
+        "success": browsers_ready(),
+        "engine": (marker or {}).get("engine"),
+        "revision": (marker or {}).get("revision"),
+        "launch_profile": (marker or {}).get("launch_profile"),
+        "launch_benchmark": (marker or {}).get("launch_benchmark"),
     })
 
 
+@app.get("/api/browser-metrics")
+def browser_metrics():
+    """API endpoint exposing browser RSS, recycling counters and host memory for tuning."""
+    return jsonify(browser_supervisor.metrics())
+
+
+@app.get("/api/portal-budgets")
+def portal_budgets_status():
+    """API endpoint exposing per-portal session caps, rate limits and their current scaling."""
+    return jsonify(portal_budgets())
+
+
+@app.get("/api/step-timings")
+def step_timings_status():
+    """API endpoint exposing learned per-host step timeouts for tuning."""
+    with _step_timings_lock:
+        _load_step_timings()
+        snapshot = json.loads(json.dumps(step_timings))
+    hosts = {}
+    for host, steps in snapshot.items():
+        token = _portal_host.set(host)
+        try:
+            hosts[host or "unknown"] = {
+                "speed_factor": round(portal_speed_factor(), 2),
+                "steps": {
+                    step: {
+                        "samples": len(entry["samples"]),
+                        "p50_ms": round(_percentile(entry["samples"], 50), 1) if entry["samples"] else None,
+                        "p99_ms": round(_percentile(entry["samples"], 99), 1) if entry["samples"] else None,
+                        "baseline_ms": entry["baseline_ms"],
+                        "timeout_ms": step_timeout(step, 0) or None,
+                    }
+                    for step, entry in steps.items()
+                },
+            }
+        finally:
+            _portal_host.reset(token)
+    return jsonify({"hosts": hosts})
+
+
 @app.get("/api/downloads")
 def list_downloads():
     """API endpoint to list all available downloaded files."""
+    sync_downloaded_files()
     files = []
     for file_id, metadata in file_metadata.items():
         file_path = SERVER_DOWNLOADS_DIR / metadata["filename"]
@@ -1435,6 +4669,8 @@ def list_downloads():
                 "test_name": metadata.get("test_name", ""),
                 "timestamp": metadata["timestamp"],
                 "size": metadata["size"],
+                "sha256": metadata.get("sha256", ""),
+                "unchanged": bool(metadata.get("duplicate_of")),
             })
     # Sort by timestamp, newest first
     files.sort(key=lambda x: x["timestamp"], reverse=True)
@@ -1444,77 +4680,35 @@ def list_downloads():
 @app.get("/api/generation-status")
 def generation_status():
     """API endpoint to check the status of report generation."""
-    if not active_processes:
+    job_ids = active_job_ids()
+    if not job_ids:
         return jsonify({"active": False, "message": "No active generation processes"})
-    
-    # Get the most recent process
-    latest_process = max(active_processes.items(), key=lambda x: x[1].get('started_at', 0))
-    process_id, process_info = latest_process
-    
+    job = get_job(job_ids[0])
     status = {
         "active": True,
-        "process_id": process_id,
-        "started_at": process_info.get('started_at', 0),
-        "cancelled": process_info.get('cancelled', False),
+        "process_id": job["id"],
+        "status": job["status"],
+        "started_at": job["started_at"] or job["created_at"],
+        "cancelled": bool(job["cancel_requested"]),
+        "checkpoint": json.loads(job["checkpoint"] or "{}").get("step"),
     }
-    
-    if 'result' in process_info:
-        result = process_info['result']
-        status["success"] = result[0]
-        status["message"] = result[1]
-    elif 'error' in process_info:
-        status["success"] = False
-        status["error"] = process_info['error']
-    
+    process_info = active_processes.get(job["id"])
+    if process_info:
+        status["attempt"] = process_info.get('attempt', 1)
+        status["checkpoint"] = process_info.get('checkpoint', {}).get('step')
+    status["last_event"] = latest_job_event(job["id"])
+    if job["status"] == "queued":
+        status["queue"] = queue_position(job["id"])
+    elif job["status"] == "waiting_for_browser":
+        status["browser_installing"] = _browser_install_in_progress
     return jsonify(status)
 
 
 @app.post("/api/cancel-generation")
 def cancel_generation():
-    """Cancel the current report generation process and close browser"""
+    """Cancel all queued and running report generation jobs and close their browsers"""
     try:
-        import asyncio
-        
-        # Mark all active processes as cancelled and close browsers
-        cancelled_count = 0
-        browsers_closed = 0
-        
-        for process_id, process_info in list(active_processes.items()):
-            try:
-                process_info['cancelled'] = True
-                
-                # Close browser if it exists
-                browser = process_info.get('browser')
-                if browser:
-                    try:
-                        # Close browser asynchronously
-                        async def close_browser():
-                            try:
-                                await browser.close()
-                            except Exception:
-                                pass
-                        
-                        # Try to close the browser
-                        try:
-                            # Check if there's a running event loop
-                            try:
-                                loop = asyncio.get_running_loop()
-                                # If loop is running, schedule the close
-                                asyncio.create_task(close_browser())
-                                browsers_closed += 1
-                            except RuntimeError:
-                                # No running loop, create a new one
-                                asyncio.run(close_browser())
-                                browsers_closed += 1
-                        except Exception:
-                            pass
-                    except Exception:
-                        pass
-                
-                cancelled_count += 1
-            except Exception:
-                pass
-        
+        cancelled_count = sum(cancel_report_job(job_id) for job_id in active_job_ids())
         return jsonify({
             "success": True,
             "message": f"Cancelled {cancelled_count} process(es) and closed browser(s)"
@@ -1526,18 +4720,235 @@ def cancel_generation():
         }), 500
 
 
+@app.get("/api/jobs/<job_id>")
+def job_status(job_id: str):
+    """Status of one report generation job, with queue position and estimated start while queued."""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    job["checkpoint"] = json.loads(job["checkpoint"] or "{}").get("step")
+    process_info = active_processes.get(job_id)
+    if process_info:
+        job["attempt"] = process_info.get("attempt", 1)
+        job["checkpoint"] = process_info.get("checkpoint", {}).get("step") or job["checkpoint"]
+    job["last_event"] = latest_job_event(job_id)
+    if job["status"] == "queued":
+        job["queue"] = queue_position(job_id)
+    elif job["status"] == "waiting_for_browser":
+        job["browser_installing"] = _browser_install_in_progress
+    return jsonify(job)
+
+
+@app.get("/api/jobs/<job_id>/events")
+def job_events_stream(job_id: str):
+    """Progress events of one job after the ?since= cursor (the `next` of the previous response)."""
+    if get_job(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+    try:
+        since = int(request.args.get("since", 0))
+    except ValueError:
+        return jsonify({"error": "since must be an integer"}), 400
+    return jsonify(job_events(job_id, since))
+
+
+@app.post("/api/jobs/<job_id>/cancel")
+def cancel_single_job(job_id: str):
+    """Cancel one report generation job and free its browser."""
+    if not cancel_report_job(job_id):
+        return jsonify({"success": False, "message": "Job not found or already finished"}), 404
+    return jsonify({"success": True, "message": f"Cancelled job {job_id}"})
+
+
+@app.get("/api/catalog/suggest")
+def catalog_autocomplete():
+    """Autocomplete course/module/test names from the catalog of the portal in ?url=."""
+    url = normalize_url(request.args.get("url", ""))
+    field = request.args.get("field", "course")
+    if not url or field not in ("course", "module", "test"):
+        return jsonify({"suggestions": []})
+    suggestions = catalog_suggest(
+        urlparse(url).hostname or "",
+        field,
+        request.args.get("q", ""),
+        course=request.args.get("course", "").strip(),
+        module=request.args.get("module", "").strip(),
+    )
+    return jsonify({"suggestions": suggestions})
+
+
+@app.post("/api/catalog/refresh")
+def catalog_refresh():
+    """Start a catalog crawl for the portal; only new or stale courses are visited unless full=true."""
+    data = request.get_json(silent=True) or request.form
+    url = normalize_url((data.get("url") or "").strip())
+    username = (data.get("username") or "").strip()
+    password = data.get("password") or ""
+    if not url or not username or not password:
+        return jsonify({"error": "url, username and password are required"}), 400
+    job_id = submit_report_job({
+        "url": url,
+        "username": username,
+        "password": password,
+        "crawl_catalog": True,
+        "full": str(data.get("full", "")).strip().lower() in ("1", "true", "yes", "on"),
+    })
+    return jsonify({"success": True, "job_id": job_id}), 202
+
+
+@app.post("/api/manifests")
+def manifests_create():
+    """Upload a CSV/XLSX manifest of course/module/test rows and queue it as planned batch jobs."""
+    url = normalize_url((request.form.get("url") or "").strip())
+    username = (request.form.get("username") or "").strip()
+    password = request.form.get("password") or ""
+    upload = request.files.get("manifest")
+    if not url or not username or not password or upload is None:
+        return jsonify({"error": "url, username, password and a manifest file are required"}), 400
+    try:
+        sessions = int(request.form.get("sessions") or QUEUE_MAX_PER_USER)
+        manifest = load_manifest(
+            upload.stream, upload.filename or "", urlparse(url).hostname or "",
+            (request.form.get("filename_choice") or "test").strip(),
+        )
+    except (ValueError, zipfile.BadZipFile, ElementTree.ParseError, UnicodeDecodeError) as exc:
+        return jsonify({"error": f"Invalid manifest: {exc}"}), 400
+    if not manifest["rows"]:
+        return jsonify({"error": "Manifest has no valid rows", "errors": manifest["errors"][:100]}), 400
+    # More sessions than a user may run at once would only queue behind each other
+    submitted = submit_manifest(url, username, password, manifest, max(1, min(sessions, QUEUE_MAX_PER_USER)))
+    return jsonify({
+        "success": True,
+        **submitted,
+        "rows": len(manifest["rows"]),
+        "duplicates": manifest["duplicates"],
+        "errors": manifest["errors"][:100],
+    }), 202
+
+
+@app.get("/api/manifests/<manifest_id>")
+def manifests_show(manifest_id: str):
+    """Per-row progress of a manifest; ?status=failed&limit=&offset= page through the rows."""
+    progress = manifest_progress(
+        manifest_id,
+        request.args.get("status") or None,
+        min(max(request.args.get("limit", 200, type=int), 1), 1000),  # bad values fall back to the default
+        max(request.args.get("offset", 0, type=int), 0),
+    )
+    if progress is None:
+        return jsonify({"error": "Manifest not found"}), 404
+    return jsonify(progress)
+
+
+@app.get("/api/schedules")
+def schedules_index():
+    return jsonify({
+        "schedules": list_schedules(),
+        "offpeak_window": SCHEDULE_OFFPEAK_WINDOW,
+        "offpeak_now": in_offpeak_window(),
+    })
+
+
+@app.post("/api/schedules")
+def schedules_create():
+    """Create a recurring Performance and Participation report schedule."""
+    data = request.get_json(silent=True) or request.form
+    url = normalize_url((data.get("url") or "").strip())
+    username = (data.get("username") or "").strip()
+    password = data.get("password") or ""
+    cron = " ".join((data.get("cron") or "").split())
+    if not url or not username or not password or not cron:
+        return jsonify({"error": "url, username, password and cron are required"}), 400
+    offpeak = str(data.get("offpeak", "true")).strip().lower() not in ("0", "false", "no", "off")
+    params = {
+        "url": url,
+        "username": username,
+        "password": password,
+        "course": (data.get("course") or "").strip(),
+        "module": (data.get("module") or "").strip(),
+        "test": (data.get("test") or "").strip(),
+        "filename_choice": (data.get("filename_choice") or "test").strip(),
+    }
+    try:
+        schedule = create_schedule((data.get("name") or "").strip() or params["course"] or url, cron, params, offpeak)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    except ImportError:
+        return jsonify({"error": "Schedules need the cryptography package to store the password"}), 500
+    return jsonify(schedule), 201
+
+
+@app.put("/api/schedules/credentials")
+def schedules_update_credentials():
+    """Replace the stored password of every schedule for a portal user (after a password change)."""
+    data = request.get_json(silent=True) or request.form
+    url = normalize_url((data.get("url") or "").strip())
+    username = (data.get("username") or "").strip()
+    password = data.get("password") or ""
+    if not url or not username or not password:
+        return jsonify({"error": "url, username and password are required"}), 400
+    updated = update_schedule_password(url, username, password)
+    if not updated:
+        return jsonify({"error": "No schedules for this portal user"}), 404
+    return jsonify({"success": True, "updated": updated})
+
+
+@app.delete("/api/schedules/<schedule_id>")
+def schedules_delete(schedule_id: str):
+    if not delete_schedule(schedule_id):
+        return jsonify({"error": "Schedule not found"}), 404
+    return jsonify({"success": True})
+
+
+@app.post("/api/schedules/<schedule_id>/run")
+def schedules_run_now(schedule_id: str):
+    """Run a schedule immediately, outside its cron time and the off-peak window."""
+    if get_schedule(schedule_id) is None:
+        return jsonify({"error": "Schedule not found"}), 404
+    job_ids = dispatch_due_schedules(force_ids=[schedule_id])
+    if not job_ids:
+        return jsonify({"error": "The schedule's stored password cannot be read; re-enter it"}), 409
+    return jsonify({"success": True, "job_id": job_ids[0]})
+
+
 @app.post("/api/downloads/<file_id>/remove")
 def remove_download(file_id: str):
     """Remove a file from the notification list after successful download."""
     if file_id in file_metadata:
         file_metadata.pop(file_id, None)
+        with closing(_jobs_db()) as conn:
+            conn.execute("DELETE FROM downloaded_files WHERE file_id = ?", (file_id,))
         return jsonify({"success": True, "message": "File removed from list"})
     return jsonify({"success": False, "message": "File not found"}), 404
 
 
+@app.get("/api/downloads/<file_id>/verify")
+def verify_download(file_id: str):
+    """Check a stored report against the SHA-256 recorded when it was downloaded."""
+    sync_downloaded_files()
+    metadata = file_metadata.get(file_id)
+    if metadata is None or not (SERVER_DOWNLOADS_DIR / metadata["filename"]).exists():
+        return jsonify({"error": "File not found"}), 404
+    return jsonify({"id": file_id, "sha256": metadata.get("sha256", ""), "intact": verify_stored_file(metadata)})
+
+
+# Not every host's mime.types knows .xlsx
+REPORT_MIMETYPES = {
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".csv": "text/csv",
+}
+
+
+def report_mimetype(filename: str) -> str:
+    """Content-Type for a stored report: exports are .xlsx, grid reports may be .csv."""
+    extension = Path(filename).suffix.lower()
+    return REPORT_MIMETYPES.get(extension) or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
 @app.get("/download/<file_id>")
 def download_file(file_id: str):
     """Download a file by its ID. File remains on server until explicitly removed."""
+    if file_id not in file_metadata:
+        sync_downloaded_files()
     if file_id not in file_metadata:
         return jsonify({"error": "File not found"}), 404
     
@@ -1561,7 +4972,8 @@ def download_file(file_id: str):
         file_path,
         as_attachment=True,
         download_name=metadata["original_name"],
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        mimetype=report_mimetype(metadata["original_name"]),
+        etag=metadata.get("sha256") or True,
     )
     
     # Set Content-Disposition header to ensure browser saves to Downloads folder
@@ -1570,7 +4982,6 @@ def download_file(file_id: str):
         f'attachment; filename="{metadata["original_name"]}"; '
         f'filename*=UTF-8\'\'{encoded_filename}'
     )
-    response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     response.headers['Access-Control-Expose-Headers'] = 'Content-Disposition'
     
     return response
@@ -1642,86 +5053,32 @@ def open_url():
         flash(f"Please provide the following required fields: {field_list}.", category="error")
         return redirect(url_for("index"))
 
-    # If credentials given, ensure browsers are installed first, then run Playwright automation
+    # If credentials given, queue the Playwright automation
     if username and password:
-        import asyncio
+        # Never wait for the browser install in the request: the job waits in the queue instead
+        waiting_for_browser = not browsers_ready()
+        if waiting_for_browser:
+            log.info("Browsers not ready, job will wait for the background installation")
+            _install_browsers_in_background()
 
-        # Ensure browsers are installed before starting
-        # Don't install synchronously here - it causes worker timeouts
-        # Browsers should be installed during build or in background thread
-        if not _browser_install_success:
-            print("INFO: Browsers not ready...")
-            
-            # If installation is in progress, wait for it (but not too long to avoid timeout)
-            if _browser_install_in_progress:
-                print("INFO: Installation in progress, waiting up to 2 minutes...")
-                max_wait = 120  # 2 minutes max wait (to avoid worker timeout)
-                waited = 0
-                while _browser_install_in_progress and waited < max_wait:
-                    time.sleep(5)
-                    waited += 5
-                    if _browser_install_success:
-                        print("INFO: Installation completed while waiting!")
-                        break
-                    if waited % 30 == 0:  # Log every 30 seconds
-                        print(f"INFO: Still waiting for installation... ({waited}s)")
-            
-            # If still not installed, don't try synchronous install (causes timeout)
-            # Just inform user and let background installation continue
-            if not _browser_install_success:
-                print("WARNING: Browsers not ready yet. Background installation may still be in progress.")
-                flash("Browsers are still installing in the background. Please wait 2-5 minutes and try again. The installation happens automatically when you visit the page.", category="error")
-                return redirect(url_for("index"))
-
-        process_id = str(uuid.uuid4())
-        
-        def _runner():
-            try:
-                # Check if cancelled before starting
-                if process_id in active_processes and active_processes[process_id].get('cancelled'):
-                    return
-                
-                result = asyncio.run(
-                    open_and_login_with_playwright(
-                        url,
-                        username,
-                        password,
-                        course_query,
-                        module_query,
-                        test_query,
-                        filename_choice=filename_choice,
-                        report_type=report_type,
-                        keep_open_ms=300000,
-                        process_id=process_id,
-                        campus=campus if report_type == "test_analysis" else "",
-                        batch=batch if report_type == "test_analysis" else "",
-                    )
-                )
-                # Store result for debugging
-                if process_id in active_processes:
-                    active_processes[process_id]['result'] = result
-                    if not result[0]:  # If failed
-                        print(f"ERROR: Report generation failed: {result[1]}")
-            except Exception as exc:
-                error_msg = f"Thread error: {exc}"
-                print(f"ERROR: {error_msg}")
-                import traceback
-                traceback.print_exc()
-                # Store error in process info
-                if process_id in active_processes:
-                    active_processes[process_id]['error'] = error_msg
-            finally:
-                # Remove from active processes when done
-                active_processes.pop(process_id, None)
-
-        thread = threading.Thread(target=_runner, daemon=True)
-        active_processes[process_id] = {
-            'thread': thread,
-            'cancelled': False,
-            'started_at': time.time()
+        params = {
+            "url": url,
+            "username": username,
+            "password": password,
+            "course_query": course_query,
+            "module_query": module_query,
+            "test_query": test_query,
+            "filename_choice": filename_choice,
+            "report_type": report_type,
+            "campus": campus if report_type == "test_analysis" else "",
+            "batch": batch if report_type == "test_analysis" else "",
         }
-        thread.start()
-        ok, msg = True, "Launching Chrome and attempting auto-login in the background."
+        process_id = submit_report_job(params)
+        session["last_job_id"] = process_id
+        if waiting_for_browser:
+            ok, msg = True, "Browsers are still installing. Your report is queued and starts automatically once they are ready."
+        else:
+            ok, msg = True, "Launching Chrome and attempting auto-login in the background."
     else:
         ok, msg = open_in_chrome(url)
 
@@ -1739,7 +5096,7 @@ def _install_browsers_in_background():
     global _browser_install_in_progress, _browser_install_thread, _browser_install_attempted
     
     # If already successfully installed, don't do anything
-    if _browser_install_success:
+    if browsers_ready():
         return
     
     # Don't start multiple installations
@@ -1756,28 +5113,28 @@ def _install_browsers_in_background():
     def _install():
         global _browser_install_in_progress, _browser_install_success
         try:
-            print("INFO: Starting automatic browser installation in background...")
+            log.info("Starting automatic browser installation in background...")
             result = ensure_playwright_browsers_installed()
             if result:
-                print("INFO: ✅ Background installation completed successfully!")
+                log.info("✅ Background installation completed successfully!")
+                release_browser_waiting_jobs()
+                _dispatch_wakeup.set()
             else:
-                print("INFO: ⚠️ Background installation did not complete successfully")
+                log.info("⚠️ Background installation did not complete successfully")
         except Exception as exc:
-            print(f"ERROR: Background installation failed: {exc}")
-            import traceback
-            traceback.print_exc()
+            log.exception(f"Background installation failed: {exc}")
         finally:
             _browser_install_in_progress = False
     
     _browser_install_thread = threading.Thread(target=_install, daemon=True)
     _browser_install_thread.start()
-    print("INFO: Browser installation thread started in background")
+    log.info("Browser installation thread started in background")
     return _browser_install_thread
 
 
 if __name__ == "__main__":
     # Also install browsers when running directly
-    print("INFO: Starting app and checking Playwright browsers...")
+    log.info("Starting app and checking Playwright browsers...")
     ensure_playwright_browsers_installed()
     
     port = int(os.environ.get("PORT", 8000))
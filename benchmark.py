@@ -0,0 +1,274 @@
+"""Load/micro-benchmark harness for the Flask API endpoints.
+
+Seeds ``file_metadata`` / ``server_downloads`` and the jobs.db queue with synthetic data and drives
+the endpoints through the WSGI app (Flask test client) under configurable
+concurrency. Reports throughput, latency percentiles and peak allocations per
+request, and compares the results against a saved baseline.
+
+Examples:
+    python benchmark.py
+    python benchmark.py --entries 1000 10000 100000 --concurrency 1 8 32
+    python benchmark.py --endpoints downloads download --save-baseline
+    python benchmark.py --fail-on-regression --tolerance 0.15
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import app as webapp
+
+
+ENDPOINTS = ("downloads", "generation-status", "download", "open")
+DEFAULT_BASELINE = Path("benchmarks") / "baseline.json"
+
+# Synthetic report sizes (bytes) cycled across seeded files
+FILE_SIZES = (4 * 1024, 64 * 1024, 512 * 1024, 4 * 1024 * 1024)
+
+
+def seed_downloads(downloads_dir: Path, entries: int, max_files: int) -> list[str]:
+    """Fill file_metadata with `entries` records backed by at most `max_files` files on disk."""
+    webapp.file_metadata.clear()
+    downloads_dir.mkdir(parents=True, exist_ok=True)
+    file_count = max(1, min(entries, max_files))
+    filenames = []
+    for i in range(file_count):
+        size = FILE_SIZES[i % len(FILE_SIZES)]
+        name = f"bench_{i}_{size}.xlsx"
+        path = downloads_dir / name
+        if not path.exists() or path.stat().st_size != size:
+            with open(path, "wb") as fh:
+                fh.write(os.urandom(min(size, 4096)) * (size // min(size, 4096)))
+        filenames.append(name)
+
+    file_ids = []
+    now = time.time()
+    for i in range(entries):
+        name = filenames[i % file_count]
+        file_id = f"{int(now) - i}_{i}_{name}"
+        webapp.file_metadata[file_id] = {
+            "filename": name,
+            "original_name": f"Course_{i % 97}_Test_{i % 13}.xlsx",
+            "course_name": f"Course {i % 97}",
+            "test_name": f"Test {i % 13}",
+            "timestamp": datetime.fromtimestamp(now - i).isoformat(),
+            "size": (downloads_dir / name).stat().st_size,
+        }
+        file_ids.append(file_id)
+    return file_ids
+
+
+def seed_jobs(count: int) -> None:
+    """Reset the job queue in jobs.db and fill it with `count` queued synthetic jobs."""
+    from contextlib import closing
+
+    with closing(webapp._jobs_db()) as conn:
+        for table in ("jobs", "job_events", "queue_users", "queue_state"):
+            conn.execute(f"DELETE FROM {table}")
+    for i in range(count):
+        webapp.enqueue_job({
+            "url": "https://portal.example.com",
+            "username": f"bench{i % 10}@example.com",
+            "course": f"Course {i % 97}",
+            "module": "Week 1",
+            "test": f"Test {i % 13}",
+        })
+
+
+async def _noop_automation(*args, **kwargs):
+    """Stand-in for the Playwright flow so /open measures only the web tier."""
+    return True, "benchmark"
+
+
+def _make_request(client, endpoint: str, file_ids: list[str], rng: random.Random):
+    if endpoint == "downloads":
+        return client.get("/api/downloads")
+    if endpoint == "generation-status":
+        return client.get("/api/generation-status")
+    if endpoint == "download":
+        return client.get(f"/download/{rng.choice(file_ids)}")
+    if endpoint == "open":
+        return client.post("/open", data={
+            "url": "https://portal.example.com",
+            "username": "bench@example.com",
+            "password": "secret",
+            "report_type": "performance",
+            "course": "Course 1",
+            "module": "Week 1",
+            "test": "Test 1",
+            "filename_choice": "test",
+        })
+    raise ValueError(f"Unknown endpoint: {endpoint}")
+
+
+def _percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def run_load(endpoint: str, file_ids: list[str], concurrency: int, requests_total: int) -> dict:
+    """Drive one endpoint with `concurrency` threads and return throughput/latency stats."""
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+    per_worker = max(1, requests_total // concurrency)
+
+    def _worker(seed: int):
+        nonlocal errors
+        client = webapp.app.test_client()
+        rng = random.Random(seed)
+        local = []
+        local_errors = 0
+        for _ in range(per_worker):
+            start = time.perf_counter()
+            response = _make_request(client, endpoint, file_ids, rng)
+            response.get_data()
+            local.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                local_errors += 1
+            response.close()
+        with lock:
+            latencies.extend(local)
+            errors += local_errors
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(_worker, range(concurrency)))
+    wall = time.perf_counter() - wall_start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "p50_ms": round(_percentile(latencies, 50), 3),
+        "p95_ms": round(_percentile(latencies, 95), 3),
+        "p99_ms": round(_percentile(latencies, 99), 3),
+        "mean_ms": round(statistics.fmean(latencies), 3) if latencies else 0.0,
+    }
+
+
+def measure_allocations(endpoint: str, file_ids: list[str], samples: int) -> float:
+    """Mean peak traced allocation (KiB) per request, measured single-threaded."""
+    client = webapp.app.test_client()
+    rng = random.Random(0)
+    # Warm up imports/caches so they don't count against the first sample
+    _make_request(client, endpoint, file_ids, rng).close()
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            response = _make_request(client, endpoint, file_ids, rng)
+            response.get_data()
+            response.close()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(max(0, peak - base))
+    finally:
+        tracemalloc.stop()
+    return round(statistics.fmean(peaks) / 1024, 2) if peaks else 0.0
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return human-readable regressions against the baseline."""
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        if previous["throughput_rps"] and current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{key}: throughput {current['throughput_rps']} rps < baseline {previous['throughput_rps']} rps"
+            )
+        for metric in ("p95_ms", "p99_ms", "alloc_peak_kib"):
+            if previous.get(metric) and current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{key}: {metric} {current[metric]} > baseline {previous[metric]}")
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the Report Generator API endpoints.")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--entries", nargs="+", type=int, default=[1000, 10000])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--requests", type=int, default=400, help="Requests per run")
+    parser.add_argument("--alloc-samples", type=int, default=20)
+    parser.add_argument("--max-files", type=int, default=500, help="Distinct files written to disk")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.20, help="Allowed relative regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+
+    # Keep the benchmark away from the real downloads folder and the real browser
+    bench_dir = Path(tempfile.mkdtemp(prefix="reportgen_bench_"))
+    webapp.SERVER_DOWNLOADS_DIR = bench_dir
+    webapp.JOB_QUEUE_DB = bench_dir / "jobs.db"
+    webapp.open_and_login_with_playwright = _noop_automation
+    # /open only enqueues: no dispatcher picks up the seeded or posted jobs
+    webapp._ensure_dispatcher = lambda: None
+    webapp._browser_install_success = True
+    webapp.SCHEDULER_ENABLED = False
+
+    results: dict[str, dict] = {}
+    print(f"{'endpoint':<18} {'entries':>7} {'conc':>5} {'rps':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'allocKiB':>9} {'err':>4}")
+    for entries in args.entries:
+        file_ids = seed_downloads(bench_dir, entries, args.max_files)
+        for endpoint in args.endpoints:
+            seed_jobs(max(1, entries // 100))
+            alloc = measure_allocations(endpoint, file_ids, args.alloc_samples)
+            for concurrency in args.concurrency:
+                # /open queues jobs; reseed so every run sees the same queue length
+                seed_jobs(max(1, entries // 100))
+                stats = run_load(endpoint, file_ids, concurrency, args.requests)
+                stats["alloc_peak_kib"] = alloc
+                key = f"{endpoint}|{entries}|{concurrency}"
+                results[key] = stats
+                print(
+                    f"{endpoint:<18} {entries:>7} {concurrency:>5} {stats['throughput_rps']:>9} "
+                    f"{stats['p50_ms']:>8} {stats['p95_ms']:>8} {stats['p99_ms']:>8} {alloc:>9} {stats['errors']:>4}"
+                )
+
+    exit_code = 0
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare_with_baseline(results, baseline.get("results", {}), args.tolerance)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for line in regressions:
+                print(f"  - {line}")
+            if args.fail_on_regression:
+                exit_code = 1
+        else:
+            print(f"\nNo regressions against baseline ({args.baseline}).")
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps({
+            "saved_at": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "results": results,
+        }, indent=2), encoding="utf-8")
+        print(f"Baseline saved to {args.baseline}")
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -43,5 +43,10 @@ except Exception as e:
     print('Build will continue - browser may download at runtime')
 "
 
+echo "Step 6: Writing browser readiness marker..."
+# Verifies the browser once per deploy and records it in server_state/browser_ready.json,
+# so gunicorn workers don't launch Chromium at startup just to find out it exists
+python -c "import app; print('Browser ready:', app.ensure_playwright_browsers_installed(full_benchmark=True))" || echo "Note: readiness marker not written, workers will verify at runtime"
+
 echo "=== Build completed! ==="
 
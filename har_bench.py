@@ -0,0 +1,274 @@
+"""Record a real report job as a HAR and replay it offline for repeatable timings.
+
+Recording runs ``open_and_login_with_playwright`` once against the live portal and saves
+the browser context's traffic as a HAR. Credentials are replaced by placeholders, auth and
+cookie headers are blanked, and the job parameters are stored in the HAR. Replaying serves
+the HAR through Playwright's ``route_from_har`` (requests missing from it are aborted), with
+optional latency injected per request, and reports the job's wall time and per-step
+durations against a saved baseline. Replays need no network.
+
+Examples:
+    python har_bench.py record --url https://portal.example.com --username me@example.com \\
+        --password secret --course "Course 1" --module "Week 1" --test "Test 1" --har benchmarks/week1.har
+    python har_bench.py replay --har benchmarks/week1.har --runs 5 --latency-ms 0 50
+    python har_bench.py replay --har benchmarks/week1.har --save-baseline
+    python har_bench.py replay --har benchmarks/week1.har --fail-on-regression --tolerance 0.15
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import quote, quote_plus
+
+import app as webapp
+
+
+DEFAULT_BASELINE = Path("benchmarks") / "har_baseline.json"
+
+# Replays log in with these; recorded credentials are rewritten to them
+USERNAME_PLACEHOLDER = "har-user@example.com"
+PASSWORD_PLACEHOLDER = "har-password"
+SCRUB_HEADERS = ("authorization", "proxy-authorization", "cookie", "set-cookie", "x-csrf-token", "x-xsrf-token")
+
+# The same value as it can appear in a HAR: raw, in URL-encoded forms, and inside JSON strings
+_ENCODINGS = (
+    lambda v: v,
+    lambda v: quote(v, safe=""),
+    quote_plus,
+    lambda v: json.dumps(v)[1:-1],
+)
+
+
+def scrub_har(har_text: str, secrets: dict[str, str]) -> tuple[dict, int]:
+    """Return the HAR with credentials removed and the number of values replaced.
+
+    Each secret is rewritten to its placeholder in the same encoding, so a replay that logs in
+    with the placeholders sends byte-identical request bodies and still matches the HAR.
+    """
+    replaced = 0
+    for secret, placeholder in secrets.items():
+        if not secret:
+            continue
+        for encode in _ENCODINGS:
+            # Escape the JSON form once more: the HAR text is itself JSON
+            form, target = json.dumps(encode(secret))[1:-1], json.dumps(encode(placeholder))[1:-1]
+            replaced += har_text.count(form)
+            har_text = har_text.replace(form, target)
+    har = json.loads(har_text)
+    for entry in har.get("log", {}).get("entries", []):
+        for message in (entry.get("request", {}), entry.get("response", {})):
+            for header in message.get("headers", []):
+                if header.get("name", "").lower() in SCRUB_HEADERS:
+                    header["value"] = "scrubbed"
+                    replaced += 1
+            for cookie in message.get("cookies", []):
+                cookie["value"] = "scrubbed"
+                replaced += 1
+    return har, replaced
+
+
+def isolate_state(run_dir: Path) -> None:
+    """Point the job queue, learned timings, deep links and downloads at `run_dir`.
+
+    Every run then starts from the same state, so it sends the same requests as the recording.
+    """
+    run_dir.mkdir(parents=True, exist_ok=True)
+    webapp.SERVER_DOWNLOADS_DIR = run_dir / "downloads"
+    webapp.JOB_QUEUE_DB = run_dir / "jobs.db"
+    webapp._jobs_db_migrated = False
+    webapp.STEP_TIMINGS_FILE = run_dir / "step_timings.json"
+    webapp.step_timings.clear()
+    webapp._step_timings_loaded = False
+    webapp.SCHEDULER_ENABLED = False
+
+
+async def _run_job(job: dict, username: str, password: str, job_id: str) -> tuple[bool, str]:
+    return await webapp.open_and_login_with_playwright(
+        job["url"], username, password,
+        job.get("course"), job.get("module"), job.get("test"),
+        filename_choice=job.get("filename_choice", "test"),
+        report_type=job.get("report_type", "performance"),
+        keep_open_ms=0,
+        process_id=job_id,
+    )
+
+
+def record(args) -> int:
+    bench_dir = Path(tempfile.mkdtemp(prefix="reportgen_har_"))
+    isolate_state(bench_dir)
+    raw_path = bench_dir / "raw.har"
+    webapp.HAR_MODE, webapp.HAR_PATH = "record", raw_path
+    job = {
+        "url": args.url,
+        "course": args.course,
+        "module": args.module,
+        "test": args.test,
+        "filename_choice": args.filename_choice,
+        "report_type": args.report_type,
+    }
+    try:
+        success, message = asyncio.run(_run_job(job, args.username, args.password, "har-record"))
+        if not raw_path.exists():
+            print(f"No HAR was written: {message}")
+            return 1
+        har, replaced = scrub_har(
+            raw_path.read_text(encoding="utf-8"),
+            {args.username: USERNAME_PLACEHOLDER, args.password: PASSWORD_PLACEHOLDER},
+        )
+    finally:
+        # The raw recording holds the real credentials
+        raw_path.unlink(missing_ok=True)
+    har["log"]["_job"] = {**job, "recorded_at": datetime.now().isoformat(), "success": success}
+    args.har.parent.mkdir(parents=True, exist_ok=True)
+    args.har.write_text(json.dumps(har), encoding="utf-8")
+    print(f"{'Recorded' if success else 'Recorded a failed job'}: {message}")
+    print(f"{len(har['log'].get('entries', []))} requests saved to {args.har}, {replaced} values scrubbed")
+    return 0 if success else 1
+
+
+async def _replay_runs(job: dict, runs: int, latency_ms: float, bench_dir: Path) -> list[dict]:
+    webapp.HAR_REPLAY_LATENCY_MS = latency_ms
+    results = []
+    for i in range(runs):
+        isolate_state(bench_dir / f"{latency_ms:g}ms_{i}")
+        job_id = f"har-replay-{i}"
+        started = time.perf_counter()
+        success, message = await _run_job(job, USERNAME_PLACEHOLDER, PASSWORD_PLACEHOLDER, job_id)
+        wall_ms = (time.perf_counter() - started) * 1000
+        webapp.flush_job_events()  # the step timings below are read back from the job's events
+        results.append({
+            "ok": success,
+            "message": message,
+            "wall_ms": wall_ms,
+            "steps": {
+                event["step"]: event["ms"]
+                for event in webapp.job_events(job_id)["events"]
+                if event["type"] == "step_finished"
+            },
+        })
+    return results
+
+
+def summarize(results: list[dict]) -> dict:
+    walls = [r["wall_ms"] for r in results]
+    step_names = {name for r in results for name in r["steps"]}
+    return {
+        "runs": len(results),
+        "errors": sum(not r["ok"] for r in results),
+        "p50_ms": round(webapp._percentile(walls, 50), 1),
+        "p95_ms": round(webapp._percentile(walls, 95), 1),
+        "mean_ms": round(statistics.fmean(walls), 1) if walls else 0.0,
+        "steps_p50_ms": {
+            name: round(webapp._percentile([r["steps"][name] for r in results if name in r["steps"]], 50), 1)
+            for name in sorted(step_names)
+        },
+    }
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return human-readable regressions against the baseline."""
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            if previous.get(metric) and current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{key}: {metric} {current[metric]} > baseline {previous[metric]}")
+        for step, ms in current["steps_p50_ms"].items():
+            before = previous.get("steps_p50_ms", {}).get(step)
+            if before and ms > before * (1 + tolerance):
+                regressions.append(f"{key}: step {step} {ms} ms > baseline {before} ms")
+    return regressions
+
+
+def replay(args) -> int:
+    har = json.loads(args.har.read_text(encoding="utf-8"))
+    job = har.get("log", {}).get("_job")
+    if not job:
+        print(f"{args.har} was not recorded by har_bench.py (no job parameters)")
+        return 1
+    bench_dir = Path(tempfile.mkdtemp(prefix="reportgen_har_"))
+    webapp.HAR_MODE, webapp.HAR_PATH = "replay", args.har.resolve()
+
+    async def _all():
+        return {latency: await _replay_runs(job, args.runs, latency, bench_dir) for latency in args.latency_ms}
+
+    results: dict[str, dict] = {}
+    print(f"{'har':<24} {'latency':>8} {'runs':>5} {'p50':>10} {'p95':>10} {'mean':>10} {'err':>4}")
+    for latency, runs in asyncio.run(_all()).items():
+        stats = summarize(runs)
+        key = f"{args.har.stem}|{latency:g}"
+        results[key] = stats
+        print(
+            f"{args.har.stem:<24} {latency:>8g} {stats['runs']:>5} {stats['p50_ms']:>10} "
+            f"{stats['p95_ms']:>10} {stats['mean_ms']:>10} {stats['errors']:>4}"
+        )
+        for step, ms in stats["steps_p50_ms"].items():
+            print(f"    {step:<28} {ms:>10}")
+        for failed in [r for r in runs if not r["ok"]][:1]:
+            print(f"    first failure: {failed['message']}")
+
+    exit_code = 0
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare_with_baseline(results, baseline.get("results", {}), args.tolerance)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for line in regressions:
+                print(f"  - {line}")
+            if args.fail_on_regression:
+                exit_code = 1
+        else:
+            print(f"\nNo regressions against baseline ({args.baseline}).")
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        saved = json.loads(args.baseline.read_text(encoding="utf-8")).get("results", {}) if args.baseline.exists() else {}
+        args.baseline.write_text(json.dumps({
+            "saved_at": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "results": {**saved, **results},
+        }, indent=2), encoding="utf-8")
+        print(f"Baseline saved to {args.baseline}")
+
+    return exit_code
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Record and replay report jobs for offline timing.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    rec = sub.add_parser("record", help="Run one job against the live portal and save its traffic")
+    rec.add_argument("--url", required=True)
+    rec.add_argument("--username", required=True)
+    rec.add_argument("--password", required=True)
+    rec.add_argument("--course")
+    rec.add_argument("--module")
+    rec.add_argument("--test")
+    rec.add_argument("--filename-choice", default="test")
+    rec.add_argument("--report-type", default="performance", choices=("performance", "test_analysis"))
+    rec.add_argument("--har", type=Path, required=True)
+
+    rep = sub.add_parser("replay", help="Replay a recorded job offline and time it")
+    rep.add_argument("--har", type=Path, required=True)
+    rep.add_argument("--runs", type=int, default=3)
+    rep.add_argument("--latency-ms", nargs="+", type=float, default=[0.0], help="Injected delay per request")
+    rep.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    rep.add_argument("--save-baseline", action="store_true")
+    rep.add_argument("--tolerance", type=float, default=0.20, help="Allowed relative regression")
+    rep.add_argument("--fail-on-regression", action="store_true")
+
+    args = parser.parse_args(argv)
+    return record(args) if args.command == "record" else replay(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""Browser worker pool for report jobs.
+
+Runs Playwright jobs in separate processes so Chromium work does not compete
+with the gunicorn web workers. The web tier and the pool share the SQLite
+queue in server_state/jobs.db; set JOB_BACKEND=worker for both:
+
+    JOB_BACKEND=worker python worker.py --processes 2
+    JOB_BACKEND=worker gunicorn app:app
+"""
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+
+def _watch_cancellation(app, job_id: str, stop: threading.Event):
+    """Forward a cancel request from the web tier to the job running in this process."""
+    while not stop.wait(0.5):
+        if app.job_cancel_requested(job_id):
+            app.cancel_job(job_id)
+            return
+
+
+def worker_loop(poll_interval: float):
+    """Claim and run queued jobs one at a time until told to stop."""
+    import app
+
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    stopping = threading.Event()
+    current = {"job_id": None}
+
+    def _shutdown(signum, frame):
+        stopping.set()
+        if current["job_id"]:
+            app.cancel_job(current["job_id"])
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+    app.log.info(f"Worker {name} ready")
+
+    while not stopping.is_set():
+        if app.host_memory_status()["under_pressure"]:
+            # Leave the job queued for a worker on a host with headroom
+            stopping.wait(poll_interval)
+            continue
+        if not app.browsers_ready():
+            # Jobs stay 'waiting_for_browser' until the web process has installed the browsers
+            stopping.wait(poll_interval)
+            continue
+        app.release_browser_waiting_jobs()
+        app.autoscale_running_limit()
+        claimed = app.claim_next_job(name)
+        if claimed is None:
+            stopping.wait(poll_interval)
+            continue
+
+        job_id, params = claimed
+        app.log.info(f"Worker {name} running job {job_id}")
+        process_info = {"thread": threading.current_thread(), "cancelled": False, "started_at": time.time()}
+        app.active_processes[job_id] = process_info
+        current["job_id"] = job_id
+        stop_watch = threading.Event()
+        threading.Thread(target=_watch_cancellation, args=(app, job_id, stop_watch), daemon=True).start()
+        try:
+            result = app.run_report_job(job_id, params)
+        finally:
+            stop_watch.set()
+            current["job_id"] = None
+
+        if process_info.get("deadline_exceeded"):
+            # Already failed by the watchdog
+            pass
+        elif stopping.is_set() and not app.job_cancel_requested(job_id):
+            # Interrupted by shutdown rather than by the user: let another worker pick it up
+            app.requeue_job(job_id)
+        else:
+            app.finish_job(job_id, result, process_info.get("checkpoint"))
+    app.log.info(f"Worker {name} stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the report browser worker pool.")
+    parser.add_argument(
+        "--processes", type=int,
+        default=int(os.environ.get("WORKER_PROCESSES", os.cpu_count() or 1)),
+        help="Number of worker processes (default: WORKER_PROCESSES or CPU count)",
+    )
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds between queue polls when idle")
+    args = parser.parse_args()
+
+    import app
+
+    app.requeue_orphaned_jobs()
+    ctx = multiprocessing.get_context("spawn")
+    stopping = threading.Event()
+
+    def _shutdown(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+
+    processes: list = [None] * max(1, args.processes)
+    app.log.info(f"Starting {len(processes)} browser worker process(es)")
+    while not stopping.is_set():
+        # Start missing workers and replace any that died
+        for i, proc in enumerate(processes):
+            if proc is None or not proc.is_alive():
+                if proc is not None:
+                    app.log.warning(f"Worker process {proc.pid} exited with {proc.exitcode}, restarting")
+                    app.requeue_orphaned_jobs()
+                processes[i] = ctx.Process(target=worker_loop, args=(args.poll_interval,), daemon=False)
+                processes[i].start()
+        stopping.wait(2)
+
+    for proc in processes:
+        if proc is not None and proc.is_alive():
+            proc.terminate()
+    for proc in processes:
+        if proc is not None:
+            proc.join(timeout=30)
+
+
+if __name__ == "__main__":
+    main()